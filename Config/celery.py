@@ -1,5 +1,10 @@
+import datetime
 import os
+import time
+
 from celery import Celery
+from celery.signals import before_task_publish, task_prerun, worker_process_init
+from kombu import Queue
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "Config.settings")
 
@@ -7,4 +12,40 @@ app = Celery("Config")
 
 app.config_from_object("django.conf:settings", namespace="CELERY")
 
+# Quick charts and small jobs, heavy exports and maintenance each have their own workers,
+# so one huge export never holds up a small chart email; see DataBuilder.queues.
+app.conf.task_default_queue = "analytics"
+app.conf.task_queues = (Queue("analytics"), Queue("reports"), Queue("maintenance"))
+app.conf.task_routes = ("DataBuilder.queues.route_task",)
+
 app.autodiscover_tasks()
+
+
+@worker_process_init.connect
+def reset_database_pools(**kwargs):
+    # Pools opened in the parent must not be shared with forked worker processes.
+    from django.db import connections
+
+    for connection in connections.all(initialized_only=True):
+        if hasattr(connection, "close_pool"):
+            connection.close_pool()
+
+
+@before_task_publish.connect
+def stamp_published_at(headers=None, **kwargs):
+    if headers is not None:
+        headers["published_at"] = time.time()
+
+
+@task_prerun.connect
+def record_queue_wait(task=None, **kwargs):
+    from DataBuilder.instrumentation import observe_queue_wait
+
+    published_at = getattr(task.request, "published_at", None)
+    if published_at is None:
+        return
+    # Countdowns are deliberate, only the time past the ETA counts as waiting.
+    if task.request.eta:
+        published_at = max(published_at, datetime.datetime.fromisoformat(task.request.eta).timestamp())
+    queue = (task.request.delivery_info or {}).get("routing_key") or app.conf.task_default_queue
+    observe_queue_wait(task.name, queue, max(time.time() - published_at, 0.0))
@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/6.0/ref/settings/
 from pathlib import Path
 import os
 from datetime import timedelta
+from celery.schedules import crontab
 from dotenv import load_dotenv
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -47,6 +48,7 @@ INSTALLED_APPS = [
     "django.contrib.sessions",
     "django.contrib.messages",
     "django.contrib.staticfiles",
+    "django.contrib.postgres",
     "DataBuilder",
     "rest_framework",
     "django_filters",
@@ -54,6 +56,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "DataBuilder.querylog.RequestIdMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -86,6 +89,15 @@ WSGI_APPLICATION = "Config.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/6.0/ref/settings/#databases
 
+# psycopg connection pool, one per web/Celery worker process. Pooling replaces
+# persistent connections, so CONN_MAX_AGE has to stay at 0 while it is enabled.
+DB_POOL_OPTIONS = {
+    "min_size": int(os.getenv("DB_POOL_MIN_SIZE", 2)),
+    "max_size": int(os.getenv("DB_POOL_MAX_SIZE", 10)),
+    "timeout": float(os.getenv("DB_POOL_TIMEOUT", 10)),
+}
+DB_POOL = os.getenv("DB_POOL", "True") == "True"
+
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.postgresql",
@@ -94,9 +106,32 @@ DATABASES = {
         "PASSWORD": os.getenv("DB_PASSWORD", "admin"),
         "HOST": DB_HOST,
         "PORT": os.getenv("DB_PORT", "5432"),
+        "OPTIONS": {"pool": DB_POOL_OPTIONS} if DB_POOL else {},
     }
 }
 
+# Analytics reads go to a streaming replica when one is configured.
+if os.getenv("DB_REPLICA_HOST"):
+    DATABASES["replica"] = {
+        **DATABASES["default"],
+        "HOST": os.getenv("DB_REPLICA_HOST"),
+        "PORT": os.getenv("DB_REPLICA_PORT", DATABASES["default"]["PORT"]),
+        "TEST": {"MIRROR": "default"},
+    }
+
+ANALYTICS_DATABASE = "replica" if "replica" in DATABASES else "default"
+ANALYTICS_REPLICA_MAX_LAG = int(os.getenv("ANALYTICS_REPLICA_MAX_LAG", 30))
+ANALYTICS_REPLICA_LAG_CHECK_INTERVAL = 5
+
+DATABASE_ROUTERS = ["DataBuilder.routers.AnalyticsReplicaRouter"]
+
+# Local benchmarks and experiments can run against SQLite instead of Postgres.
+if os.getenv("DB_ENGINE") == "sqlite":
+    DATABASES["default"] = {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": BASE_DIR / "db.sqlite3",
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/6.0/ref/settings/#auth-password-validators
@@ -134,6 +169,16 @@ USE_TZ = True
 
 STATIC_URL = "static/"
 
+# Generated analytics reports; point REPORTS_STORAGE_BACKEND at e.g. an S3 backend in production.
+STORAGES = {
+    "default": {"BACKEND": "django.core.files.storage.FileSystemStorage"},
+    "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+    "reports": {
+        "BACKEND": os.getenv("REPORTS_STORAGE_BACKEND", "django.core.files.storage.FileSystemStorage"),
+        "OPTIONS": {"location": os.getenv("REPORTS_ROOT", str(BASE_DIR / "reports"))},
+    },
+}
+
 REST_FRAMEWORK = {
     "DEFAULT_PAGINATION_CLASS": "rest_framework.pagination.PageNumberPagination",
     "PAGE_SIZE": 10,
@@ -161,9 +206,15 @@ LOGGING = {
             "level": os.getenv("DJANGO_LOG_LEVEL", "INFO"),
             "propagate": False,
         },
+        # Every statement at DEBUG only when asked for; DataBuilder.querylog logs the slow ones.
         "django.db.backends": {
             "handlers": ["console"],
-            "level": os.getenv("DJANGO_LOG_LEVEL", "DEBUG"),
+            "level": os.getenv("DJANGO_DB_LOG_LEVEL", "INFO"),
+            "propagate": False,
+        },
+        "DataBuilder.querylog": {
+            "handlers": ["console"],
+            "level": "INFO",
             "propagate": False,
         },
     },
@@ -183,6 +234,85 @@ CACHES = {
 
 ANALYTICS_CACHE_TTL = 60 * 60
 
+# Summary tables for the dashboard shapes we see most. Time dimensions other than
+# "hour" are derived from the daily bucket, so only item dimensions really matter here.
+ANALYTICS_ROLLUPS = {
+    "shop_month": ["shop_name", "month_year"],
+    "daily_total": ["day_month_year"],
+    "brand_quarter": ["brand_name", "quarter_year"],
+}
+ANALYTICS_ROLLUP_MAX_STALENESS = int(os.getenv("ANALYTICS_ROLLUP_MAX_STALENESS", 60 * 60))
+ANALYTICS_ROLLUP_REFRESH_INTERVAL = int(os.getenv("ANALYTICS_ROLLUP_REFRESH_INTERVAL", 15 * 60))
+# Ingestion also schedules a refresh, at most once per this many seconds.
+ANALYTICS_ROLLUP_REFRESH_DEBOUNCE = 60
+
+# Planner estimates above these limits are sent to Celery instead of running inline.
+ANALYTICS_SYNC_MAX_ROWS = int(os.getenv("ANALYTICS_SYNC_MAX_ROWS", 100_000))
+ANALYTICS_SYNC_MAX_COST = float(os.getenv("ANALYTICS_SYNC_MAX_COST", 1_000_000))
+ANALYTICS_JOB_RESULT_TTL = 60 * 60
+
+# get-analytics responses carry an ETag and are always revalidated; "public, no-cache" lets an
+# authorization-aware CDN in front of the GET variant store them as well.
+ANALYTICS_HTTP_CACHE_CONTROL = os.getenv("ANALYTICS_HTTP_CACHE_CONTROL", "private, no-cache")
+
+# Postgres cancels a synchronous analytics statement after this many milliseconds (503 for the client);
+# Celery jobs get the longer ANALYTICS_TASK_STATEMENT_TIMEOUT. Abandoned requests are cancelled as well.
+ANALYTICS_STATEMENT_TIMEOUT = int(os.getenv("ANALYTICS_STATEMENT_TIMEOUT", 30_000))
+ANALYTICS_TASK_STATEMENT_TIMEOUT = int(os.getenv("ANALYTICS_TASK_STATEMENT_TIMEOUT", 15 * 60 * 1000))
+ANALYTICS_DISCONNECT_POLL_INTERVAL = 0.5
+
+# Uncached analytics queries one user may run at once. Over the limit a request waits up to
+# ANALYTICS_QUERY_QUEUE_TIMEOUT seconds for a slot, then gets 429 with Retry-After.
+ANALYTICS_MAX_CONCURRENT_QUERIES = int(os.getenv("ANALYTICS_MAX_CONCURRENT_QUERIES", 2))
+ANALYTICS_QUERY_QUEUE_TIMEOUT = 5
+ANALYTICS_QUERY_RETRY_AFTER = 2
+ANALYTICS_QUERY_SLOT_TTL = 120
+
+# Bytes of DataFrames one analytics request may hold; larger results are rejected with 422.
+ANALYTICS_MEMORY_BUDGET = int(os.getenv("ANALYTICS_MEMORY_BUDGET", 512 * 1024 * 1024))
+
+# Cache warming: the most requested dashboards are recomputed after new data lands.
+ANALYTICS_WARM_TOP_K = int(os.getenv("ANALYTICS_WARM_TOP_K", 20))
+ANALYTICS_WARM_BUDGET = int(os.getenv("ANALYTICS_WARM_BUDGET", 120))
+ANALYTICS_WARM_DEBOUNCE = 60
+ANALYTICS_WARM_MAX_END_OFFSET = 31
+# Usage is counted per day; popularity is the last ANALYTICS_USAGE_DAYS days, each day weighted
+# ANALYTICS_USAGE_DECAY times the day after it, so old favourites fade out of the warm set.
+ANALYTICS_USAGE_DAYS = 14
+ANALYTICS_USAGE_DECAY = 0.8
+
+# Ingestion keeps per-shop, per-hour totals of the open day in Redis; see DataBuilder.intraday.
+ANALYTICS_INTRADAY_TTL = 2 * 24 * 60 * 60
+
+# "duckdb" answers supported requests over closed days from a Parquet snapshot of cart items
+# (the "columnar" extra); run sync_columnar_snapshot to build it. Anything else uses Postgres.
+ANALYTICS_ENGINE = os.getenv("ANALYTICS_ENGINE", "postgres")
+ANALYTICS_COLUMNAR_ROOT = Path(os.getenv("ANALYTICS_COLUMNAR_ROOT", BASE_DIR / "columnar"))
+ANALYTICS_DUCKDB_THREADS = int(os.getenv("ANALYTICS_DUCKDB_THREADS", 0)) or None
+
+# get-analytics-batch answers this many widget requests at most in one call.
+ANALYTICS_BATCH_MAX_REQUESTS = 20
+
+# "approximate": true requests read a TABLESAMPLE of cart items for ranges longer than this.
+ANALYTICS_SAMPLE_EXACT_DAYS = 31
+ANALYTICS_SAMPLE_MIN_PERCENT = 1.0
+ANALYTICS_SAMPLE_SEED = 0
+
+# Staff-only ?profile=1 on get-analytics keeps this many reports for later inspection.
+ANALYTICS_PROFILE_STORE_SIZE = 50
+ANALYTICS_PROFILE_EXPLAIN_LIMIT = 5
+
+# Statements slower than ANALYTICS_SLOW_QUERY_MS are logged, plus a sample of the rest. Per-fingerprint
+# stats of all statements reach Redis every ANALYTICS_QUERY_STATS_FLUSH_INTERVAL seconds and the
+# "Query fingerprints" admin after the next collect_query_stats_task.
+ANALYTICS_QUERY_LOG = os.getenv("ANALYTICS_QUERY_LOG", "True") == "True"
+ANALYTICS_SLOW_QUERY_MS = float(os.getenv("ANALYTICS_SLOW_QUERY_MS", 500))
+ANALYTICS_QUERY_SAMPLE_RATE = float(os.getenv("ANALYTICS_QUERY_SAMPLE_RATE", 0.01))
+ANALYTICS_QUERY_STATS_FLUSH_INTERVAL = 10
+
+# Bearer token for the Prometheus /metrics endpoint; without one it is open to staff sessions only.
+METRICS_AUTH_TOKEN = os.getenv("METRICS_AUTH_TOKEN")
+
 SIMPLE_JWT = {
     "ACCESS_TOKEN_LIFETIME": timedelta(days=1),
     "REFRESH_TOKEN_LIFETIME": timedelta(days=1),
@@ -201,6 +331,13 @@ EMAIL_USE_TLS = True
 
 DEFAULT_FROM_EMAIL = "robot@databuilder.local"
 
+# Absolute base for links in emails sent from Celery, where there is no request to build them from.
+SITE_URL = os.getenv("SITE_URL", "http://localhost:8000")
+ANALYTICS_REPORT_TTL = timedelta(days=7)
+
+# Report subscriptions run from beat every morning; emails go out over one SMTP connection in batches.
+ANALYTICS_SUBSCRIPTION_EMAIL_BATCH = 50
+
 
 CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL", "redis://localhost:6379/0")
 CELERY_RESULT_BACKEND = os.getenv("CELERY_RESULT_BACKEND", "redis://localhost:6379/0")
@@ -209,3 +346,46 @@ CELERY_ACCEPT_CONTENT = ["json"]
 CELERY_TASK_SERIALIZER = "json"
 CELERY_RESULT_SERIALIZER = "json"
 CELERY_TIMEZONE = TIME_ZONE
+
+# Queues and routing live in Config/celery.py. Workers reserve one task at a time, so a long export
+# never sits on tasks another worker could start. Heavy tasks set longer limits of their own.
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+CELERY_TASK_SOFT_TIME_LIMIT = 5 * 60
+CELERY_TASK_TIME_LIMIT = 6 * 60
+
+# Background analytics jobs whose planner estimate exceeds either limit go to the "reports" queue.
+ANALYTICS_BULK_TASK_MIN_ROWS = int(os.getenv("ANALYTICS_BULK_TASK_MIN_ROWS", 100_000))
+ANALYTICS_BULK_TASK_MIN_COST = float(os.getenv("ANALYTICS_BULK_TASK_MIN_COST", 5_000_000))
+
+CELERY_BEAT_SCHEDULE = {
+    "refresh-analytics-rollups": {
+        "task": "DataBuilder.tasks.refresh_analytics_rollups_task",
+        "schedule": ANALYTICS_ROLLUP_REFRESH_INTERVAL,
+    },
+    # Catches corrected or deleted sales, which incremental refreshes do not see.
+    "rebuild-analytics-rollups": {
+        "task": "DataBuilder.tasks.refresh_analytics_rollups_task",
+        "schedule": crontab(minute=0, hour=1),
+        "kwargs": {"full": True},
+    },
+    "delete-expired-reports": {
+        "task": "DataBuilder.tasks.delete_expired_reports_task",
+        "schedule": 60 * 60,
+    },
+    "sync-columnar-snapshot": {
+        "task": "DataBuilder.tasks.sync_columnar_snapshot_task",
+        "schedule": crontab(minute=30, hour=0),
+    },
+    "rebuild-intraday-counters": {
+        "task": "DataBuilder.tasks.rebuild_intraday_counters_task",
+        "schedule": crontab(minute=0, hour=0),
+    },
+    "collect-query-stats": {
+        "task": "DataBuilder.tasks.collect_query_stats_task",
+        "schedule": 5 * 60,
+    },
+    "send-report-subscriptions": {
+        "task": "DataBuilder.tasks.send_report_subscriptions_task",
+        "schedule": crontab(minute=0, hour=6),
+    },
+}
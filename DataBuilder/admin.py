@@ -1,5 +1,71 @@
+import datetime
+
 from django.contrib import admin
-from .models import Brand, Shop, Product, Receipt, CartItem
+from django.core.cache import cache
+from django.utils import timezone
+
+from .models import (
+    AnalyticsProfile,
+    Brand,
+    Shop,
+    Product,
+    QueryFingerprint,
+    Receipt,
+    CartItem,
+    ReportArtifact,
+    ReportSubscription,
+    RollupRefresh,
+)
+from .pagination import EstimatedCountPaginator
+
+
+class RecentDateRangeFilter(admin.SimpleListFilter):
+    # Bounded ranges instead of date_hierarchy, which scans the whole table for distinct dates.
+    title = "дата"
+    parameter_name = "period"
+    field_name = "datetime"
+    periods = {"today": ("Сьогодні", 1), "7d": ("Останні 7 днів", 7), "30d": ("Останні 30 днів", 30)}
+
+    def lookups(self, request, model_admin):
+        return [(key, label) for key, (label, _) in self.periods.items()]
+
+    def queryset(self, request, queryset):
+        if self.value() not in self.periods:
+            return queryset
+        days = self.periods[self.value()][1]
+        start = timezone.make_aware(
+            datetime.datetime.combine(timezone.localdate() - datetime.timedelta(days=days - 1), datetime.time.min)
+        )
+        return queryset.filter(**{f"{self.field_name}__gte": start})
+
+
+class CachedShopFilter(admin.SimpleListFilter):
+    title = "магазин"
+    parameter_name = "shop"
+    field_name = "shop_id"
+    cache_key = "admin:shop-choices"
+    cache_timeout = 10 * 60
+
+    def lookups(self, request, model_admin):
+        return cache.get_or_set(
+            self.cache_key,
+            lambda: [(str(pk), name) for pk, name in Shop.objects.order_by("name").values_list("id", "name")],
+            self.cache_timeout,
+        )
+
+    def queryset(self, request, queryset):
+        if not self.value():
+            return queryset
+        return queryset.filter(**{self.field_name: self.value()})
+
+
+class CartItemShopFilter(CachedShopFilter):
+    field_name = "receipt__shop_id"
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
 
 @admin.register(Brand)
@@ -26,16 +92,16 @@ class ProductAdmin(admin.ModelAdmin):
 
 
 @admin.register(Receipt)
-class ReceiptAdmin(admin.ModelAdmin):
+class ReceiptAdmin(LargeTableAdmin):
     list_display = ("id", "shop", "datetime", "total_price", "margin_price_total", "refund")
-    list_filter = ("refund", "shop", "datetime")
+    list_filter = ("refund", CachedShopFilter, RecentDateRangeFilter)
+    list_select_related = ("shop",)
     search_fields = ("id", "shop__name")
     autocomplete_fields = ("shop",)
-    date_hierarchy = "datetime"
 
 
 @admin.register(CartItem)
-class CartItemAdmin(admin.ModelAdmin):
+class CartItemAdmin(LargeTableAdmin):
     list_display = (
         "id",
         "receipt",
@@ -47,7 +113,63 @@ class CartItemAdmin(admin.ModelAdmin):
         "margin_price_total",
         "datetime",
     )
-    list_filter = ("datetime", "receipt__shop")
+    list_filter = (CartItemShopFilter, RecentDateRangeFilter)
+    list_select_related = ("receipt", "product")
     search_fields = ("receipt__id", "product__name")
     autocomplete_fields = ("receipt", "product")
-    date_hierarchy = "datetime"
+
+
+@admin.register(RollupRefresh)
+class RollupRefreshAdmin(admin.ModelAdmin):
+    list_display = ("id", "name", "refreshed_at", "duration", "rows", "source_max_datetime", "age")
+    list_filter = ("name",)
+    ordering = ("-refreshed_at",)
+
+
+@admin.register(AnalyticsProfile)
+class AnalyticsProfileAdmin(admin.ModelAdmin):
+    list_display = ("id", "created_at", "user", "duration_ms")
+    readonly_fields = ("created_at", "user", "request_data", "duration_ms", "report")
+    ordering = ("-created_at",)
+
+
+@admin.register(ReportArtifact)
+class ReportArtifactAdmin(admin.ModelAdmin):
+    list_display = ("id", "filename", "created_at", "expires_at", "size", "content_encoding")
+    readonly_fields = ("created_at", "expires_at", "file", "filename", "content_type", "content_encoding", "size")
+    ordering = ("-created_at",)
+
+
+@admin.register(ReportSubscription)
+class ReportSubscriptionAdmin(admin.ModelAdmin):
+    list_display = ("id", "name", "owner", "frequency", "render_type", "is_active", "last_period_start")
+    list_filter = ("frequency", "render_type", "is_active")
+    search_fields = ("name",)
+    autocomplete_fields = ("owner",)
+    readonly_fields = ("created_at", "last_period_start")
+    ordering = ("name",)
+
+
+@admin.register(QueryFingerprint)
+class QueryFingerprintAdmin(admin.ModelAdmin):
+    list_display = (
+        "fingerprint",
+        "short_query",
+        "calls",
+        "mean_ms",
+        "p50_ms",
+        "p95_ms",
+        "total_ms",
+        "rows",
+        "last_seen",
+    )
+    search_fields = ("query",)
+    readonly_fields = [field.name for field in QueryFingerprint._meta.fields]
+    ordering = ("-total_ms",)
+
+    @admin.display(description="query")
+    def short_query(self, obj):
+        return obj.query[:120]
+
+    def has_add_permission(self, request):
+        return False
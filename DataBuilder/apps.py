@@ -1,5 +1,19 @@
+import atexit
+
+from celery.signals import task_postrun
 from django.apps import AppConfig
+from django.core.signals import request_finished
+from django.db.backends.signals import connection_created
 
 
 class DatabuilderConfig(AppConfig):
     name = "DataBuilder"
+
+    def ready(self):
+        from .querylog import flush_query_stats, install_query_log, query_stats
+
+        connection_created.connect(install_query_log)
+        request_finished.connect(flush_query_stats)
+        task_postrun.connect(flush_query_stats)
+        # Whatever is still buffered when a process exits.
+        atexit.register(query_stats.flush)
@@ -0,0 +1,178 @@
+import datetime
+import json
+import re
+from typing import NamedTuple
+
+import pandas as pd
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Aggregate, IntegerField
+
+from .instrumentation import record_cache_lookup, record_rows, timed
+from .limits import guarded_queries
+from .memory import CHUNK_SIZE, MemoryBudget, compact_dataframe, read_dataframe
+from .models import CartItem
+from .querylog import query_tags
+from .routers import analytics_reads
+from .services import AnalyticsService, build_analytics_payload, prefetched_dataframes
+from .utils import get_datetime_bounds, iter_compiled, serialize_filters
+
+
+class Grouping(Aggregate):
+    # GROUPING(a, b, ...) is a bitmask of the arguments that are aggregated away in a row.
+    function = "GROUPING"
+    output_field = IntegerField()
+
+
+class DataFrameRequest(NamedTuple):
+    service: AnalyticsService
+    date_from: datetime.date
+    date_to: datetime.date
+    as_total: bool
+
+    @property
+    def cache_key(self) -> str:
+        return self.service.get_cache_key(self.date_from, self.date_to, self.as_total)
+
+    @property
+    def dimensions(self) -> tuple[str, ...]:
+        return () if self.as_total else tuple(self.service.db_group_kwargs)
+
+
+def get_dataframe_requests(params: dict) -> list[DataFrameRequest]:
+    service = AnalyticsService.from_params(params)
+    date_ranges = [params["date_range"]]
+    if params.get("prev_date_range"):
+        date_ranges.append(params["prev_date_range"])
+    totals = [False, True] if params.get("total", False) and params.get("group_by") else [False]
+
+    return [
+        DataFrameRequest(service, date_range["from_date"], date_range["to_date"], as_total)
+        for date_range in date_ranges
+        for as_total in totals
+    ]
+
+
+def can_share_scan(request: DataFrameRequest) -> bool:
+    service = request.service
+    return (
+        bool(service.db_aggregates)
+        and service.match_rollup(request.as_total, request.date_to) is None
+        and not service.is_receipt_level()
+        and service.get_sample_percent(request.date_from, request.date_to) is None
+        and not service.uses_intraday(request.date_from, request.date_to)
+        and not service.uses_columnar(request.date_to)
+    )
+
+
+def _grouping_mask(dimensions: list[str], grouping_set: tuple[str, ...]) -> int:
+    return sum(1 << (len(dimensions) - 1 - i) for i, d in enumerate(dimensions) if d not in grouping_set)
+
+
+def run_shared_scan(requests: list[DataFrameRequest], budget: MemoryBudget) -> dict[str, pd.DataFrame]:
+    date_from, date_to = requests[0].date_from, requests[0].date_to
+    dimensions = sorted({d for request in requests for d in request.dimensions})
+    aggregates = {m: e for request in requests for m, e in request.service.db_aggregates.items()}
+
+    # Totals of brand requests skip unbranded items too, so a scan never mixes the two filters.
+    # Dimension filters are part of the scan key as well, so every request in a scan shares them.
+    has_brand = "brand_name" in requests[0].service.db_group_kwargs
+    dimension_mapping = AnalyticsService.get_item_dimension_mapping()
+    annotations = {d: dimension_mapping[d] for d in dimensions}
+    if has_brand:
+        annotations["brand_name"] = dimension_mapping["brand_name"]
+
+    datetime_from, datetime_to = get_datetime_bounds(date_from, date_to)
+    queryset = CartItem.objects.filter(datetime__gte=datetime_from, datetime__lt=datetime_to)
+    queryset = (
+        requests[0]
+        .service.apply_filters(queryset, dimension_mapping, AnalyticsService.get_item_date_filter_mapping())
+        .annotate(**annotations)
+    )
+    if has_brand:
+        queryset = queryset.exclude(brand_name__isnull=True).exclude(brand_name__exact="")
+
+    if dimensions:
+        queryset = queryset.values(*dimensions).annotate(
+            **aggregates, grouping_set=Grouping(*[dimension_mapping[d] for d in dimensions])
+        )
+        compiler = queryset.query.get_compiler(using=queryset.db)
+        sql, params = compiler.as_sql()
+
+        # Django has no GROUPING SETS support; swap its positional GROUP BY for one set per request.
+        positions = {alias: i + 1 for i, (_, _, alias) in enumerate(compiler.select)}
+        grouping_sets = sorted({r.dimensions for r in requests}, key=len, reverse=True)
+        grouping_sql = ", ".join(f"({', '.join(str(positions[d]) for d in s)})" for s in grouping_sets)
+        sql, replaced = re.subn(r"GROUP BY \d+(?:, \d+)*$", f"GROUP BY GROUPING SETS ({grouping_sql})", sql)
+        if not replaced:
+            raise ValueError(f"Unexpected GROUP BY in shared analytics scan: {sql}")
+
+        # Streamed and compacted chunk by chunk, under the same memory budget as a single request.
+        with timed("sql"):
+            df = read_dataframe(iter_compiled(compiler, sql, params, CHUNK_SIZE), list(aggregates), budget)
+    else:
+        with timed("sql"):
+            df = compact_dataframe(
+                pd.DataFrame([{**queryset.aggregate(**aggregates), "grouping_set": 0}]), list(aggregates)
+            )
+        budget.charge(df)
+
+    record_rows(len(df))
+    if df.empty:
+        return {request.cache_key: pd.DataFrame() for request in requests}
+
+    ttl = getattr(settings, "ANALYTICS_CACHE_TTL", 3600)
+    dataframes = {}
+    for request in requests:
+        metrics = list(request.service.db_aggregates)
+        part = df[df["grouping_set"] == _grouping_mask(dimensions, request.dimensions)]
+        part = part[[*request.dimensions, *metrics]]
+        if not request.dimensions:
+            part = part[part[metrics].notna().any(axis=1)]
+
+        if part.empty:
+            dataframes[request.cache_key] = pd.DataFrame()
+            continue
+
+        part = part.reset_index(drop=True)
+        for dimension in request.dimensions:
+            if isinstance(part[dimension].dtype, pd.CategoricalDtype):
+                part[dimension] = part[dimension].cat.remove_unused_categories()
+        dataframes[request.cache_key] = part
+        cache.set(request.cache_key, part, timeout=ttl)
+
+    return dataframes
+
+
+def prefetch_dataframes(requests: list[DataFrameRequest], budget: MemoryBudget) -> dict[str, pd.DataFrame]:
+    unique_requests = {request.cache_key: request for request in requests}
+    with timed("cache_get"):
+        cached = cache.get_many(list(unique_requests))
+    for cache_key in unique_requests:
+        record_cache_lookup(cache_key in cached)
+
+    # Misses over the same range and filters can share one GROUPING SETS scan of CartItem.
+    scans: dict[tuple, list[DataFrameRequest]] = {}
+    with analytics_reads():
+        for cache_key, request in unique_requests.items():
+            if cache_key in cached or not can_share_scan(request):
+                continue
+            has_brand = "brand_name" in request.service.db_group_kwargs
+            filters = json.dumps(serialize_filters(request.service.filters), sort_keys=True)
+            scans.setdefault((request.date_from, request.date_to, has_brand, filters), []).append(request)
+
+        dataframes = dict(cached)
+        for scan_requests in scans.values():
+            if len(scan_requests) > 1:
+                dimensions = sorted({d for request in scan_requests for d in request.dimensions})
+                metrics = sorted({m for request in scan_requests for m in request.service.db_aggregates})
+                with guarded_queries(), query_tags(dimensions, metrics):
+                    dataframes.update(run_shared_scan(scan_requests, budget))
+
+    return dataframes
+
+
+def build_analytics_batch(params_list: list[dict]) -> list[dict]:
+    requests = [request for params in params_list for request in get_dataframe_requests(params)]
+    with prefetched_dataframes(prefetch_dataframes(requests, MemoryBudget())):
+        return [build_analytics_payload(params) for params in params_list]
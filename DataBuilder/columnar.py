@@ -0,0 +1,251 @@
+import datetime
+import json
+import os
+from pathlib import Path
+from typing import Any
+
+import pandas as pd
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Max, Min
+from django.utils import timezone
+
+from .models import CartItem
+from .utils import get_datetime_bounds
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+# One row per cart item with its dimensions denormalized, stored as Parquet in "day=YYYY-MM-DD" partitions.
+SNAPSHOT_COLUMNS: dict[str, str] = {
+    "local_datetime": "datetime",
+    "receipt_id": "receipt_id",
+    "product_id": "product_id",
+    "product_name": "product__name",
+    "brand_name": "product__brand__name",
+    "shop_name": "receipt__shop__name",
+    "total_price": "total_price",
+    "margin_price_total": "margin_price_total",
+    "qty": "qty",
+}
+
+# DuckDB counterparts of AnalyticsService.DIMENSION_MAPPING and METRIC_MAPPING, keyed the same way.
+# Timestamps are stored as naive local time, so truncation matches Django's Trunc* in TIME_ZONE.
+DUCKDB_DIMENSION_MAPPING: dict[str, str] = {
+    "product_name": "product_name",
+    "brand_name": "brand_name",
+    "shop_name": "shop_name",
+    "day_month_year": "date_trunc('day', local_datetime)",
+    "day_of_week": "dayofweek(local_datetime) + 1",
+    "month": "month(local_datetime)",
+    "month_year": "date_trunc('month', local_datetime)",
+    "quarter": "quarter(local_datetime)",
+    "quarter_year": "date_trunc('quarter', local_datetime)",
+    "year": "date_trunc('year', local_datetime)",
+    "hour": "hour(local_datetime)",
+}
+
+DUCKDB_METRIC_MAPPING: dict[str, str] = {
+    "turnover": "SUM(total_price)",
+    "profit": "SUM(margin_price_total)",
+    "sales_qty": "SUM(qty)",
+    "checks_count": "COUNT(DISTINCT receipt_id)",
+    "avg_check": "CAST(SUM(total_price) / NULLIF(COUNT(DISTINCT receipt_id), 0) AS DECIMAL(10, 2))",
+    "avg_price": "CAST(SUM(total_price) / NULLIF(SUM(qty), 0) AS DECIMAL(10, 2))",
+    "avg_cost": "CAST((SUM(total_price) - SUM(margin_price_total)) / NULLIF(SUM(qty), 0) AS DECIMAL(10, 2))",
+    "unique_products_sold": "COUNT(DISTINCT product_id)",
+}
+
+DATETIME_DIMENSIONS: set[str] = {"day_month_year", "month_year", "quarter_year", "year"}
+
+MANIFEST_NAME = "_manifest.json"
+
+
+def get_snapshot_root() -> Path:
+    return Path(getattr(settings, "ANALYTICS_COLUMNAR_ROOT", Path(settings.BASE_DIR) / "columnar")) / "cart_items"
+
+
+def is_columnar_engine() -> bool:
+    return duckdb is not None and getattr(settings, "ANALYTICS_ENGINE", "postgres") == "duckdb"
+
+
+def read_manifest() -> dict[str, datetime.date] | None:
+    try:
+        manifest = json.loads((get_snapshot_root() / MANIFEST_NAME).read_text())
+    except FileNotFoundError:
+        return None
+    return {key: datetime.date.fromisoformat(value) for key, value in manifest.items()}
+
+
+def _write_manifest(first_day: datetime.date, last_day: datetime.date) -> None:
+    path = get_snapshot_root() / MANIFEST_NAME
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps({"first_day": first_day.isoformat(), "last_day": last_day.isoformat()}))
+    os.replace(tmp_path, path)
+
+
+def _connect():
+    if duckdb is None:
+        raise ImproperlyConfigured("The duckdb analytics engine requires the 'columnar' extra (pip install duckdb).")
+    connection = duckdb.connect()
+    threads = getattr(settings, "ANALYTICS_DUCKDB_THREADS", None)
+    if threads:
+        connection.execute(f"SET threads = {int(threads)}")
+    return connection
+
+
+def export_day(day: datetime.date) -> int:
+    datetime_from, datetime_to = get_datetime_bounds(day, day)
+    rows = CartItem.objects.filter(datetime__gte=datetime_from, datetime__lt=datetime_to).values_list(
+        *SNAPSHOT_COLUMNS.values()
+    )
+    df = pd.DataFrame(list(rows.iterator(chunk_size=10_000)), columns=list(SNAPSHOT_COLUMNS))
+
+    partition = get_snapshot_root() / f"day={day.isoformat()}"
+    path = partition / "part-0.parquet"
+    if df.empty:
+        path.unlink(missing_ok=True)
+        return 0
+
+    df["local_datetime"] = (
+        pd.to_datetime(df["local_datetime"], utc=True).dt.tz_convert(settings.TIME_ZONE).dt.tz_localize(None)
+    )
+    df[["total_price", "margin_price_total", "qty"]] = df[["total_price", "margin_price_total", "qty"]].astype(float)
+
+    partition.mkdir(parents=True, exist_ok=True)
+    tmp_path = partition / "part-0.parquet.tmp"
+    connection = _connect()
+    try:
+        connection.register("snapshot_rows", df)
+        connection.execute(
+            f"""
+            COPY (
+                SELECT
+                    local_datetime, receipt_id, product_id, product_name, brand_name, shop_name,
+                    CAST(total_price AS DECIMAL(18, 5)) AS total_price,
+                    CAST(margin_price_total AS DECIMAL(18, 5)) AS margin_price_total,
+                    CAST(qty AS DECIMAL(18, 4)) AS qty
+                FROM snapshot_rows
+            ) TO '{tmp_path}' (FORMAT parquet)
+            """
+        )
+    finally:
+        connection.close()
+    # Readers only ever see a complete file for a day.
+    os.replace(tmp_path, path)
+    return len(df)
+
+
+def sync_columnar_snapshot(rebuild_from: datetime.date | None = None) -> list[datetime.date]:
+    # Only closed days are exported; a day is never rewritten unless rebuild_from reaches back to it.
+    last_closed_day = timezone.localdate() - datetime.timedelta(days=1)
+    manifest = read_manifest()
+
+    if manifest is None or (rebuild_from is not None and rebuild_from <= manifest["first_day"]):
+        bounds = CartItem.objects.aggregate(first=Min("datetime"), last=Max("datetime"))
+        if bounds["first"] is None:
+            return []
+        first_day = timezone.localtime(bounds["first"]).date()
+        start = first_day
+    else:
+        first_day = manifest["first_day"]
+        start = manifest["last_day"] + datetime.timedelta(days=1)
+        if rebuild_from is not None:
+            start = min(start, rebuild_from)
+
+    get_snapshot_root().mkdir(parents=True, exist_ok=True)
+    exported = []
+    day = start
+    while day <= last_closed_day:
+        export_day(day)
+        exported.append(day)
+        day += datetime.timedelta(days=1)
+
+    if day > start:
+        _write_manifest(first_day, last_closed_day)
+    return exported
+
+
+def can_serve(
+    dimensions: list[str], metrics: list[str], date_to: datetime.date, filter_dimensions: list[str] | None = None
+) -> bool:
+    if not is_columnar_engine() or not metrics:
+        return False
+    if not {*dimensions, *(filter_dimensions or [])} <= DUCKDB_DIMENSION_MAPPING.keys():
+        return False
+    if not set(metrics) <= DUCKDB_METRIC_MAPPING.keys():
+        return False
+    manifest = read_manifest()
+    return manifest is not None and date_to <= manifest["last_day"]
+
+
+def _compile_filters(filters: dict[str, dict[str, Any]]) -> tuple[list[str], list[Any]]:
+    def bound(dimension: str, value: Any) -> Any:
+        # Stored timestamps are naive local time, so date bounds stay naive as well.
+        if dimension in DATETIME_DIMENSIONS:
+            return datetime.datetime.combine(value, datetime.time.min)
+        return value
+
+    conditions, params = [], []
+    for dimension, operators in filters.items():
+        expression = DUCKDB_DIMENSION_MAPPING[dimension]
+        for operator, value in operators.items():
+            if operator in {"in", "not_in"}:
+                placeholders = ", ".join("?" for _ in value)
+                condition = f"{expression} IN ({placeholders})"
+                if operator == "not_in":
+                    condition = f"({expression} NOT IN ({placeholders}) OR {expression} IS NULL)"
+                conditions.append(condition)
+                params += [bound(dimension, v) for v in value]
+            else:
+                conditions.append(f"{expression} {'>=' if operator == 'gte' else '<='} ?")
+                params.append(bound(dimension, value))
+    return conditions, params
+
+
+def get_columnar_dataframe(
+    dimensions: list[str],
+    metrics: list[str],
+    date_from: datetime.date,
+    date_to: datetime.date,
+    as_total: bool,
+    filters: dict[str, dict[str, Any]] | None = None,
+) -> pd.DataFrame:
+    root = get_snapshot_root()
+    if not any(root.glob("day=*/*.parquet")):
+        return pd.DataFrame()
+
+    group_by = [] if as_total else dimensions
+    select = [f"{DUCKDB_DIMENSION_MAPPING[d]} AS {d}" for d in group_by]
+    select += [f"{DUCKDB_METRIC_MAPPING[m]} AS {m}" for m in metrics]
+
+    sql = (
+        f"SELECT {', '.join(select)} "
+        f"FROM read_parquet('{root}/day=*/*.parquet', hive_partitioning = true, hive_types = {{'day': DATE}}) "
+        "WHERE day BETWEEN ? AND ?"
+    )
+    params = [date_from, date_to]
+    if "brand_name" in dimensions:
+        sql += " AND brand_name IS NOT NULL AND brand_name <> ''"
+    conditions, filter_params = _compile_filters(filters or {})
+    for condition in conditions:
+        sql += f" AND {condition}"
+    params += filter_params
+    if group_by:
+        sql += f" GROUP BY {', '.join(str(i + 1) for i in range(len(group_by)))}"
+
+    connection = _connect()
+    try:
+        df = connection.execute(sql, params).fetchdf()
+    finally:
+        connection.close()
+
+    if not group_by and df[metrics].isna().all(axis=1).all():
+        return pd.DataFrame()
+
+    current_timezone = timezone.get_current_timezone()
+    for dimension in DATETIME_DIMENSIONS & set(group_by):
+        df[dimension] = pd.to_datetime(df[dimension]).dt.tz_localize(current_timezone)
+    return df
@@ -0,0 +1,97 @@
+import datetime
+import hashlib
+import json
+import logging
+import uuid
+from typing import Iterable
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpRequest
+from django.utils.http import parse_etags
+from django_redis import get_redis_connection
+from redis import Redis
+from redis.exceptions import RedisError
+
+from .utils import serialize_filters
+
+logger = logging.getLogger(__name__)
+
+DATA_VERSION_KEY = "analytics:data-version"
+# Counter per ISO day, bumped by ingestion for the days a batch touches.
+DAY_VERSIONS_KEY = "analytics:data-versions"
+
+
+def _get_redis() -> Redis | None:
+    try:
+        return get_redis_connection("default")
+    except NotImplementedError:
+        return None
+
+
+def get_data_version(date_from: datetime.date | None = None, date_to: datetime.date | None = None) -> str:
+    # Expires with cached DataFrames, so writes that bypass ingestion are picked up within a TTL too.
+    ttl = getattr(settings, "ANALYTICS_CACHE_TTL", 3600)
+    version = cache.get_or_set(DATA_VERSION_KEY, lambda: uuid.uuid4().hex, timeout=ttl)
+    redis = _get_redis()
+    if date_from is None or redis is None:
+        return version
+
+    try:
+        counters = redis.hgetall(DAY_VERSIONS_KEY)
+    except RedisError:
+        logger.warning("Could not read analytics data versions", exc_info=True)
+        return version
+    # Counters only grow, so their sum over a fixed range changes whenever a day in it does.
+    first, last = date_from.isoformat(), date_to.isoformat()
+    touched = sum(int(value) for day, value in counters.items() if first <= day.decode() <= last)
+    return f"{version}:{touched}"
+
+
+def bump_data_version(days: Iterable[datetime.date] | None = None) -> None:
+    redis = _get_redis()
+    if days is not None and redis is not None:
+        try:
+            pipe = redis.pipeline(transaction=False)
+            for day in set(days):
+                pipe.hincrby(DAY_VERSIONS_KEY, day.isoformat(), 1)
+            pipe.execute()
+            return
+        except RedisError:
+            logger.warning("Could not bump analytics data versions, bumping all of them", exc_info=True)
+
+    cache.set(DATA_VERSION_KEY, uuid.uuid4().hex, timeout=getattr(settings, "ANALYTICS_CACHE_TTL", 3600))
+
+
+def get_analytics_etag(params: dict) -> str:
+    def date_range(value: dict | None) -> list[str] | None:
+        return [value["from_date"].isoformat(), value["to_date"].isoformat()] if value else None
+
+    # Dimension and metric order is kept: it is the column order of the response.
+    payload = {
+        "group_by": params.get("group_by", []),
+        "metrics": params.get("metrics", []),
+        "date_range": date_range(params["date_range"]),
+        "prev_date_range": date_range(params.get("prev_date_range")),
+        "total": params.get("total", False),
+        "approximate": params.get("approximate", False),
+        "filters": serialize_filters(params.get("filters")),
+        "render_type": params.get("render_type", "json"),
+        "chart_type": params.get("chart_type", "Bar Chart"),
+        "chart_format": params.get("chart_format", "html"),
+        "layout": params.get("layout", "records"),
+        "data_version": [
+            get_data_version(value["from_date"], value["to_date"])
+            for value in (params["date_range"], params.get("prev_date_range"))
+            if value
+        ],
+    }
+    return f'"{hashlib.md5(json.dumps(payload, sort_keys=True).encode()).hexdigest()}"'
+
+
+def etag_matches(request: HttpRequest, etag: str) -> bool:
+    header = request.headers.get("If-None-Match")
+    if not header:
+        return False
+    etags = parse_etags(header)
+    return "*" in etags or etag in {e.removeprefix("W/") for e in etags}
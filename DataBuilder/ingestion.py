@@ -0,0 +1,28 @@
+from django.db import transaction
+from django.utils import timezone
+
+from .etags import bump_data_version
+from .intraday import record_intraday_sales
+from .models import CartItem, Receipt
+from .tasks import schedule_cache_warming, schedule_rollup_refresh
+
+
+def ingest_receipts(batch: list[tuple[Receipt, list[CartItem]]]) -> list[Receipt]:
+    with transaction.atomic():
+        receipts = Receipt.objects.bulk_create([receipt for receipt, _ in batch])
+        items = []
+        for receipt, receipt_items in batch:
+            for item in receipt_items:
+                item.receipt = receipt
+                item.datetime = receipt.datetime
+                items.append(item)
+        CartItem.objects.bulk_create(items)
+
+        # Counters must only ever include committed sales.
+        transaction.on_commit(lambda: record_intraday_sales(receipts, items))
+        days = {timezone.localtime(receipt.datetime).date() for receipt in receipts}
+        transaction.on_commit(lambda: bump_data_version(days))
+        transaction.on_commit(schedule_rollup_refresh)
+        transaction.on_commit(schedule_cache_warming)
+
+    return receipts
@@ -0,0 +1,216 @@
+import json
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+from typing import Iterator
+
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+METRICS_KEY_PREFIX = "analytics:metrics"
+
+LATENCY_BUCKETS: tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+KNOWN_RENDER_TYPES: set[str] = {"json", "chart", "excel", "batch"}
+
+
+class Timings:
+    def __init__(self, source: str) -> None:
+        self.source = source
+        self.started = time.perf_counter()
+        self.stages: dict[str, float] = {}
+        self.labels: dict[str, str] = {"render_type": "json", "dimensions": ""}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.rows = 0
+        self._token: Token | None = None
+
+    @property
+    def total(self) -> float:
+        return time.perf_counter() - self.started
+
+    def add(self, stage: str, seconds: float) -> None:
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def set_request(self, render_type: str | None, dimensions: list[str]) -> None:
+        render_type = render_type or "json"
+        self.labels["render_type"] = render_type if render_type in KNOWN_RENDER_TYPES else "other"
+        self.labels["dimensions"] = ",".join(sorted(dimensions))
+
+    def as_server_timing(self) -> str:
+        parts = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in self.stages.items()]
+        if self.cache_hits or self.cache_misses:
+            parts.append(f'cache;desc="hit={self.cache_hits} miss={self.cache_misses}"')
+        parts.append(f'rows;desc="{self.rows}"')
+        parts.append(f"total;dur={self.total * 1000:.1f}")
+        return ", ".join(parts)
+
+
+_current_timings: ContextVar[Timings | None] = ContextVar("analytics_timings", default=None)
+
+
+def get_current_timings() -> Timings | None:
+    return _current_timings.get()
+
+
+def start_timings(source: str) -> Timings:
+    timings = Timings(source)
+    timings._token = _current_timings.set(timings)
+    return timings
+
+
+def finish_timings(timings: Timings) -> None:
+    if timings._token is not None:
+        _current_timings.reset(timings._token)
+        timings._token = None
+    observe_timings(timings)
+
+
+@contextmanager
+def track_analytics(source: str, render_type: str | None, dimensions: list[str]) -> Iterator[Timings]:
+    timings = start_timings(source)
+    timings.set_request(render_type, dimensions)
+    try:
+        yield timings
+    finally:
+        finish_timings(timings)
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    timings = _current_timings.get()
+    if timings is None:
+        yield
+        return
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(stage, time.perf_counter() - started)
+
+
+def record_cache_lookup(hit: bool) -> None:
+    timings = _current_timings.get()
+    if timings is None:
+        return
+    if hit:
+        timings.cache_hits += 1
+    else:
+        timings.cache_misses += 1
+
+
+def record_rows(rows: int) -> None:
+    timings = _current_timings.get()
+    if timings is not None:
+        timings.rows += rows
+
+
+def _labels_key(labels: dict[str, str]) -> str:
+    return json.dumps(labels, sort_keys=True, ensure_ascii=False)
+
+
+def _observe_histogram(pipe, name: str, labels: dict[str, str], value: float) -> None:
+    key = f"{METRICS_KEY_PREFIX}:{name}"
+    labels_key = _labels_key(labels)
+    for bound in LATENCY_BUCKETS:
+        if value <= bound:
+            pipe.hincrby(key, f"{labels_key}\tbucket\t{bound}", 1)
+    pipe.hincrby(key, f"{labels_key}\tbucket\t+Inf", 1)
+    pipe.hincrbyfloat(key, f"{labels_key}\tsum", value)
+    pipe.hincrby(key, f"{labels_key}\tcount", 1)
+
+
+def _increment_counter(pipe, name: str, labels: dict[str, str], value: float) -> None:
+    pipe.hincrbyfloat(f"{METRICS_KEY_PREFIX}:{name}", _labels_key(labels), value)
+
+
+def observe_timings(timings: Timings) -> None:
+    request_labels = {"source": timings.source, **timings.labels}
+    stage_labels = {"source": timings.source, "render_type": timings.labels["render_type"]}
+
+    try:
+        pipe = get_redis_connection("default").pipeline(transaction=False)
+        _observe_histogram(pipe, "analytics_request_duration_seconds", request_labels, timings.total)
+        for stage, seconds in timings.stages.items():
+            _observe_histogram(pipe, "analytics_stage_duration_seconds", {**stage_labels, "stage": stage}, seconds)
+        _increment_counter(
+            pipe, "analytics_cache_lookups_total", {**stage_labels, "result": "hit"}, timings.cache_hits
+        )
+        _increment_counter(
+            pipe, "analytics_cache_lookups_total", {**stage_labels, "result": "miss"}, timings.cache_misses
+        )
+        _increment_counter(pipe, "analytics_result_rows_total", stage_labels, timings.rows)
+        pipe.execute()
+    except RedisError:
+        logger.warning("Could not record analytics metrics", exc_info=True)
+
+
+def observe_queue_wait(task: str, queue: str, seconds: float) -> None:
+    try:
+        pipe = get_redis_connection("default").pipeline(transaction=False)
+        _observe_histogram(pipe, "analytics_task_queue_wait_seconds", {"task": task, "queue": queue}, seconds)
+        pipe.execute()
+    except RedisError:
+        logger.warning("Could not record queue wait of %s", task, exc_info=True)
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    return "{" + ",".join(f'{name}="{_escape_label_value(str(value))}"' for name, value in labels.items()) + "}"
+
+
+def _format_number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+METRIC_TYPES: dict[str, tuple[str, str]] = {
+    "analytics_request_duration_seconds": ("histogram", "End-to-end analytics request latency."),
+    "analytics_stage_duration_seconds": ("histogram", "Latency of individual analytics stages."),
+    "analytics_cache_lookups_total": ("counter", "Analytics dataframe cache lookups."),
+    "analytics_result_rows_total": ("counter", "Rows returned by analytics queries."),
+    "analytics_task_queue_wait_seconds": ("histogram", "Time Celery tasks spent in their queue."),
+}
+
+
+def _render_histogram(name: str, values: dict[str, float]) -> list[str]:
+    series: dict[str, dict[str, float]] = {}
+    for field, value in values.items():
+        labels_key, _, suffix = field.partition("\t")
+        series.setdefault(labels_key, {})[suffix] = value
+
+    lines = []
+    for labels_key in sorted(series):
+        labels = json.loads(labels_key)
+        observed = series[labels_key]
+        for bound in [*map(str, LATENCY_BUCKETS), "+Inf"]:
+            bucket_labels = _format_labels({**labels, "le": bound})
+            bucket_value = observed.get("bucket\t" + bound, 0)
+            lines.append(f"{name}_bucket{bucket_labels} {_format_number(bucket_value)}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {_format_number(observed.get('sum', 0))}")
+        lines.append(f"{name}_count{_format_labels(labels)} {_format_number(observed.get('count', 0))}")
+    return lines
+
+
+def render_prometheus_metrics() -> str:
+    redis = get_redis_connection("default")
+    lines: list[str] = []
+
+    for name, (metric_type, help_text) in METRIC_TYPES.items():
+        values = {k.decode(): float(v) for k, v in redis.hgetall(f"{METRICS_KEY_PREFIX}:{name}").items()}
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+
+        if metric_type == "histogram":
+            lines.extend(_render_histogram(name, values))
+        else:
+            for labels_key in sorted(values):
+                lines.append(f"{name}{_format_labels(json.loads(labels_key))} {_format_number(values[labels_key])}")
+
+    return "\n".join(lines) + "\n"
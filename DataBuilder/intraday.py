@@ -0,0 +1,169 @@
+import datetime
+import logging
+from collections import defaultdict
+
+import pandas as pd
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Sum
+from django.db.models.functions import ExtractHour
+from django.utils import timezone
+from django_redis import get_redis_connection
+from redis import Redis
+from redis.exceptions import RedisError
+
+from .models import CartItem, Receipt, Shop
+from .utils import get_datetime_bounds
+
+logger = logging.getLogger(__name__)
+
+# Running totals per "<shop_id>:<hour>:<metric>" field, one hash per day.
+INTRADAY_METRICS: tuple[str, ...] = ("turnover", "profit", "sales_qty", "checks_count")
+
+# Set when a day's hash was built from Postgres, so counters alone can answer for that day.
+COMPLETE_FIELD = "complete"
+
+SHOP_NAMES_KEY = "analytics:shop-names"
+
+
+def get_intraday_key(day: datetime.date) -> str:
+    return f"analytics:intraday:{day.isoformat()}"
+
+
+def _get_redis() -> Redis | None:
+    try:
+        return get_redis_connection("default")
+    except NotImplementedError:
+        # Only the Redis cache backend keeps live counters, e.g. not the benchmark's DummyCache.
+        return None
+
+
+def _get_intraday_ttl() -> int:
+    return getattr(settings, "ANALYTICS_INTRADAY_TTL", 2 * 24 * 60 * 60)
+
+
+def record_intraday_sales(receipts: list[Receipt], items: list[CartItem]) -> None:
+    totals: dict[tuple[datetime.date, str], float] = defaultdict(float)
+    for item in items:
+        local = timezone.localtime(item.datetime)
+        prefix = f"{item.receipt.shop_id}:{local.hour}"
+        totals[local.date(), f"{prefix}:turnover"] += float(item.total_price)
+        totals[local.date(), f"{prefix}:profit"] += float(item.margin_price_total)
+        totals[local.date(), f"{prefix}:sales_qty"] += float(item.qty)
+    for receipt in receipts:
+        local = timezone.localtime(receipt.datetime)
+        totals[local.date(), f"{receipt.shop_id}:{local.hour}:checks_count"] += 1
+
+    days = {day for day, _ in totals}
+    redis = _get_redis()
+    if redis is None:
+        return
+
+    try:
+        # MULTI/EXEC: a reader never sees a receipt's turnover without its check.
+        pipe = redis.pipeline(transaction=True)
+        for (day, field), value in totals.items():
+            pipe.hincrbyfloat(get_intraday_key(day), field, value)
+        for day in days:
+            pipe.expire(get_intraday_key(day), _get_intraday_ttl())
+        pipe.execute()
+    except RedisError:
+        logger.warning("Could not update intraday counters", exc_info=True)
+        # The counters missed this batch, so Postgres answers for these days until they are rebuilt.
+        try:
+            for day in days:
+                redis.hdel(get_intraday_key(day), COMPLETE_FIELD)
+        except RedisError:
+            pass
+
+
+def rebuild_intraday_counters(day: datetime.date) -> None:
+    # Sales ingested between the query and the RENAME are lost, so this runs when the
+    # day is still empty (right after midnight) or to repair counters after an outage.
+    datetime_from, datetime_to = get_datetime_bounds(day, day)
+    rows = (
+        CartItem.objects.filter(datetime__gte=datetime_from, datetime__lt=datetime_to)
+        .annotate(hour=ExtractHour("datetime"))
+        .values("receipt__shop_id", "hour")
+        .annotate(
+            turnover=Sum("total_price"),
+            profit=Sum("margin_price_total"),
+            sales_qty=Sum("qty"),
+            checks_count=Count("receipt_id", distinct=True),
+        )
+    )
+
+    mapping = {COMPLETE_FIELD: 1}
+    for row in rows:
+        for metric in INTRADAY_METRICS:
+            mapping[f"{row['receipt__shop_id']}:{row['hour']}:{metric}"] = float(row[metric])
+
+    key = get_intraday_key(day)
+    redis = get_redis_connection("default")
+    pipe = redis.pipeline(transaction=True)
+    pipe.delete(f"{key}:rebuild")
+    pipe.hset(f"{key}:rebuild", mapping=mapping)
+    pipe.rename(f"{key}:rebuild", key)
+    pipe.expire(key, _get_intraday_ttl())
+    pipe.execute()
+
+
+def is_intraday_ready(day: datetime.date) -> bool:
+    redis = _get_redis()
+    if redis is None:
+        return False
+
+    try:
+        return bool(redis.hexists(get_intraday_key(day), COMPLETE_FIELD))
+    except RedisError:
+        logger.warning("Could not read intraday counters", exc_info=True)
+        return False
+
+
+def get_shop_names(shop_ids: set[int]) -> dict[int, str]:
+    names = cache.get(SHOP_NAMES_KEY) or {}
+    if not shop_ids <= names.keys():
+        names = dict(Shop.objects.values_list("id", "name"))
+        cache.set(SHOP_NAMES_KEY, names, timeout=10 * 60)
+    return names
+
+
+def _get_time_dimensions(day: datetime.date, hour: int) -> dict[str, object]:
+    quarter = (day.month - 1) // 3 + 1
+
+    def start_of(date: datetime.date) -> pd.Timestamp:
+        return pd.Timestamp(timezone.make_aware(datetime.datetime.combine(date, datetime.time.min)))
+
+    return {
+        "day_month_year": start_of(day),
+        "day_of_week": day.isoweekday() % 7 + 1,
+        "month": day.month,
+        "month_year": start_of(day.replace(day=1)),
+        "quarter": quarter,
+        "quarter_year": start_of(day.replace(month=3 * quarter - 2, day=1)),
+        "year": start_of(day.replace(month=1, day=1)),
+        "hour": hour,
+    }
+
+
+def get_intraday_dataframe(day: datetime.date, dimensions: list[str], metrics: list[str]) -> pd.DataFrame:
+    counters = get_redis_connection("default").hgetall(get_intraday_key(day))
+
+    totals: dict[tuple[int, int], dict[str, float]] = defaultdict(dict)
+    for field, value in counters.items():
+        parts = field.decode().split(":")
+        if len(parts) == 3 and parts[2] in metrics:
+            totals[int(parts[0]), int(parts[1])][parts[2]] = float(value)
+    if not totals:
+        return pd.DataFrame()
+
+    shop_names = get_shop_names({shop_id for shop_id, _ in totals}) if "shop_name" in dimensions else {}
+    rows = []
+    for (shop_id, hour), values in totals.items():
+        row = {d: v for d, v in _get_time_dimensions(day, hour).items() if d in dimensions}
+        if "shop_name" in dimensions:
+            row["shop_name"] = shop_names.get(shop_id)
+        rows.append({**row, **{m: values.get(m, 0.0) for m in metrics}})
+
+    # One row per shop and hour; the caller filters and groups them.
+    return pd.DataFrame(rows, columns=[*dimensions, *metrics])
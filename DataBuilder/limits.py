@@ -0,0 +1,200 @@
+import logging
+import select
+import socket
+import threading
+import time
+import uuid
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+from typing import Iterator
+
+import psycopg
+from django.conf import settings
+from django.db import OperationalError, connections, transaction
+from django.db.backends.base.base import BaseDatabaseWrapper
+from django.http import HttpRequest
+from django_redis import get_redis_connection
+from psycopg.errors import QueryCanceled
+from redis import Redis
+from redis.exceptions import RedisError
+from rest_framework.exceptions import APIException, Throttled
+from rest_framework import status
+
+from .routers import get_analytics_database
+
+logger = logging.getLogger(__name__)
+
+SLOT_POLL_INTERVAL = 0.1
+
+# A slot is a sorted set member scored by its expiry, so a worker that dies mid-query
+# frees its slot after ANALYTICS_QUERY_SLOT_TTL instead of never.
+TAKE_SLOT_SCRIPT = """
+redis.call("ZREMRANGEBYSCORE", KEYS[1], "-inf", ARGV[1])
+if redis.call("ZCARD", KEYS[1]) >= tonumber(ARGV[2]) then
+    return 0
+end
+redis.call("ZADD", KEYS[1], ARGV[3], ARGV[4])
+redis.call("EXPIRE", KEYS[1], ARGV[5])
+return 1
+"""
+
+
+class QueryTimeout(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = "Запит виконувався задовго і був зупинений. Звузьте період або замовте звіт на пошту."
+    default_code = "query_timeout"
+
+
+class ClientClosedRequest(APIException):
+    # nginx's status for a client that went away; nobody is left to read it.
+    status_code = 499
+    default_detail = "З'єднання закрито клієнтом, запит скасовано."
+    default_code = "client_closed_request"
+
+
+class TooManyConcurrentQueries(Throttled):
+    default_detail = "Забагато одночасних запитів аналітики."
+    extra_detail_singular = "Спробуйте ще раз через {wait} секунду."
+    extra_detail_plural = "Спробуйте ще раз через {wait} секунд."
+    default_code = "too_many_concurrent_queries"
+
+
+class RequestLimits:
+    def __init__(self, owner: str, client_socket: socket.socket | None) -> None:
+        self.owner = owner
+        self.client_socket = client_socket
+
+
+_request_limits: ContextVar[RequestLimits | None] = ContextVar("analytics_request_limits", default=None)
+
+
+def get_client_socket(request: HttpRequest) -> socket.socket | None:
+    # gunicorn hands the socket over in the environ; runserver only through its input stream.
+    client_socket = request.META.get("gunicorn.socket")
+    if client_socket is None:
+        client_socket = getattr(getattr(request.META.get("wsgi.input"), "raw", None), "_sock", None)
+    return client_socket if isinstance(client_socket, socket.socket) else None
+
+
+def client_disconnected(client_socket: socket.socket) -> bool:
+    try:
+        readable, _, _ = select.select([client_socket], [], [], 0)
+        # Readable with nothing to read is EOF; a pipelined next request peeks as data and is left alone.
+        return bool(readable) and not client_socket.recv(1, socket.MSG_PEEK)
+    except OSError:
+        return True
+
+
+@contextmanager
+def request_limits(request: HttpRequest) -> Iterator[None]:
+    token = _request_limits.set(RequestLimits(f"user:{request.user.pk}", get_client_socket(request)))
+    try:
+        yield
+    finally:
+        _request_limits.reset(token)
+
+
+def _get_redis() -> Redis | None:
+    try:
+        return get_redis_connection("default")
+    except NotImplementedError:
+        return None
+
+
+def _take_slot(redis: Redis, key: str, slot: str) -> bool:
+    now = time.time()
+    ttl = getattr(settings, "ANALYTICS_QUERY_SLOT_TTL", 120)
+    limit = getattr(settings, "ANALYTICS_MAX_CONCURRENT_QUERIES", 2)
+    return bool(redis.eval(TAKE_SLOT_SCRIPT, 1, key, now, limit, now + ttl, slot, ttl))
+
+
+@contextmanager
+def query_slot(owner: str) -> Iterator[None]:
+    redis = _get_redis()
+    if redis is None:
+        yield
+        return
+
+    key = f"analytics:query-slots:{owner}"
+    slot = uuid.uuid4().hex
+    deadline = time.monotonic() + getattr(settings, "ANALYTICS_QUERY_QUEUE_TIMEOUT", 5)
+    try:
+        # Over the limit a request waits a little for a slot to free up before it is turned away.
+        while not _take_slot(redis, key, slot):
+            if time.monotonic() >= deadline:
+                raise TooManyConcurrentQueries(wait=getattr(settings, "ANALYTICS_QUERY_RETRY_AFTER", 2))
+            time.sleep(SLOT_POLL_INTERVAL)
+    except RedisError:
+        logger.warning("Could not take a query slot for %s", owner, exc_info=True)
+        slot = None
+
+    try:
+        yield
+    finally:
+        if slot is not None:
+            try:
+                redis.zrem(key, slot)
+            except RedisError:
+                logger.warning("Could not release a query slot for %s", owner, exc_info=True)
+
+
+class DisconnectWatcher:
+    def __init__(self, connection: BaseDatabaseWrapper, client_socket: socket.socket) -> None:
+        connection.ensure_connection()
+        self.connection = connection.connection
+        self.client_socket = client_socket
+        self.disconnected = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._watch, name="analytics-disconnect-watcher", daemon=True)
+
+    def __enter__(self) -> "DisconnectWatcher":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _watch(self) -> None:
+        interval = getattr(settings, "ANALYTICS_DISCONNECT_POLL_INTERVAL", 0.5)
+        while not self._stop.wait(interval):
+            if client_disconnected(self.client_socket):
+                self.disconnected = True
+                # A cancel request for the running statement, the same as pg_cancel_backend() from another session.
+                try:
+                    self.connection.cancel_safe()
+                except psycopg.Error:
+                    logger.warning("Could not cancel an abandoned analytics query", exc_info=True)
+                return
+
+
+@contextmanager
+def guarded_queries() -> Iterator[None]:
+    limits = _request_limits.get()
+    alias = get_analytics_database()
+    connection = connections[alias]
+    if limits is not None:
+        timeout = getattr(settings, "ANALYTICS_STATEMENT_TIMEOUT", 30_000)
+    else:
+        timeout = getattr(settings, "ANALYTICS_TASK_STATEMENT_TIMEOUT", None)
+
+    watcher = None
+    try:
+        with ExitStack() as stack:
+            if limits is not None:
+                stack.enter_context(query_slot(limits.owner))
+            if connection.vendor == "postgresql":
+                # SET LOCAL ends with the transaction, so a pooled connection never keeps the timeout.
+                stack.enter_context(transaction.atomic(using=alias))
+                if timeout:
+                    with connection.cursor() as cursor:
+                        cursor.execute("SELECT set_config('statement_timeout', %s, true)", [str(int(timeout))])
+                if limits is not None and limits.client_socket is not None:
+                    watcher = stack.enter_context(DisconnectWatcher(connection, limits.client_socket))
+            yield
+    except OperationalError as exc:
+        if not isinstance(exc.__cause__, QueryCanceled):
+            raise
+        if watcher is not None and watcher.disconnected:
+            raise ClientClosedRequest() from exc
+        raise QueryTimeout() from exc
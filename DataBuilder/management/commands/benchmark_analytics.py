@@ -0,0 +1,168 @@
+import datetime
+import json
+import statistics
+import subprocess
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Max, Min
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from DataBuilder.models import CartItem
+from DataBuilder.services import AnalyticsService, build_excel_report
+
+OPERATIONS = ("dataframe", "comparison", "chart", "excel")
+
+NO_CACHE = {"default": {"BACKEND": "django.core.cache.backends.dummy.DummyCache"}}
+
+
+def current_commit() -> str:
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=settings.BASE_DIR,
+            capture_output=True,
+            text=True,
+        )
+    except OSError:
+        return "unknown"
+    return result.stdout.strip() if result.returncode == 0 else "unknown"
+
+
+class Command(BaseCommand):
+    help = "Time AnalyticsService for every dimension x metric combination and compare with an earlier run."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--from-date", type=datetime.date.fromisoformat, default=None)
+        parser.add_argument("--to-date", type=datetime.date.fromisoformat, default=None)
+        parser.add_argument("--dimensions", nargs="*", default=None, help="Limit to these DIMENSION_MAPPING keys.")
+        parser.add_argument("--metrics", nargs="*", default=None, help="Limit to these METRIC_MAPPING keys.")
+        parser.add_argument("--operations", nargs="*", choices=OPERATIONS, default=list(OPERATIONS))
+        parser.add_argument("--repeat", type=int, default=3)
+        parser.add_argument("--output-dir", type=Path, default=Path(settings.BASE_DIR) / "benchmarks")
+        parser.add_argument("--compare", type=Path, default=None, help="Earlier result file, defaults to the latest.")
+        parser.add_argument("--threshold", type=float, default=10.0, help="Regression threshold in percent.")
+
+    def handle(self, *args, **options):
+        date_from, date_to = self._get_date_range(options)
+        prev_to = date_from - datetime.timedelta(days=1)
+        prev_from = prev_to - (date_to - date_from)
+        current_range = {"from_date": date_from, "to_date": date_to}
+        prev_range = {"from_date": prev_from, "to_date": prev_to}
+
+        dimensions = options["dimensions"] or [None, *AnalyticsService.DIMENSION_MAPPING]
+        metrics = options["metrics"] or list(AnalyticsService.METRIC_MAPPING)
+        unknown = set(metrics) - AnalyticsService.METRIC_MAPPING.keys()
+        unknown |= {d for d in dimensions if d is not None} - AnalyticsService.DIMENSION_MAPPING.keys()
+        if unknown:
+            raise CommandError(f"Unknown dimensions or metrics: {', '.join(sorted(unknown))}")
+
+        results = []
+        with override_settings(CACHES=NO_CACHE):
+            for dimension in dimensions:
+                group_by = [dimension] if dimension else []
+                for metric in metrics:
+                    service = AnalyticsService(dimensions=group_by, metrics=[metric, f"{metric}_diff"])
+                    for operation in options["operations"]:
+                        timings = self._time_operation(
+                            service, operation, current_range, prev_range, options["repeat"]
+                        )
+                        results.append(
+                            {
+                                "dimension": dimension or "__total__",
+                                "metric": metric,
+                                "operation": operation,
+                                "median_ms": round(statistics.median(timings), 3),
+                                "min_ms": round(min(timings), 3),
+                            }
+                        )
+                        self.stdout.write(f"{dimension or '__total__'} x {metric} {operation}: {min(timings):.1f} ms")
+
+        run = {
+            "commit": current_commit(),
+            "created_at": timezone.now().isoformat(),
+            "database": connection.vendor,
+            "cart_items": CartItem.objects.count(),
+            "date_range": [date_from.isoformat(), date_to.isoformat()],
+            "results": results,
+        }
+
+        baseline_path = options["compare"] or self._latest_result(options["output_dir"])
+        output_path = self._save(run, options["output_dir"])
+        self.stdout.write(self.style.SUCCESS(f"Saved {len(results)} timings to {output_path}"))
+
+        if baseline_path is not None:
+            self._compare(run, json.loads(baseline_path.read_text()), options["threshold"])
+
+    def _get_date_range(self, options) -> tuple[datetime.date, datetime.date]:
+        if options["from_date"] and options["to_date"]:
+            return options["from_date"], options["to_date"]
+
+        bounds = CartItem.objects.aggregate(first=Min("datetime"), last=Max("datetime"))
+        if bounds["first"] is None:
+            raise CommandError("No CartItem rows found, run generate_sales first.")
+
+        return (
+            options["from_date"] or timezone.localtime(bounds["first"]).date(),
+            options["to_date"] or timezone.localtime(bounds["last"]).date(),
+        )
+
+    @staticmethod
+    def _time_operation(service, operation, current_range, prev_range, repeat) -> list[float]:
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            if operation == "dataframe":
+                service.get_dataframe(current_range["from_date"], current_range["to_date"])
+            elif operation == "comparison":
+                service.get_comparison_dataframe(current_range, prev_range)
+            else:
+                df = service.get_dataframe(current_range["from_date"], current_range["to_date"])
+                started = time.perf_counter()
+                if operation == "chart":
+                    service.generate_plotly_chart(df, "Bar Chart")
+                else:
+                    build_excel_report(df)
+            timings.append((time.perf_counter() - started) * 1000)
+        return timings
+
+    @staticmethod
+    def _latest_result(output_dir: Path) -> Path | None:
+        files = sorted(output_dir.glob("*.json")) if output_dir.exists() else []
+        return files[-1] if files else None
+
+    @staticmethod
+    def _save(run: dict, output_dir: Path) -> Path:
+        output_dir.mkdir(parents=True, exist_ok=True)
+        stamp = timezone.now().strftime("%Y%m%dT%H%M%S")
+        output_path = output_dir / f"{stamp}-{run['commit']}.json"
+        output_path.write_text(json.dumps(run, indent=2, ensure_ascii=False))
+        return output_path
+
+    def _compare(self, run: dict, baseline: dict, threshold: float) -> None:
+        previous = {(r["dimension"], r["metric"], r["operation"]): r["min_ms"] for r in baseline["results"]}
+        self.stdout.write(f"Compared with {baseline['commit']} ({baseline['created_at']}):")
+
+        regressions = 0
+        for result in run["results"]:
+            before = previous.get((result["dimension"], result["metric"], result["operation"]))
+            if not before:
+                continue
+            change = (result["min_ms"] - before) / before * 100
+            if change > threshold:
+                regressions += 1
+                self.stdout.write(
+                    self.style.WARNING(
+                        f"{result['dimension']} x {result['metric']} {result['operation']}: "
+                        f"{before:.1f} -> {result['min_ms']:.1f} ms ({change:+.0f}%)"
+                    )
+                )
+
+        if regressions:
+            self.stdout.write(self.style.WARNING(f"{regressions} timings regressed by more than {threshold:.0f}%"))
+        else:
+            self.stdout.write(self.style.SUCCESS("No regressions above the threshold"))
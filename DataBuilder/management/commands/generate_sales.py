@@ -0,0 +1,171 @@
+import datetime
+from decimal import Decimal
+
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from DataBuilder.etags import bump_data_version
+from DataBuilder.intraday import is_intraday_ready, rebuild_intraday_counters
+from DataBuilder.models import Brand, CartItem, Product, Receipt, Shop
+from DataBuilder.rollups import get_rollup_config, refresh_rollup
+
+# Share of receipts per hour of day: closed at night, lunch and evening peaks.
+HOUR_WEIGHTS = np.array(
+    [0, 0, 0, 0, 0, 0, 0.2, 0.6, 1.5, 2.5, 3.5, 4.5, 5.5, 5.0, 4.5, 4.5, 5.0, 6.5, 7.5, 7.0, 5.5, 3.5, 1.5, 0.5]
+)
+
+
+def zipf_weights(size: int, exponent: float) -> np.ndarray:
+    weights = 1.0 / np.arange(1, size + 1) ** exponent
+    return weights / weights.sum()
+
+
+class Command(BaseCommand):
+    help = "Generate seeded, skewed synthetic sales (shops, brands, products, receipts and cart items)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--items", type=int, default=1_000_000, help="Number of CartItem rows to create.")
+        parser.add_argument("--shops", type=int, default=50)
+        parser.add_argument("--brands", type=int, default=300)
+        parser.add_argument("--products", type=int, default=10_000)
+        parser.add_argument("--days", type=int, default=365, help="Length of the generated period.")
+        parser.add_argument("--end-date", type=datetime.date.fromisoformat, default=None)
+        parser.add_argument("--skew", type=float, default=1.1, help="Zipf exponent for shop/product popularity.")
+        parser.add_argument("--seed", type=int, default=42)
+        parser.add_argument("--batch-size", type=int, default=20_000)
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(options["seed"])
+        end_date = options["end_date"] or timezone.localdate()
+        start = timezone.make_aware(
+            datetime.datetime.combine(end_date - datetime.timedelta(days=options["days"] - 1), datetime.time.min)
+        )
+
+        shops, products, product_prices = self._create_catalog(rng, options)
+        shop_weights = zipf_weights(len(shops), options["skew"])
+        product_weights = zipf_weights(len(products), options["skew"])
+        hour_weights = HOUR_WEIGHTS / HOUR_WEIGHTS.sum()
+        # Later days sell a bit more, so month-over-month comparisons are not flat.
+        day_weights = np.linspace(0.8, 1.2, options["days"])
+        day_weights /= day_weights.sum()
+
+        created = 0
+        while created < options["items"]:
+            batch_items = min(options["batch_size"], options["items"] - created)
+            created += self._create_batch(
+                rng,
+                batch_items,
+                start,
+                shops,
+                products,
+                product_prices,
+                shop_weights,
+                product_weights,
+                day_weights,
+                hour_weights,
+            )
+            self.stdout.write(f"{created}/{options['items']} cart items")
+
+        # Bulk inserts bypass ingestion, so live counters for today are recounted from the new rows.
+        if end_date == timezone.localdate() and is_intraday_ready(end_date):
+            rebuild_intraday_counters(end_date)
+        # Generated history spans the whole range, so the rollups are rebuilt from scratch in one go.
+        for name in get_rollup_config():
+            refresh_rollup(name, full=True)
+        bump_data_version()
+
+        self.stdout.write(self.style.SUCCESS(f"Generated {created} cart items"))
+
+    def _create_catalog(self, rng: np.random.Generator, options: dict):
+        shops = Shop.objects.bulk_create([Shop(name=f"Магазин {i + 1}") for i in range(options["shops"])])
+        brands = Brand.objects.bulk_create([Brand(name=f"Бренд {i + 1}") for i in range(options["brands"])])
+
+        # Roughly 5% of products have no brand, like unbranded goods in real data.
+        brand_indexes = rng.choice(len(brands), size=options["products"], p=zipf_weights(len(brands), 0.8))
+        no_brand = rng.random(options["products"]) < 0.05
+        products = Product.objects.bulk_create(
+            [
+                Product(name=f"Товар {i + 1}", brand=None if no_brand[i] else brands[brand_indexes[i]])
+                for i in range(options["products"])
+            ],
+            batch_size=options["batch_size"],
+        )
+        product_prices = np.round(rng.lognormal(mean=4.0, sigma=0.9, size=len(products)), 2) + 1
+        return shops, products, product_prices
+
+    @transaction.atomic
+    def _create_batch(
+        self,
+        rng: np.random.Generator,
+        batch_items: int,
+        start: datetime.datetime,
+        shops: list[Shop],
+        products: list[Product],
+        product_prices: np.ndarray,
+        shop_weights: np.ndarray,
+        product_weights: np.ndarray,
+        day_weights: np.ndarray,
+        hour_weights: np.ndarray,
+    ) -> int:
+        receipt_sizes = rng.geometric(p=0.35, size=batch_items)
+        receipt_sizes = receipt_sizes[np.cumsum(receipt_sizes) <= batch_items]
+        if receipt_sizes.sum() < batch_items:
+            receipt_sizes = np.append(receipt_sizes, batch_items - receipt_sizes.sum())
+
+        receipts_count = len(receipt_sizes)
+        days = rng.choice(len(day_weights), size=receipts_count, p=day_weights)
+        hours = rng.choice(24, size=receipts_count, p=hour_weights)
+        seconds = rng.integers(0, 3600, size=receipts_count)
+        receipt_shops = rng.choice(len(shops), size=receipts_count, p=shop_weights)
+        refunds = rng.random(receipts_count) < 0.01
+
+        item_products = rng.choice(len(products), size=batch_items, p=product_weights)
+        item_qty = rng.choice([1, 1, 1, 2, 2, 3, 5], size=batch_items)
+        discounts = np.where(rng.random(batch_items) < 0.2, rng.uniform(0.05, 0.3, size=batch_items), 0)
+        margins = rng.uniform(0.1, 0.35, size=batch_items)
+
+        receipt_datetimes = [
+            start + datetime.timedelta(days=int(day), hours=int(hour), seconds=int(second))
+            for day, hour, second in zip(days, hours, seconds)
+        ]
+        receipt_indexes = np.repeat(np.arange(receipts_count), receipt_sizes)
+
+        original_prices = product_prices[item_products]
+        prices = np.round(original_prices * (1 - discounts), 2)
+        totals = np.round(prices * item_qty, 2)
+        margin_totals = np.round(totals * margins, 2)
+
+        receipt_totals = np.bincount(receipt_indexes, weights=totals, minlength=receipts_count)
+        receipt_margins = np.bincount(receipt_indexes, weights=margin_totals, minlength=receipts_count)
+
+        receipts = Receipt.objects.bulk_create(
+            [
+                Receipt(
+                    datetime=receipt_datetimes[i],
+                    shop=shops[receipt_shops[i]],
+                    total_price=Decimal(f"{receipt_totals[i]:.2f}"),
+                    margin_price_total=Decimal(f"{receipt_margins[i]:.2f}"),
+                    refund=bool(refunds[i]),
+                )
+                for i in range(receipts_count)
+            ]
+        )
+
+        CartItem.objects.bulk_create(
+            [
+                CartItem(
+                    receipt=receipts[receipt_indexes[i]],
+                    product=products[item_products[i]],
+                    price=Decimal(f"{prices[i]:.2f}"),
+                    original_price=Decimal(f"{original_prices[i]:.2f}"),
+                    qty=Decimal(int(item_qty[i])),
+                    total_price=Decimal(f"{totals[i]:.2f}"),
+                    margin_price_total=Decimal(f"{margin_totals[i]:.2f}"),
+                    datetime=receipt_datetimes[receipt_indexes[i]],
+                )
+                for i in range(batch_items)
+            ]
+        )
+        return batch_items
@@ -0,0 +1,24 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+
+from DataBuilder.columnar import get_snapshot_root, sync_columnar_snapshot
+
+
+class Command(BaseCommand):
+    help = "Export closed days of cart items to the Parquet snapshot read by the duckdb analytics engine."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--rebuild-from",
+            type=datetime.date.fromisoformat,
+            default=None,
+            help="Re-export every day from this date on, e.g. after late data was loaded.",
+        )
+
+    def handle(self, *args, **options):
+        days = sync_columnar_snapshot(rebuild_from=options["rebuild_from"])
+        if days:
+            self.stdout.write(self.style.SUCCESS(f"Exported {days[0]}..{days[-1]} to {get_snapshot_root()}"))
+        else:
+            self.stdout.write("Snapshot is up to date")
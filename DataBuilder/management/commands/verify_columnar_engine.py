@@ -0,0 +1,66 @@
+import datetime
+
+import pandas as pd
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from DataBuilder.columnar import DUCKDB_DIMENSION_MAPPING, DUCKDB_METRIC_MAPPING, read_manifest
+from DataBuilder.services import AnalyticsService
+
+NO_CACHE = {"default": {"BACKEND": "django.core.cache.backends.dummy.DummyCache"}}
+
+
+class Command(BaseCommand):
+    help = "Compare duckdb engine results with the ORM for every dimension x metric over the snapshot."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--from-date", type=datetime.date.fromisoformat, default=None)
+        parser.add_argument("--to-date", type=datetime.date.fromisoformat, default=None)
+        parser.add_argument("--tolerance", type=float, default=0.01, help="Allowed absolute difference.")
+
+    def handle(self, *args, **options):
+        manifest = read_manifest()
+        if manifest is None:
+            raise CommandError("No columnar snapshot found, run sync_columnar_snapshot first.")
+        date_from = options["from_date"] or manifest["first_day"]
+        date_to = options["to_date"] or manifest["last_day"]
+
+        mismatches = checked = 0
+        for dimension in [None, *DUCKDB_DIMENSION_MAPPING]:
+            group_by = [dimension] if dimension else []
+            for metric in DUCKDB_METRIC_MAPPING:
+                service = AnalyticsService(dimensions=group_by, metrics=[metric])
+                with override_settings(CACHES=NO_CACHE, ANALYTICS_ENGINE="duckdb"):
+                    if not service.uses_columnar(date_to):
+                        raise CommandError("The duckdb engine cannot serve this range, check the snapshot.")
+                    columnar = service.get_dataframe(date_from, date_to)
+                with override_settings(CACHES=NO_CACHE, ANALYTICS_ENGINE="postgres"):
+                    orm = service.get_dataframe(date_from, date_to)
+
+                checked += 1
+                error = self._compare(columnar, orm, group_by, metric, options["tolerance"])
+                if error:
+                    mismatches += 1
+                    self.stdout.write(self.style.WARNING(f"{dimension or '__total__'} x {metric}: {error}"))
+
+        if mismatches:
+            raise CommandError(f"{mismatches} of {checked} results differ from the ORM")
+        self.stdout.write(self.style.SUCCESS(f"All {checked} results match the ORM for {date_from}..{date_to}"))
+
+    @staticmethod
+    def _compare(columnar: pd.DataFrame, orm: pd.DataFrame, group_by: list[str], metric: str, tolerance: float):
+        if columnar.empty or orm.empty:
+            return None if columnar.empty and orm.empty else f"{len(columnar)} rows vs {len(orm)} from the ORM"
+
+        if group_by:
+            merged = columnar.merge(orm, on=group_by, how="outer", suffixes=("", "_orm"), indicator=True)
+            unmatched = int((merged["_merge"] != "both").sum())
+            if unmatched:
+                return f"{unmatched} groups exist on one side only"
+        else:
+            merged = columnar.join(orm, rsuffix="_orm")
+
+        difference = (merged[metric].astype(float) - merged[f"{metric}_orm"].astype(float)).abs().max()
+        if difference > tolerance:
+            return f"values differ by up to {difference}"
+        return None
@@ -0,0 +1,73 @@
+from itertools import islice
+from typing import Iterable
+
+import pandas as pd
+from django.conf import settings
+from pandas.api.types import (
+    is_float_dtype,
+    is_integer_dtype,
+    is_object_dtype,
+    is_string_dtype,
+    union_categoricals,
+)
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+CHUNK_SIZE = 10_000
+
+
+class MemoryBudgetExceeded(APIException):
+    status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
+    default_detail = "Результат запиту завеликий. Звузьте період, зменште кількість вимірів або додайте фільтри."
+    default_code = "memory_budget_exceeded"
+
+
+class MemoryBudget:
+    def __init__(self, limit: int | None = None) -> None:
+        self.limit = limit if limit is not None else getattr(settings, "ANALYTICS_MEMORY_BUDGET", 512 * 1024 * 1024)
+        self.used = 0
+
+    def charge(self, df: pd.DataFrame) -> None:
+        self.used += int(df.memory_usage(deep=True).sum())
+        if self.used > self.limit:
+            raise MemoryBudgetExceeded()
+
+
+def compact_dataframe(df: pd.DataFrame, metrics: list[str]) -> pd.DataFrame:
+    for column in df.columns:
+        values = df[column]
+        # Metrics stay float64, so diffs and rounded percentages are computed exactly.
+        if column in metrics:
+            if not is_float_dtype(values):
+                df[column] = values.astype(float)
+        elif is_object_dtype(values) or is_string_dtype(values):
+            df[column] = values.astype("category")
+        elif is_integer_dtype(values):
+            df[column] = pd.to_numeric(values, downcast="integer")
+    return df
+
+
+def concat_compact(chunks: list[pd.DataFrame]) -> pd.DataFrame:
+    if len(chunks) == 1:
+        return chunks[0]
+
+    # Chunks see different values, so categories are unified first to keep the result categorical.
+    for column in chunks[0].select_dtypes("category").columns:
+        categories = union_categoricals([chunk[column] for chunk in chunks]).categories
+        for chunk in chunks:
+            chunk[column] = chunk[column].cat.set_categories(categories)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def read_dataframe(rows: Iterable[dict], metrics: list[str], budget: MemoryBudget) -> pd.DataFrame:
+    rows = iter(rows)
+    chunks = []
+    while batch := list(islice(rows, CHUNK_SIZE)):
+        chunk = compact_dataframe(pd.DataFrame(batch), metrics)
+        # Fail before the next chunk is fetched rather than after the whole result is in memory.
+        budget.charge(chunk)
+        chunks.append(chunk)
+
+    if not chunks:
+        return pd.DataFrame()
+    return concat_compact(chunks)
@@ -0,0 +1,56 @@
+# Generated by Django 6.0.1 on 2026-10-19 09:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("DataBuilder", "0005_remove_cartitem_databuilder_datetim_5e6d9d_idx_and_more"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RollupRefresh",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("name", models.CharField(max_length=50)),
+                ("refreshed_at", models.DateTimeField()),
+                ("duration", models.DurationField()),
+                ("rows", models.BigIntegerField()),
+                ("source_max_datetime", models.DateTimeField(null=True)),
+            ],
+            options={
+                "indexes": [models.Index(fields=["name", "-refreshed_at"], name="DataBuilder_name_3a050d_idx")],
+            },
+        ),
+        migrations.CreateModel(
+            name="SalesRollup",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("name", models.CharField(max_length=50)),
+                ("datetime", models.DateTimeField()),
+                ("total_price", models.DecimalField(decimal_places=5, max_digits=18)),
+                ("margin_price_total", models.DecimalField(decimal_places=5, max_digits=18)),
+                ("qty", models.DecimalField(decimal_places=4, max_digits=18)),
+                ("receipts_count", models.BigIntegerField()),
+                (
+                    "brand",
+                    models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to="DataBuilder.brand"),
+                ),
+                (
+                    "product",
+                    models.ForeignKey(
+                        null=True, on_delete=django.db.models.deletion.CASCADE, to="DataBuilder.product"
+                    ),
+                ),
+                (
+                    "shop",
+                    models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to="DataBuilder.shop"),
+                ),
+            ],
+            options={
+                "indexes": [models.Index(fields=["name", "datetime"], name="DataBuilder_name_6db133_idx")],
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 6.0.1 on 2026-10-19 11:40
+
+import django.core.serializers.json
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("DataBuilder", "0006_salesrollup_rolluprefresh"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="AnalyticsProfile",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("request_data", models.JSONField(encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                ("duration_ms", models.FloatField()),
+                ("report", models.JSONField(encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                (
+                    "user",
+                    models.ForeignKey(
+                        null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL
+                    ),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 6.0.1 on 2026-10-19 11:20
+
+import DataBuilder.models
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("DataBuilder", "0007_analyticsprofile"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ReportArtifact",
+            fields=[
+                ("id", models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("expires_at", models.DateTimeField()),
+                (
+                    "file",
+                    models.FileField(storage=DataBuilder.models.get_reports_storage, upload_to="reports/%Y/%m/%d"),
+                ),
+                ("filename", models.CharField(max_length=255)),
+                ("content_type", models.CharField(max_length=100)),
+                ("content_encoding", models.CharField(blank=True, max_length=20)),
+                ("size", models.BigIntegerField()),
+            ],
+            options={
+                "indexes": [models.Index(fields=["expires_at"], name="DataBuilder_expires_944743_idx")],
+            },
+        ),
+    ]
@@ -0,0 +1,87 @@
+# Generated by Django 6.0.1 on 2026-10-19 13:10
+
+import django.contrib.postgres.indexes
+import django.db.models.functions.datetime
+from django.contrib.postgres.indexes import BrinIndex
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class AddIndexConcurrentlyOnPostgres(AddIndexConcurrently):
+    # DB_ENGINE=sqlite (local benchmarks) builds plain indexes and has no BRIN at all.
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == "postgresql":
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+        elif not isinstance(self.index, BrinIndex):
+            migrations.AddIndex.database_forwards(self, app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == "postgresql":
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+        elif not isinstance(self.index, BrinIndex):
+            migrations.AddIndex.database_backwards(self, app_label, schema_editor, from_state, to_state)
+
+
+class Migration(migrations.Migration):
+    # Adding stored columns rewrites the table; the indexes are built afterwards without blocking writes.
+    atomic = False
+
+    dependencies = [
+        ("DataBuilder", "0009_catalog_name_trigram_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="cartitem",
+            name="sale_day",
+            field=models.GeneratedField(
+                db_persist=True,
+                expression=django.db.models.functions.datetime.TruncDate("datetime"),
+                output_field=models.DateField(),
+            ),
+        ),
+        migrations.AddField(
+            model_name="cartitem",
+            name="sale_hour",
+            field=models.GeneratedField(
+                db_persist=True,
+                expression=django.db.models.functions.datetime.ExtractHour("datetime"),
+                output_field=models.SmallIntegerField(),
+            ),
+        ),
+        migrations.AddField(
+            model_name="cartitem",
+            name="sale_month",
+            field=models.GeneratedField(
+                db_persist=True,
+                expression=django.db.models.functions.datetime.ExtractMonth("datetime"),
+                output_field=models.SmallIntegerField(),
+            ),
+        ),
+        migrations.AddField(
+            model_name="cartitem",
+            name="sale_quarter",
+            field=models.GeneratedField(
+                db_persist=True,
+                expression=django.db.models.functions.datetime.ExtractQuarter("datetime"),
+                output_field=models.SmallIntegerField(),
+            ),
+        ),
+        migrations.AddField(
+            model_name="cartitem",
+            name="sale_weekday",
+            field=models.GeneratedField(
+                db_persist=True,
+                expression=django.db.models.functions.datetime.ExtractWeekDay("datetime"),
+                output_field=models.SmallIntegerField(),
+            ),
+        ),
+        AddIndexConcurrentlyOnPostgres(
+            model_name="cartitem",
+            index=django.contrib.postgres.indexes.BrinIndex(fields=["datetime"], name="cartitem_datetime_brin"),
+        ),
+        AddIndexConcurrentlyOnPostgres(
+            model_name="cartitem",
+            index=models.Index(fields=["sale_day", "sale_hour"], name="cartitem_sale_day_hour"),
+        ),
+    ]
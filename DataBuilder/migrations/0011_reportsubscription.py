@@ -0,0 +1,44 @@
+# Generated by Django 6.0.1 on 2026-10-19 14:20
+
+import django.core.serializers.json
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("DataBuilder", "0010_cartitem_sale_buckets"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ReportSubscription",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("name", models.CharField(max_length=255)),
+                ("request_data", models.JSONField(encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                ("compare_previous", models.BooleanField(default=False)),
+                (
+                    "render_type",
+                    models.CharField(
+                        choices=[("excel", "Excel"), ("chart", "Графік")], default="excel", max_length=10
+                    ),
+                ),
+                (
+                    "frequency",
+                    models.CharField(
+                        choices=[("daily", "Щодня"), ("weekly", "Щотижня"), ("monthly", "Щомісяця")],
+                        default="monthly",
+                        max_length=10,
+                    ),
+                ),
+                ("recipients", models.JSONField(default=list)),
+                ("is_active", models.BooleanField(default=True)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("last_period_start", models.DateField(blank=True, null=True)),
+                ("owner", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
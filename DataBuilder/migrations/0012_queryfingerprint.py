@@ -0,0 +1,28 @@
+# Generated by Django 6.0.1 on 2026-10-19 16:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("DataBuilder", "0011_reportsubscription"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="QueryFingerprint",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("fingerprint", models.CharField(max_length=32, unique=True)),
+                ("query", models.TextField()),
+                ("calls", models.BigIntegerField(default=0)),
+                ("total_ms", models.FloatField(default=0)),
+                ("rows", models.BigIntegerField(default=0)),
+                ("duration_buckets", models.JSONField(default=dict)),
+                ("p50_ms", models.FloatField(default=0)),
+                ("p95_ms", models.FloatField(default=0)),
+                ("first_seen", models.DateTimeField(auto_now_add=True)),
+                ("last_seen", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
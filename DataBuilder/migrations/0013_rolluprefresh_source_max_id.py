@@ -0,0 +1,17 @@
+# Generated by Django 6.0.1 on 2026-10-19 17:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("DataBuilder", "0012_queryfingerprint"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="rolluprefresh",
+            name="source_max_id",
+            field=models.BigIntegerField(null=True),
+        ),
+    ]
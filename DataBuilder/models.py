@@ -1,9 +1,20 @@
+import uuid
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.files.storage import storages
+from django.contrib.postgres.indexes import BrinIndex, GinIndex, OpClass
 from django.db import models
+from django.db.models.functions import ExtractHour, ExtractMonth, ExtractQuarter, ExtractWeekDay, TruncDate, Upper
+from django.utils import timezone
 
 
 class Brand(models.Model):
     name = models.CharField(max_length=100)
 
+    class Meta:
+        indexes = [GinIndex(OpClass(Upper("name"), name="gin_trgm_ops"), name="brand_name_trgm")]
+
     def __str__(self):
         return self.name
 
@@ -12,6 +23,9 @@ class Product(models.Model):
     name = models.CharField(max_length=100)
     brand = models.ForeignKey(Brand, on_delete=models.CASCADE, null=True)
 
+    class Meta:
+        indexes = [GinIndex(OpClass(Upper("name"), name="gin_trgm_ops"), name="product_name_trgm")]
+
     def __str__(self):
         return self.name
 
@@ -19,6 +33,9 @@ class Product(models.Model):
 class Shop(models.Model):
     name = models.CharField(max_length=100)
 
+    class Meta:
+        indexes = [GinIndex(OpClass(Upper("name"), name="gin_trgm_ops"), name="shop_name_trgm")]
+
     def __str__(self):
         return self.name
 
@@ -34,6 +51,11 @@ class Receipt(models.Model):
         return f"Чек #{self.id}"
 
 
+# The sale_* buckets are computed in the TIME_ZONE active when the migration ran, which is this one.
+# Analytics only reads them while TIME_ZONE still matches; moving it needs a migration rewriting the table.
+SALE_BUCKETS_TIME_ZONE = "UTC"
+
+
 class CartItem(models.Model):
     receipt = models.ForeignKey(Receipt, on_delete=models.CASCADE)
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
@@ -44,5 +66,154 @@ class CartItem(models.Model):
     margin_price_total = models.DecimalField(max_digits=10, decimal_places=5)
     datetime = models.DateTimeField()
 
+    sale_day = models.GeneratedField(
+        expression=TruncDate("datetime"), output_field=models.DateField(), db_persist=True
+    )
+    sale_hour = models.GeneratedField(
+        expression=ExtractHour("datetime"),
+        output_field=models.SmallIntegerField(),
+        db_persist=True,
+    )
+    sale_weekday = models.GeneratedField(
+        expression=ExtractWeekDay("datetime"),
+        output_field=models.SmallIntegerField(),
+        db_persist=True,
+    )
+    sale_month = models.GeneratedField(
+        expression=ExtractMonth("datetime"),
+        output_field=models.SmallIntegerField(),
+        db_persist=True,
+    )
+    sale_quarter = models.GeneratedField(
+        expression=ExtractQuarter("datetime"),
+        output_field=models.SmallIntegerField(),
+        db_persist=True,
+    )
+
+    class Meta:
+        indexes = [
+            # Cart items arrive in time order, so block ranges stay tight and the index stays tiny.
+            BrinIndex(fields=["datetime"], name="cartitem_datetime_brin"),
+            models.Index(fields=["sale_day", "sale_hour"], name="cartitem_sale_day_hour"),
+        ]
+
     def __str__(self):
         return f"{self.product.name} ({self.qty} шт.)"
+
+
+class SalesRollup(models.Model):
+    name = models.CharField(max_length=50)
+    datetime = models.DateTimeField()
+    shop = models.ForeignKey(Shop, on_delete=models.CASCADE, null=True)
+    brand = models.ForeignKey(Brand, on_delete=models.CASCADE, null=True)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, null=True)
+    total_price = models.DecimalField(max_digits=18, decimal_places=5)
+    margin_price_total = models.DecimalField(max_digits=18, decimal_places=5)
+    qty = models.DecimalField(max_digits=18, decimal_places=4)
+    receipts_count = models.BigIntegerField()
+
+    class Meta:
+        indexes = [models.Index(fields=["name", "datetime"])]
+
+    def __str__(self):
+        return f"{self.name} @ {self.datetime:%Y-%m-%d %H:%M}"
+
+
+class RollupRefresh(models.Model):
+    name = models.CharField(max_length=50)
+    refreshed_at = models.DateTimeField()
+    duration = models.DurationField()
+    rows = models.BigIntegerField()
+    source_max_datetime = models.DateTimeField(null=True)
+    # Highest CartItem id seen, so the next refresh knows which items are new.
+    source_max_id = models.BigIntegerField(null=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["name", "-refreshed_at"])]
+
+    def __str__(self):
+        return f"{self.name} ({self.refreshed_at:%Y-%m-%d %H:%M})"
+
+    @property
+    def age(self):
+        return timezone.now() - self.refreshed_at
+
+
+class AnalyticsProfile(models.Model):
+    created_at = models.DateTimeField(auto_now_add=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True)
+    request_data = models.JSONField(encoder=DjangoJSONEncoder)
+    duration_ms = models.FloatField()
+    report = models.JSONField(encoder=DjangoJSONEncoder)
+
+    def __str__(self):
+        return f"Профіль #{self.id} ({self.duration_ms:.0f} мс)"
+
+
+def get_reports_storage():
+    return storages["reports"]
+
+
+class ReportArtifact(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField()
+    file = models.FileField(storage=get_reports_storage, upload_to="reports/%Y/%m/%d")
+    filename = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100)
+    content_encoding = models.CharField(max_length=20, blank=True)
+    size = models.BigIntegerField()
+
+    class Meta:
+        indexes = [models.Index(fields=["expires_at"])]
+
+    def __str__(self):
+        return f"{self.filename} ({self.created_at:%Y-%m-%d %H:%M})"
+
+
+class ReportSubscription(models.Model):
+    class Frequency(models.TextChoices):
+        DAILY = "daily", "Щодня"
+        WEEKLY = "weekly", "Щотижня"
+        MONTHLY = "monthly", "Щомісяця"
+
+    class RenderType(models.TextChoices):
+        EXCEL = "excel", "Excel"
+        CHART = "chart", "Графік"
+
+    name = models.CharField(max_length=255)
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    # An analytics request without date ranges; each run covers the last complete period.
+    request_data = models.JSONField(encoder=DjangoJSONEncoder)
+    compare_previous = models.BooleanField(default=False)
+    render_type = models.CharField(max_length=10, choices=RenderType.choices, default=RenderType.EXCEL)
+    frequency = models.CharField(max_length=10, choices=Frequency.choices, default=Frequency.MONTHLY)
+    recipients = models.JSONField(default=list)
+    is_active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_period_start = models.DateField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.name} ({self.get_frequency_display()})"
+
+
+class QueryFingerprint(models.Model):
+    # Statements that differ only in literals share a fingerprint; see DataBuilder.querylog.
+    fingerprint = models.CharField(max_length=32, unique=True)
+    query = models.TextField()
+    calls = models.BigIntegerField(default=0)
+    total_ms = models.FloatField(default=0)
+    rows = models.BigIntegerField(default=0)
+    # Calls per duration bucket, keyed by its upper bound in milliseconds.
+    duration_buckets = models.JSONField(default=dict)
+    p50_ms = models.FloatField(default=0)
+    p95_ms = models.FloatField(default=0)
+    first_seen = models.DateTimeField(auto_now_add=True)
+    last_seen = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.fingerprint[:8]}: {self.query[:80]}"
+
+    @property
+    def mean_ms(self):
+        return round(self.total_ms / self.calls, 1) if self.calls else 0
@@ -0,0 +1,51 @@
+from django.core.paginator import Paginator
+from django.db.models import QuerySet
+from django.utils.functional import cached_property
+from rest_framework.pagination import CursorPagination
+
+from .utils import explain_estimate
+
+
+class CatalogCursorPagination(CursorPagination):
+    # Keyset pages cost the same at any depth; counts are opt-in via ?count=estimate|exact.
+    ordering = "id"
+    page_size = 50
+    page_size_query_param = "page_size"
+    max_page_size = 500
+    count_query_param = "count"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.count = self.get_count(queryset, request.query_params.get(self.count_query_param))
+        return super().paginate_queryset(queryset, request, view)
+
+    @staticmethod
+    def get_count(queryset, mode: str | None) -> int | None:
+        if mode == "exact":
+            return queryset.count()
+        if mode == "estimate":
+            estimate = explain_estimate(queryset)
+            return estimate["rows"] if estimate is not None else queryset.count()
+        return None
+
+    def get_paginated_response(self, data):
+        response = super().get_paginated_response(data)
+        if self.count is not None:
+            response.data["count"] = self.count
+        return response
+
+    def get_paginated_response_schema(self, schema):
+        response_schema = super().get_paginated_response_schema(schema)
+        response_schema["properties"]["count"] = {"type": "integer", "example": 123}
+        return response_schema
+
+
+class EstimatedCountPaginator(Paginator):
+    # Planner estimate instead of COUNT(*) once the result is large enough for it not to matter.
+    exact_count_threshold = 10_000
+
+    @cached_property
+    def count(self) -> int:
+        estimate = explain_estimate(self.object_list) if isinstance(self.object_list, QuerySet) else None
+        if estimate is None or estimate["rows"] < self.exact_count_threshold:
+            return super().count
+        return estimate["rows"]
@@ -0,0 +1,145 @@
+import cProfile
+import pstats
+import time
+from contextlib import ExitStack
+from typing import Any, Callable
+
+from django.conf import settings
+from django.db import connections
+
+from .models import AnalyticsProfile
+
+# Source paths that count towards the library breakdown of a profile.
+LIBRARY_MARKERS: dict[str, str] = {
+    "pandas": "/pandas/",
+    "plotly": "/plotly/",
+    "django_db": "/django/db/",
+}
+
+
+class QueryCollector:
+    def __init__(self) -> None:
+        self.queries: list[dict[str, Any]] = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            connection = context["connection"]
+            self.queries.append(
+                {
+                    "database": connection.alias,
+                    "sql": sql,
+                    "params": params,
+                    "many": many,
+                    "executed_sql": connection.ops.last_executed_query(context["cursor"], sql, params),
+                    "duration_ms": (time.perf_counter() - started) * 1000,
+                }
+            )
+
+
+def _function_name(func: tuple[str, int, str]) -> str:
+    filename, line, name = func
+    return f"{name} ({filename}:{line})" if line else name
+
+
+def _index_callees(stats: pstats.Stats) -> dict[tuple, list[tuple[float, tuple]]]:
+    callees: dict[tuple, list[tuple[float, tuple]]] = {}
+    for callee, (_, _, _, _, callers) in stats.stats.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, []).append((edge[3], callee))
+    return callees
+
+
+def _build_call_tree(callees: dict, func: tuple, cumulative: float, depth: int, min_seconds: float, path: frozenset):
+    node = {"function": _function_name(func), "cumulative_ms": round(cumulative * 1000, 3), "children": []}
+    if depth <= 0 or func in path:
+        return node
+
+    for edge_cumulative, callee in sorted(callees.get(func, []), key=lambda item: item[0], reverse=True):
+        if edge_cumulative < min_seconds:
+            break
+        node["children"].append(
+            _build_call_tree(callees, callee, edge_cumulative, depth - 1, min_seconds, path | {func})
+        )
+    return node
+
+
+def _library_breakdown(stats: pstats.Stats) -> dict[str, float]:
+    breakdown = dict.fromkeys(LIBRARY_MARKERS, 0.0)
+    for (filename, _, _), (_, _, own_time, _, _) in stats.stats.items():
+        for library, marker in LIBRARY_MARKERS.items():
+            if marker in filename:
+                breakdown[library] += own_time
+    return {library: round(seconds * 1000, 3) for library, seconds in breakdown.items()}
+
+
+def _explain_queries(queries: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    limit = getattr(settings, "ANALYTICS_PROFILE_EXPLAIN_LIMIT", 5)
+    selects = [q for q in queries if not q["many"] and q["sql"].lstrip().upper().startswith("SELECT")]
+    slowest = sorted(selects, key=lambda q: q["duration_ms"], reverse=True)[:limit]
+
+    explained = []
+    for query in slowest:
+        # Explained where it ran, a replica can plan differently from the primary.
+        connection = connections[query["database"]]
+        plan = None
+        if connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {query['sql']}", query["params"])
+                plan = cursor.fetchone()[0]
+        explained.append(
+            {
+                "database": query["database"],
+                "sql": query["executed_sql"],
+                "duration_ms": round(query["duration_ms"], 3),
+                "plan": plan,
+            }
+        )
+    return explained
+
+
+def profile_call(func: Callable[[], Any]) -> tuple[Any, dict[str, Any]]:
+    profiler = cProfile.Profile()
+    collector = QueryCollector()
+
+    started = time.perf_counter()
+    # Analytics reads may be routed to a replica, so every database is watched.
+    with ExitStack() as stack:
+        for alias in connections:
+            stack.enter_context(connections[alias].execute_wrapper(collector))
+        result = profiler.runcall(func)
+    duration = time.perf_counter() - started
+
+    stats = pstats.Stats(profiler)
+    root = (func.__code__.co_filename, func.__code__.co_firstlineno, func.__code__.co_name)
+    min_seconds = duration * getattr(settings, "ANALYTICS_PROFILE_MIN_FRACTION", 0.01)
+    depth = getattr(settings, "ANALYTICS_PROFILE_MAX_DEPTH", 12)
+
+    report = {
+        "duration_ms": round(duration * 1000, 3),
+        "sql_ms": round(sum(q["duration_ms"] for q in collector.queries), 3),
+        "libraries_ms": _library_breakdown(stats),
+        "queries": _explain_queries(collector.queries),
+        "call_tree": _build_call_tree(_index_callees(stats), root, duration, depth, min_seconds, frozenset()),
+    }
+    return result, report
+
+
+def store_profile(user, request_data: dict, report: dict[str, Any]) -> AnalyticsProfile:
+    profile = AnalyticsProfile.objects.create(
+        user=user,
+        request_data=request_data,
+        duration_ms=report["duration_ms"],
+        report=report,
+    )
+
+    store_size = getattr(settings, "ANALYTICS_PROFILE_STORE_SIZE", 50)
+    expired_ids = list(
+        AnalyticsProfile.objects.order_by("-created_at", "-id").values_list("id", flat=True)[store_size:]
+    )
+    if expired_ids:
+        AnalyticsProfile.objects.filter(id__in=expired_ids).delete()
+
+    return profile
@@ -0,0 +1,223 @@
+import bisect
+import hashlib
+import logging
+import random
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+from typing import Any, Callable, Iterator
+
+from celery import current_task
+from django.conf import settings
+from django.db import transaction
+from django.http import HttpRequest, HttpResponse
+from django_redis import get_redis_connection
+from redis import Redis
+from redis.exceptions import RedisError, ResponseError
+
+from .models import QueryFingerprint
+
+logger = logging.getLogger(__name__)
+
+QUERY_STATS_KEY_PREFIX = "analytics:query-stats"
+QUERY_STATS_INDEX_KEY = "analytics:query-stats:fingerprints"
+
+# Upper bounds in milliseconds. Percentiles are read off these buckets, so stats from every process add up.
+DURATION_BUCKETS_MS: tuple[float, ...] = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+_request_id: ContextVar[str | None] = ContextVar("query_log_request_id", default=None)
+_query_tags: ContextVar[dict[str, str] | None] = ContextVar("query_log_tags", default=None)
+
+
+@contextmanager
+def query_tags(dimensions: list[str], metrics: list[str]) -> Iterator[None]:
+    token = _query_tags.set({"dimensions": ",".join(dimensions), "metrics": ",".join(metrics)})
+    try:
+        yield
+    finally:
+        _query_tags.reset(token)
+
+
+def get_request_id() -> str | None:
+    request_id = _request_id.get()
+    if request_id is None and current_task:
+        return current_task.request.id
+    return request_id
+
+
+class RequestIdMiddleware:
+    def __init__(self, get_response: Callable[[HttpRequest], HttpResponse]) -> None:
+        self.get_response = get_response
+
+    def __call__(self, request: HttpRequest) -> HttpResponse:
+        request_id = request.headers.get("X-Request-ID", "")[:64] or uuid.uuid4().hex
+        token = _request_id.set(request_id)
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_id.reset(token)
+        response["X-Request-ID"] = request_id
+        return response
+
+
+@lru_cache(maxsize=2048)
+def get_fingerprint(sql: str) -> tuple[str, str]:
+    # ORM statements keep parameters apart, so mostly IN lists and inlined literals vary.
+    normalized = re.sub(r"'(?:[^']|'')*'", "?", sql)
+    # Savepoint names carry the thread id and a counter.
+    normalized = re.sub(r'"s\d+_x\d+"', '"s?"', normalized)
+    normalized = re.sub(r"%s|\b\d+(?:\.\d+)?\b", "?", normalized)
+    normalized = re.sub(r"\(\s*\?(?:\s*,\s*\?)*\s*\)", "(?, ...)", normalized)
+    normalized = re.sub(r"\s+", " ", normalized).strip()
+    return hashlib.md5(normalized.encode()).hexdigest(), normalized
+
+
+def _get_redis() -> Redis | None:
+    try:
+        return get_redis_connection("default")
+    except NotImplementedError:
+        return None
+
+
+class QueryStatsBuffer:
+    # Every statement is counted in process memory; Redis only sees a merged write every few seconds.
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.stats: dict[str, dict[str, float]] = {}
+        self.queries: dict[str, str] = {}
+        self.flushed_at = time.monotonic()
+
+    def add(self, fingerprint: str, query: str, duration_ms: float, rows: int) -> None:
+        index = bisect.bisect_left(DURATION_BUCKETS_MS, duration_ms)
+        bucket = str(DURATION_BUCKETS_MS[index]) if index < len(DURATION_BUCKETS_MS) else "+Inf"
+        with self.lock:
+            stats = self.stats.setdefault(fingerprint, {"calls": 0, "total_ms": 0.0, "rows": 0})
+            stats["calls"] += 1
+            stats["total_ms"] += duration_ms
+            stats["rows"] += rows
+            stats[f"bucket:{bucket}"] = stats.get(f"bucket:{bucket}", 0) + 1
+            self.queries[fingerprint] = query
+        self.flush_if_due()
+
+    def flush_if_due(self) -> None:
+        if time.monotonic() - self.flushed_at >= getattr(settings, "ANALYTICS_QUERY_STATS_FLUSH_INTERVAL", 10):
+            self.flush()
+
+    def flush(self) -> None:
+        with self.lock:
+            stats, queries = self.stats, self.queries
+            self.stats, self.queries, self.flushed_at = {}, {}, time.monotonic()
+        redis = _get_redis()
+        if not stats or redis is None:
+            return
+
+        try:
+            pipe = redis.pipeline(transaction=False)
+            for fingerprint, values in stats.items():
+                key = f"{QUERY_STATS_KEY_PREFIX}:{fingerprint}"
+                for field, value in values.items():
+                    pipe.hincrbyfloat(key, field, value)
+                pipe.hsetnx(key, "query", queries[fingerprint])
+                pipe.sadd(QUERY_STATS_INDEX_KEY, fingerprint)
+            pipe.execute()
+        except RedisError:
+            logger.warning("Could not record query stats", exc_info=True)
+
+
+query_stats = QueryStatsBuffer()
+
+
+def flush_query_stats(**kwargs) -> None:
+    # A process gone idle runs no statements; the end of each request and task flushes what is due too.
+    query_stats.flush_if_due()
+
+
+def record_query(sql: str, duration_ms: float, rows: int) -> None:
+    fingerprint, query = get_fingerprint(sql)
+    query_stats.add(fingerprint, query, duration_ms, rows)
+
+    slow = duration_ms >= getattr(settings, "ANALYTICS_SLOW_QUERY_MS", 500)
+    if not slow and random.random() >= getattr(settings, "ANALYTICS_QUERY_SAMPLE_RATE", 0.01):
+        return
+    tags = _query_tags.get() or {}
+    logger.log(
+        logging.WARNING if slow else logging.INFO,
+        "%s query %.1f ms, %d rows, fingerprint=%s request_id=%s dimensions=%s metrics=%s: %s",
+        "Slow" if slow else "Sampled",
+        duration_ms,
+        rows,
+        fingerprint,
+        get_request_id() or "-",
+        tags.get("dimensions", "-"),
+        tags.get("metrics", "-"),
+        sql,
+    )
+
+
+def log_query(execute: Callable, sql: str, params: Any, many: bool, context: dict[str, Any]) -> Any:
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        rows = getattr(context["cursor"], "rowcount", -1)
+        record_query(sql, (time.perf_counter() - started) * 1000, max(rows or 0, 0))
+
+
+def install_query_log(sender, connection, **kwargs) -> None:
+    # Sent for every new (or pooled) connection; the wrapper list lives as long as the thread's wrapper.
+    if getattr(settings, "ANALYTICS_QUERY_LOG", True) and log_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(log_query)
+
+
+def get_percentile(buckets: dict[str, float], quantile: float) -> float:
+    # Upper bound of the bucket the percentile falls into; +Inf is reported as the largest finite bound.
+    rank = quantile * sum(buckets.values())
+    seen = 0.0
+    for bound in DURATION_BUCKETS_MS:
+        seen += buckets.get(str(bound), 0)
+        if seen >= rank:
+            return float(bound)
+    return float(DURATION_BUCKETS_MS[-1])
+
+
+def collect_query_stats() -> int:
+    query_stats.flush()
+    redis = _get_redis()
+    if redis is None:
+        return 0
+
+    collected = 0
+    for member in redis.smembers(QUERY_STATS_INDEX_KEY):
+        fingerprint = member.decode()
+        key = f"{QUERY_STATS_KEY_PREFIX}:{fingerprint}"
+        # Renamed first, so that increments arriving meanwhile start a fresh hash instead of being lost.
+        collecting_key = f"{key}:collecting"
+        try:
+            redis.rename(key, collecting_key)
+        except ResponseError:
+            redis.srem(QUERY_STATS_INDEX_KEY, fingerprint)
+            continue
+        values = {field.decode(): value.decode() for field, value in redis.hgetall(collecting_key).items()}
+        redis.delete(collecting_key)
+
+        with transaction.atomic():
+            stats, _ = QueryFingerprint.objects.select_for_update().get_or_create(
+                fingerprint=fingerprint, defaults={"query": values.get("query", "")}
+            )
+            stats.calls += int(float(values.get("calls", 0)))
+            stats.total_ms += float(values.get("total_ms", 0))
+            stats.rows += int(float(values.get("rows", 0)))
+            for field, value in values.items():
+                if field.startswith("bucket:"):
+                    bound = field.removeprefix("bucket:")
+                    stats.duration_buckets[bound] = stats.duration_buckets.get(bound, 0) + int(float(value))
+            stats.p50_ms = get_percentile(stats.duration_buckets, 0.5)
+            stats.p95_ms = get_percentile(stats.duration_buckets, 0.95)
+            stats.save()
+        collected += 1
+
+    return collected
@@ -0,0 +1,60 @@
+import logging
+
+from django.conf import settings
+from django.db import DatabaseError
+
+from .services import estimate_request_cost
+from .utils import QueryEstimate
+
+logger = logging.getLogger(__name__)
+
+QUICK_QUEUE = "analytics"
+BULK_QUEUE = "reports"
+MAINTENANCE_QUEUE = "maintenance"
+
+MAINTENANCE_TASKS: set[str] = {
+    "DataBuilder.tasks.refresh_analytics_rollups_task",
+    "DataBuilder.tasks.refresh_analytics_rollup_task",
+    "DataBuilder.tasks.warm_analytics_cache_task",
+    "DataBuilder.tasks.delete_expired_reports_task",
+    "DataBuilder.tasks.rebuild_intraday_counters_task",
+    "DataBuilder.tasks.sync_columnar_snapshot_task",
+    "DataBuilder.tasks.collect_query_stats_task",
+}
+BULK_TASKS: set[str] = {"DataBuilder.tasks.send_report_subscriptions_task"}
+
+# These run an analytics request and are sent to the queue its planner estimate picks, see get_request_queue.
+# The fixed queue is only used when no estimate could be made.
+SIZED_TASKS: dict[str, str] = {
+    "DataBuilder.tasks.generate_and_send_excel_task": BULK_QUEUE,
+    "DataBuilder.tasks.generate_and_send_chart_task": QUICK_QUEUE,
+    "DataBuilder.tasks.generate_analytics_task": BULK_QUEUE,
+}
+
+
+def get_estimate_queue(estimate: QueryEstimate) -> str:
+    if estimate["rows"] > getattr(settings, "ANALYTICS_BULK_TASK_MIN_ROWS", 100_000):
+        return BULK_QUEUE
+    if estimate["cost"] > getattr(settings, "ANALYTICS_BULK_TASK_MIN_COST", 5_000_000):
+        return BULK_QUEUE
+    return QUICK_QUEUE
+
+
+def get_request_queue(task_name: str, params: dict) -> str:
+    try:
+        estimate = estimate_request_cost(params)
+    except DatabaseError:
+        # Not worth failing an accepted request over; the task reports its own database errors.
+        logger.warning("Could not estimate %s, using its default queue", task_name, exc_info=True)
+        return SIZED_TASKS[task_name]
+    return get_estimate_queue(estimate)
+
+
+def route_task(name: str, args: tuple, kwargs: dict, options: dict, task=None, **kw) -> dict | None:
+    if name in MAINTENANCE_TASKS:
+        return {"queue": MAINTENANCE_QUEUE}
+    if name in BULK_TASKS:
+        return {"queue": BULK_QUEUE}
+    if name in SIZED_TASKS and not options.get("queue"):
+        return {"queue": SIZED_TASKS[name]}
+    return None
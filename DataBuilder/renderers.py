@@ -0,0 +1,42 @@
+from typing import Any
+
+import orjson
+import pandas as pd
+from pandas.api.types import is_datetime64_any_dtype
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+# "Z" for UTC like DRF's encoder; NaN becomes null.
+ORJSON_OPTIONS = orjson.OPT_UTC_Z | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+
+class DataFrameRows:
+    # Rendered as [[...], ...] in column order, for the "columns" layout.
+    def __init__(self, df: pd.DataFrame) -> None:
+        self.df = df
+
+
+def _column_values(series: pd.Series) -> list:
+    if is_datetime64_any_dtype(series):
+        return series.dt.to_pydatetime().tolist()
+    return series.tolist()
+
+
+def _default(obj: Any) -> Any:
+    # Values are read column by column with tolist() instead of to_dict's per-cell lookups; the records
+    # layout still builds one dict per row for orjson, only the columns layout gets by with plain tuples.
+    if isinstance(obj, pd.DataFrame):
+        columns = list(obj.columns)
+        rows = zip(*(_column_values(obj[c]) for c in columns))
+        return orjson.Fragment(orjson.dumps([dict(zip(columns, row)) for row in rows], option=ORJSON_OPTIONS))
+    if isinstance(obj, DataFrameRows):
+        rows = zip(*(_column_values(obj.df[c]) for c in obj.df.columns))
+        return orjson.Fragment(orjson.dumps(list(rows), option=ORJSON_OPTIONS))
+    return JSONEncoder().default(obj)
+
+
+class AnalyticsJSONRenderer(JSONRenderer):
+    def render(self, data: Any, accepted_media_type: str | None = None, renderer_context: dict | None = None) -> bytes:
+        if data is None:
+            return b""
+        return orjson.dumps(data, default=_default, option=ORJSON_OPTIONS)
@@ -0,0 +1,95 @@
+import datetime
+import gzip
+import re
+import shutil
+import tempfile
+from typing import IO, Iterator
+
+from django.conf import settings
+from django.core import signing
+from django.core.files import File
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import ReportArtifact
+
+REPORT_SIGNING_SALT = "DataBuilder.reports"
+
+CHUNK_SIZE = 64 * 1024
+
+# Office documents are zip containers already; gzip would only cost CPU.
+COMPRESSIBLE_CONTENT_TYPES: set[str] = {"text/html", "text/csv", "application/json"}
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def store_report(content: IO[bytes], filename: str, content_type: str) -> ReportArtifact:
+    artifact = ReportArtifact(
+        filename=filename,
+        content_type=content_type,
+        expires_at=timezone.now() + getattr(settings, "ANALYTICS_REPORT_TTL", datetime.timedelta(days=7)),
+    )
+
+    if content_type in COMPRESSIBLE_CONTENT_TYPES:
+        with tempfile.TemporaryFile() as compressed:
+            with gzip.GzipFile(fileobj=compressed, mode="wb") as gz:
+                shutil.copyfileobj(content, gz, CHUNK_SIZE)
+            compressed.seek(0)
+            artifact.content_encoding = "gzip"
+            artifact.file.save(f"{artifact.id}.gz", File(compressed), save=False)
+    else:
+        artifact.file.save(str(artifact.id), File(content), save=False)
+
+    artifact.size = artifact.file.size
+    artifact.save()
+    return artifact
+
+
+def get_report_url(artifact: ReportArtifact) -> str:
+    token = signing.TimestampSigner(salt=REPORT_SIGNING_SALT).sign(str(artifact.id))
+    return settings.SITE_URL.rstrip("/") + reverse("report-download", kwargs={"token": token})
+
+
+def get_artifact_id(token: str) -> str | None:
+    max_age = getattr(settings, "ANALYTICS_REPORT_TTL", datetime.timedelta(days=7))
+    try:
+        return signing.TimestampSigner(salt=REPORT_SIGNING_SALT).unsign(token, max_age=max_age)
+    except signing.BadSignature:
+        return None
+
+
+def parse_range(header: str, size: int) -> tuple[int, int] | None:
+    # Only a single "bytes=" range is honoured; anything else gets the whole file.
+    match = RANGE_RE.match(header.strip())
+    if not match or not any(match.groups()):
+        return None
+
+    start, end = match.groups()
+    if not start:
+        length = min(int(end), size)
+        return size - length, size - 1
+    end_value = min(int(end), size - 1) if end else size - 1
+    return int(start), end_value
+
+
+def iter_file_range(file: IO[bytes], start: int, length: int) -> Iterator[bytes]:
+    try:
+        file.seek(start)
+        while length > 0:
+            chunk = file.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        file.close()
+
+
+def delete_expired_reports() -> int:
+    expired = ReportArtifact.objects.filter(expires_at__lt=timezone.now())
+    deleted = 0
+    for artifact in expired.iterator():
+        artifact.file.delete(save=False)
+        artifact.delete()
+        deleted += 1
+    return deleted
@@ -0,0 +1,123 @@
+import time
+import datetime
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, F, Max, Min, QuerySet, Sum
+from django.db.models.functions import TruncDay, TruncHour
+from django.utils import timezone
+
+from .models import CartItem, SalesRollup, RollupRefresh
+
+# Dimensions that are stored as their own column in a rollup. Every other time
+# dimension is derived from the rollup bucket, so it never has to be configured.
+ROLLUP_ITEM_DIMENSIONS: dict[str, tuple[str, str]] = {
+    "shop_name": ("shop_id", "receipt__shop_id"),
+    "brand_name": ("brand_id", "product__brand_id"),
+    "product_name": ("product_id", "product_id"),
+}
+
+
+def get_rollup_config() -> dict[str, list[str]]:
+    return getattr(settings, "ANALYTICS_ROLLUPS", {})
+
+
+def get_item_dimensions(dimensions: list[str]) -> frozenset[str]:
+    return frozenset(d for d in dimensions if d in ROLLUP_ITEM_DIMENSIONS)
+
+
+def is_hourly(dimensions: list[str]) -> bool:
+    return "hour" in dimensions
+
+
+def get_fresh_rollups(covered_until: datetime.datetime | None = None) -> set[str]:
+    # A rollup only answers a range whose end it has seen sales past; today's totals never come from it.
+    max_staleness = getattr(settings, "ANALYTICS_ROLLUP_MAX_STALENESS", 3600)
+    threshold = timezone.now() - datetime.timedelta(seconds=max_staleness)
+    refreshes = RollupRefresh.objects.filter(name__in=list(get_rollup_config()), refreshed_at__gte=threshold)
+    if covered_until is not None:
+        refreshes = refreshes.filter(source_max_datetime__gte=covered_until)
+
+    return set(refreshes.values_list("name", flat=True))
+
+
+def _build_source_queryset(dimensions: list[str]) -> tuple[QuerySet, list[str]]:
+    bucket = TruncHour("datetime") if is_hourly(dimensions) else TruncDay("datetime")
+    annotations = {"rollup_datetime": bucket}
+    columns = ["datetime"]
+
+    for dimension in sorted(get_item_dimensions(dimensions)):
+        column, path = ROLLUP_ITEM_DIMENSIONS[dimension]
+        annotations[f"rollup_{column}"] = F(path)
+        columns.append(column)
+
+    queryset = CartItem.objects.annotate(**annotations)
+    if "brand_name" in dimensions:
+        queryset = queryset.exclude(product__brand__name__isnull=True).exclude(product__brand__name__exact="")
+
+    queryset = queryset.values(*annotations).annotate(
+        rollup_total_price=Sum("total_price"),
+        rollup_margin_price_total=Sum("margin_price_total"),
+        rollup_qty=Sum("qty"),
+        rollup_receipts_count=Count("receipt_id", distinct=True),
+    )
+    columns += ["total_price", "margin_price_total", "qty", "receipts_count"]
+
+    return queryset, columns
+
+
+def refresh_rollup(name: str, full: bool = False) -> RollupRefresh:
+    dimensions = get_rollup_config()[name]
+    started_at = timezone.now()
+    started = time.monotonic()
+
+    source = CartItem.objects.aggregate(max_datetime=Max("datetime"), max_id=Max("id"))
+    queryset, columns = _build_source_queryset(dimensions)
+    rollup_rows = SalesRollup.objects.filter(name=name)
+
+    # Only days with sales inserted since the previous refresh are rebuilt, however far back they are dated.
+    # Updated or deleted items, and inserts still uncommitted at that refresh, wait for the nightly full rebuild.
+    previous = None if full else RollupRefresh.objects.filter(name=name).order_by("-refreshed_at").first()
+    changed_from = None
+    if previous is not None and previous.source_max_id is not None:
+        changed_from = CartItem.objects.filter(id__gt=previous.source_max_id).aggregate(value=Min("datetime"))["value"]
+        if changed_from is None:
+            return _record_refresh(name, started_at, started, 0, source)
+
+        rebuild_from = timezone.make_aware(
+            datetime.datetime.combine(timezone.localtime(changed_from).date(), datetime.time.min)
+        )
+        queryset = queryset.filter(datetime__gte=rebuild_from)
+        rollup_rows = rollup_rows.filter(datetime__gte=rebuild_from)
+
+    select_sql, params = queryset.query.sql_with_params()
+
+    quote = connection.ops.quote_name
+    target_columns = ", ".join(quote(c) for c in ["name", *columns])
+    source_columns = ", ".join(quote(f"rollup_{c}") for c in columns)
+    insert_sql = (
+        f"INSERT INTO {quote(SalesRollup._meta.db_table)} ({target_columns}) "
+        f"SELECT %s, {source_columns} FROM ({select_sql}) AS rollup_source"
+    )
+
+    # Readers keep seeing the previous snapshot until the swap is committed.
+    with transaction.atomic():
+        rollup_rows.delete()
+        with connection.cursor() as cursor:
+            cursor.execute(insert_sql, [name, *params])
+            rows = cursor.rowcount
+
+    return _record_refresh(name, started_at, started, rows, source)
+
+
+def _record_refresh(
+    name: str, started_at: datetime.datetime, started: float, rows: int, source: dict
+) -> RollupRefresh:
+    return RollupRefresh.objects.create(
+        name=name,
+        refreshed_at=started_at,
+        duration=datetime.timedelta(seconds=time.monotonic() - started),
+        rows=rows,
+        source_max_datetime=source["max_datetime"],
+        source_max_id=source["max_id"],
+    )
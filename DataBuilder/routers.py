@@ -0,0 +1,78 @@
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+logger = logging.getLogger(__name__)
+
+_analytics_reads: ContextVar[bool] = ContextVar("analytics_reads", default=False)
+
+# Replica is fully caught up when it has replayed everything it received;
+# otherwise the lag is the age of the last replayed transaction.
+REPLICA_LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END
+"""
+
+
+@contextmanager
+def analytics_reads() -> Iterator[None]:
+    token = _analytics_reads.set(True)
+    try:
+        yield
+    finally:
+        _analytics_reads.reset(token)
+
+
+def get_replica_lag(alias: str) -> float | None:
+    cache_key = f"analytics:replica-lag:{alias}"
+    lag = cache.get(cache_key)
+    if lag is not None:
+        return None if lag < 0 else lag
+
+    try:
+        with connections[alias].cursor() as cursor:
+            cursor.execute(REPLICA_LAG_SQL)
+            value = cursor.fetchone()[0]
+        lag = float(value) if value is not None else -1.0
+    except DatabaseError:
+        logger.warning("Could not check lag of database %s", alias, exc_info=True)
+        lag = -1.0
+
+    cache.set(cache_key, lag, timeout=getattr(settings, "ANALYTICS_REPLICA_LAG_CHECK_INTERVAL", 5))
+    return None if lag < 0 else lag
+
+
+def get_analytics_database() -> str:
+    alias = getattr(settings, "ANALYTICS_DATABASE", DEFAULT_DB_ALIAS)
+    if alias == DEFAULT_DB_ALIAS:
+        return alias
+
+    lag = get_replica_lag(alias)
+    if lag is None or lag > getattr(settings, "ANALYTICS_REPLICA_MAX_LAG", 30):
+        return DEFAULT_DB_ALIAS
+    return alias
+
+
+class AnalyticsReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if _analytics_reads.get():
+            return get_analytics_database()
+        return None
+
+    def db_for_write(self, model, **hints):
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == getattr(settings, "ANALYTICS_DATABASE", DEFAULT_DB_ALIAS) and db != DEFAULT_DB_ALIAS:
+            return False
+        return None
@@ -1,3 +1,7 @@
+import json
+
+from django.conf import settings
+from django.http import QueryDict
 from rest_framework import serializers
 from .models import Brand, Shop, Product
 from .validators import validate_comparison_metrics
@@ -26,19 +30,104 @@ class DateRangeSerializer(serializers.Serializer):
     to_date = serializers.DateField()
 
 
+# Value type of every filterable dimension; truncated periods are filtered by their start date.
+FILTER_VALUE_FIELDS: dict[str, type[serializers.Field]] = {
+    "product_name": serializers.CharField,
+    "brand_name": serializers.CharField,
+    "shop_name": serializers.CharField,
+    "day_month_year": serializers.DateField,
+    "day_of_week": serializers.IntegerField,
+    "month": serializers.IntegerField,
+    "month_year": serializers.DateField,
+    "quarter": serializers.IntegerField,
+    "quarter_year": serializers.DateField,
+    "year": serializers.DateField,
+    "hour": serializers.IntegerField,
+}
+
+FILTER_LIST_OPERATORS: set[str] = {"in", "not_in"}
+FILTER_RANGE_OPERATORS: set[str] = {"gte", "lte"}
+
+
 class AnalyticsRequestSerializer(serializers.Serializer):
     metrics = serializers.ListField(child=serializers.CharField())
     group_by = serializers.ListField(child=serializers.CharField())
     date_range = DateRangeSerializer()
     prev_date_range = DateRangeSerializer(required=False, allow_null=True)
     total = serializers.BooleanField(required=False, default=False)
+    approximate = serializers.BooleanField(required=False, default=False)
+    filters = serializers.DictField(child=serializers.DictField(), required=False, default=dict)
     render_type = serializers.CharField(required=False)
     chart_type = serializers.CharField(required=False)
+    chart_format = serializers.ChoiceField(choices=["html", "json"], required=False, default="html")
+    layout = serializers.ChoiceField(choices=["records", "columns"], required=False, default="records")
     email = serializers.EmailField(required=False)
 
+    def validate_filters(self, value):
+        filters = {}
+        for dimension, conditions in value.items():
+            if dimension not in FILTER_VALUE_FIELDS:
+                raise serializers.ValidationError(f"Невідомий вимір для фільтра: {dimension}.")
+            unknown = conditions.keys() - FILTER_LIST_OPERATORS - FILTER_RANGE_OPERATORS
+            if unknown or not conditions:
+                raise serializers.ValidationError(
+                    f"Фільтр {dimension} підтримує лише операції in, not_in, gte та lte."
+                )
+
+            value_field = FILTER_VALUE_FIELDS[dimension]
+            filters[dimension] = {}
+            for operator, operand in conditions.items():
+                if operator in FILTER_LIST_OPERATORS:
+                    field = serializers.ListField(child=value_field(), allow_empty=False)
+                else:
+                    field = value_field()
+                try:
+                    filters[dimension][operator] = field.run_validation(operand)
+                except serializers.ValidationError as exc:
+                    raise serializers.ValidationError({dimension: {operator: exc.detail}})
+        return filters
+
     def validate(self, data):
         if data.get("render_type") == "excel" and not data.get("email"):
             raise serializers.ValidationError({"email": "Для формату Excel необхідно вказати email."})
         return data
 
     validators = [validate_comparison_metrics]
+
+
+def parse_analytics_query(query: QueryDict) -> dict:
+    # GET form of an analytics request: lists are repeated or comma separated, filters are JSON.
+    def split(name: str) -> list[str]:
+        return [item for value in query.getlist(name) for item in value.split(",") if item]
+
+    if query.get("render_type", "json") not in {"json", "chart"} or "email" in query:
+        raise serializers.ValidationError("GET-запит підтримує лише render_type json та chart без email.")
+
+    data = {
+        "metrics": split("metrics"),
+        "group_by": split("group_by"),
+        "date_range": {"from_date": query.get("from_date"), "to_date": query.get("to_date")},
+    }
+    if "prev_from_date" in query or "prev_to_date" in query:
+        data["prev_date_range"] = {"from_date": query.get("prev_from_date"), "to_date": query.get("prev_to_date")}
+    for name in ("total", "approximate", "render_type", "chart_type", "chart_format", "layout"):
+        if name in query:
+            data[name] = query[name]
+    if "filters" in query:
+        try:
+            data["filters"] = json.loads(query["filters"])
+        except ValueError:
+            raise serializers.ValidationError({"filters": "Фільтри мають бути JSON-об'єктом."})
+    return data
+
+
+class AnalyticsBatchRequestSerializer(serializers.Serializer):
+    requests = AnalyticsRequestSerializer(many=True, allow_empty=False)
+
+    def validate_requests(self, value):
+        max_requests = getattr(settings, "ANALYTICS_BATCH_MAX_REQUESTS", 20)
+        if len(value) > max_requests:
+            raise serializers.ValidationError(f"Пакет може містити не більше {max_requests} запитів.")
+        if any(request.get("render_type", "json") != "json" for request in value):
+            raise serializers.ValidationError("Пакетний запит підтримує лише render_type json.")
+        return value
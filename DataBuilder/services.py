@@ -1,7 +1,15 @@
 import datetime
-from typing import TypedDict
-
-from django.db.models import Sum, Count, DecimalField, F, Expression, QuerySet
+import gzip
+import hashlib
+import json
+from contextlib import contextmanager
+from contextvars import ContextVar
+from io import BytesIO
+from typing import Any, Callable, Iterator, TypedDict
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models import Sum, Count, DateTimeField, DecimalField, F, Expression, Q, QuerySet
+from django.db.models.expressions import RawSQL
 from django.db.models.functions import (
     TruncDay,
     TruncMonth,
@@ -16,10 +24,45 @@ from django.db.models.functions import (
 )
 from django.core.cache import cache
 from django.conf import settings
+from django.utils import timezone
+import numpy as np
 import pandas as pd
 import plotly.express as px
-from .models import CartItem
-from .utils import calculate_diffs, generate_analytics_cache_key
+from .columnar import can_serve, get_columnar_dataframe
+from .etags import get_data_version
+from .instrumentation import record_cache_lookup, record_rows, timed
+from .intraday import get_intraday_dataframe, is_intraday_ready
+from .limits import guarded_queries
+from .memory import CHUNK_SIZE, MemoryBudget, compact_dataframe, read_dataframe
+from .models import SALE_BUCKETS_TIME_ZONE, CartItem, Receipt, SalesRollup
+from .querylog import query_tags
+from .renderers import DataFrameRows
+from .rollups import get_fresh_rollups, get_item_dimensions, get_rollup_config, is_hourly
+from .routers import analytics_reads
+from .utils import (
+    QueryEstimate,
+    calculate_diffs,
+    execute_compiled,
+    explain_estimate,
+    generate_analytics_cache_key,
+    get_datetime_bounds,
+    serialize_filters,
+)
+
+XLSX_CONTENT_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+_prefetched_dataframes: ContextVar[dict[str, pd.DataFrame] | None] = ContextVar(
+    "analytics_prefetched_dataframes", default=None
+)
+
+
+@contextmanager
+def prefetched_dataframes(dataframes: dict[str, pd.DataFrame]) -> Iterator[None]:
+    token = _prefetched_dataframes.set(dataframes)
+    try:
+        yield
+    finally:
+        _prefetched_dataframes.reset(token)
 
 
 class DateRangeDict(TypedDict):
@@ -42,6 +85,26 @@ class AnalyticsService:
         "hour": ExtractHour("datetime"),
     }
 
+    # CartItem's stored sale_* buckets; dates are cast back to the aware datetimes Trunc* returns.
+    SALE_BUCKET_DIMENSION_MAPPING: dict[str, Expression] = {
+        "day_month_year": Cast("sale_day", output_field=DateTimeField()),
+        "day_of_week": F("sale_weekday"),
+        "month": F("sale_month"),
+        "month_year": Cast(TruncMonth("sale_day"), output_field=DateTimeField()),
+        "quarter": F("sale_quarter"),
+        "quarter_year": Cast(TruncQuarter("sale_day"), output_field=DateTimeField()),
+        "year": Cast(TruncYear("sale_day"), output_field=DateTimeField()),
+        "hour": F("sale_hour"),
+    }
+
+    # Date filters compare the bucket dates themselves, so the (sale_day, sale_hour) index applies.
+    SALE_BUCKET_FILTER_MAPPING: dict[str, Expression] = {
+        "day_month_year": F("sale_day"),
+        "month_year": TruncMonth("sale_day"),
+        "quarter_year": TruncQuarter("sale_day"),
+        "year": TruncYear("sale_day"),
+    }
+
     _turnover = Sum("total_price")
     _profit = Sum("margin_price_total")
     _qty = Sum("qty")
@@ -70,11 +133,88 @@ class AnalyticsService:
         "unique_products_sold": Count("product_id", distinct=True),
     }
 
+    ROLLUP_DIMENSION_MAPPING: dict[str, Expression] = {
+        **DIMENSION_MAPPING,
+        "product_name": F("product__name"),
+        "brand_name": F("brand__name"),
+        "shop_name": F("shop__name"),
+    }
+
+    _rollup_checks_count_safe = NullIf(Sum("receipts_count"), 0)
+
+    ROLLUP_METRIC_MAPPING: dict[str, Expression] = {
+        "turnover": _turnover,
+        "profit": _profit,
+        "sales_qty": _qty,
+        "checks_count": Sum("receipts_count"),
+        "avg_check": Cast(
+            _turnover / _rollup_checks_count_safe,
+            output_field=DecimalField(max_digits=10, decimal_places=2),
+        ),
+        "avg_price": METRIC_MAPPING["avg_price"],
+        "avg_cost": METRIC_MAPPING["avg_cost"],
+    }
+
+    ROLLUP_RECEIPT_METRICS: set[str] = {"checks_count", "avg_check"}
+
+    # Receipt stores the same totals as the sum of its items, one row per check.
+    RECEIPT_DIMENSION_MAPPING: dict[str, Expression] = {
+        **{d: e for d, e in DIMENSION_MAPPING.items() if d not in {"product_name", "brand_name"}},
+        "shop_name": F("shop__name"),
+    }
+
+    _receipts_count = Count("*")
+
+    RECEIPT_METRIC_MAPPING: dict[str, Expression] = {
+        "turnover": _turnover,
+        "profit": _profit,
+        "checks_count": _receipts_count,
+        "avg_check": Cast(
+            _turnover / NullIf(_receipts_count, 0),
+            output_field=DecimalField(max_digits=10, decimal_places=2),
+        ),
+    }
+
+    # Sums that add up across partitions of the data (sample blocks, closed days and today);
+    # ratios are rebuilt from them after the parts are combined.
+    ADDITIVE_METRICS: set[str] = {"turnover", "profit", "sales_qty", "checks_count"}
+
+    RATIO_METRICS: dict[str, tuple[Callable[[pd.DataFrame], pd.Series], set[str]]] = {
+        "avg_check": (lambda df: df["turnover"] / df["checks_count"], {"turnover", "checks_count"}),
+        "avg_price": (lambda df: df["turnover"] / df["sales_qty"], {"turnover", "sales_qty"}),
+        "avg_cost": (
+            lambda df: (df["turnover"] - df["profit"]) / df["sales_qty"],
+            {"turnover", "profit", "sales_qty"},
+        ),
+    }
+
+    SAMPLE_Z_SCORE = 1.96
+
     SUFFIXES: list[str] = ["_prev", "_diff", "_diff_percent"]
 
-    def __init__(self, dimensions: list[str], metrics: list[str]) -> None:
+    # Filter operators and the lookups they compile to; "not_in" excludes the matching rows.
+    FILTER_LOOKUPS: dict[str, str] = {"in": "in", "not_in": "in", "gte": "gte", "lte": "lte"}
+
+    # Truncated dimensions are filtered by the date their bucket starts on.
+    DATE_DIMENSIONS: set[str] = {"day_month_year", "month_year", "quarter_year", "year"}
+
+    def __init__(
+        self,
+        dimensions: list[str],
+        metrics: list[str],
+        approximate: bool = False,
+        filters: dict[str, dict[str, Any]] | None = None,
+    ) -> None:
         self.requested_dimensions = dimensions
         self.requested_metrics = metrics
+        self.approximate = approximate
+        # Shared by every frame this service holds at once, e.g. both periods and their merge.
+        self.memory_budget = MemoryBudget()
+        self.filters: dict[str, dict[str, Any]] = {
+            d: {op: self._coerce_filter_value(d, value) for op, value in conditions.items()}
+            for d, conditions in (filters or {}).items()
+            if d in self.DIMENSION_MAPPING and conditions
+        }
 
         self.base_metrics: set[str] = set()
         for m in self.requested_metrics:
@@ -89,102 +229,577 @@ class AnalyticsService:
                         self.base_metrics.add(base_name)
                     break
 
+        item_dimension_mapping = self.get_item_dimension_mapping()
         self.db_group_kwargs: dict[str, Expression] = {
-            m: self.DIMENSION_MAPPING[m] for m in self.requested_dimensions if m in self.DIMENSION_MAPPING
+            m: item_dimension_mapping[m] for m in self.requested_dimensions if m in self.DIMENSION_MAPPING
         }
 
         self.db_aggregates: dict[str, Expression] = {
             m: self.METRIC_MAPPING[m] for m in self.base_metrics if m in self.METRIC_MAPPING
         }
 
-    def get_dataframe(self, date_from: datetime.date, date_to: datetime.date, as_total: bool = False) -> pd.DataFrame:
+    @classmethod
+    def from_params(cls, params: dict) -> "AnalyticsService":
+        return cls(
+            dimensions=params.get("group_by", []),
+            metrics=params.get("metrics", []),
+            approximate=params.get("approximate", False),
+            filters=params.get("filters"),
+        )
+
+    @classmethod
+    def uses_sale_buckets(cls) -> bool:
+        return timezone.get_current_timezone_name() == SALE_BUCKETS_TIME_ZONE
+
+    @classmethod
+    def get_item_dimension_mapping(cls) -> dict[str, Expression]:
+        if not cls.uses_sale_buckets():
+            return cls.DIMENSION_MAPPING
+        return {**cls.DIMENSION_MAPPING, **cls.SALE_BUCKET_DIMENSION_MAPPING}
+
+    @classmethod
+    def get_item_date_filter_mapping(cls) -> dict[str, Expression]:
+        return cls.SALE_BUCKET_FILTER_MAPPING if cls.uses_sale_buckets() else {}
+
+    @classmethod
+    def _coerce_filter_value(cls, dimension: str, value: Any) -> Any:
+        if isinstance(value, list):
+            return [cls._coerce_filter_value(dimension, v) for v in value]
+        if dimension in cls.DATE_DIMENSIONS and isinstance(value, str):
+            return datetime.date.fromisoformat(value)
+        return value
+
+    @classmethod
+    def get_filter_bound(cls, dimension: str, value: Any) -> Any:
+        # Trunc* dimensions are aware datetimes at the start of the bucket.
+        if isinstance(value, list):
+            return [cls.get_filter_bound(dimension, v) for v in value]
+        if dimension in cls.DATE_DIMENSIONS:
+            return timezone.make_aware(datetime.datetime.combine(value, datetime.time.min))
+        return value
+
+    def apply_filters(
+        self,
+        queryset: QuerySet,
+        mapping: dict[str, Expression],
+        date_mapping: dict[str, Expression] | None = None,
+    ) -> QuerySet:
+        date_mapping = date_mapping or {}
+        for dimension, conditions in self.filters.items():
+            alias = f"filter_{dimension}"
+            queryset = queryset.alias(**{alias: date_mapping.get(dimension, mapping[dimension])})
+            for operator, value in conditions.items():
+                bound = value if dimension in date_mapping else self.get_filter_bound(dimension, value)
+                condition = Q(**{f"{alias}__{self.FILTER_LOOKUPS[operator]}": bound})
+                if operator == "not_in":
+                    # Rows without a value (e.g. unbranded products) are not in any list.
+                    condition = ~condition | Q(**{f"{alias}__isnull": True})
+                queryset = queryset.filter(condition)
+        return queryset
+
+    def filter_dataframe(self, df: pd.DataFrame) -> pd.DataFrame:
+        mask = pd.Series(True, index=df.index)
+        for dimension, conditions in self.filters.items():
+            for operator, value in conditions.items():
+                bound = self.get_filter_bound(dimension, value)
+                if operator == "in":
+                    mask &= df[dimension].isin(bound)
+                elif operator == "not_in":
+                    mask &= ~df[dimension].isin(bound)
+                elif operator == "gte":
+                    mask &= df[dimension] >= bound
+                else:
+                    mask &= df[dimension] <= bound
+        return df[mask]
+
+    def get_cache_key(self, date_from: datetime.date, date_to: datetime.date, as_total: bool = False) -> str:
         current_dimensions = list(self.db_group_kwargs.keys())
-        current_metrics = list(self.db_aggregates.keys())
         dimensions_for_cache = current_dimensions + ["__total__"] if as_total else current_dimensions
 
-        cache_key = generate_analytics_cache_key(
+        return generate_analytics_cache_key(
             date_from,
             date_to,
             dimensions_for_cache,
-            current_metrics,
+            list(self.db_aggregates.keys()),
+            self.get_sample_percent(date_from, date_to),
+            serialize_filters(self.filters),
+            # Ingestion bumps the versions of the days it touches, so only ranges over those days are recomputed.
+            get_data_version(date_from, date_to),
         )
 
-        cached_df = cache.get(cache_key)
-        if cached_df is not None:
-            return cached_df
+    def get_sample_percent(self, date_from: datetime.date, date_to: datetime.date) -> float | None:
+        sampled_metrics = self.ADDITIVE_METRICS | self.RATIO_METRICS.keys()
+        if not self.approximate or not self.db_aggregates.keys() <= sampled_metrics:
+            return None
+        if connections[DEFAULT_DB_ALIAS].vendor != "postgresql" or self.uses_columnar(date_to):
+            return None
+
+        # Ranges up to ANALYTICS_SAMPLE_EXACT_DAYS stay exact; longer ones read about as many blocks.
+        days = (date_to - date_from).days + 1
+        exact_days = getattr(settings, "ANALYTICS_SAMPLE_EXACT_DAYS", 31)
+        if days <= exact_days:
+            return None
+        min_percent = getattr(settings, "ANALYTICS_SAMPLE_MIN_PERCENT", 1.0)
+        return round(max(min_percent, 100 * exact_days / days), 2)
+
+    @property
+    def sample_ci_columns(self) -> list[str]:
+        return [f"{m}_ci" for m in self.db_aggregates if m in self.ADDITIVE_METRICS]
+
+    def build_queryset(
+        self, date_from: datetime.date, date_to: datetime.date, as_total: bool = False
+    ) -> tuple[QuerySet, dict[str, Expression]]:
+        current_dimensions = list(self.db_group_kwargs.keys())
+        current_metrics = list(self.db_aggregates.keys())
 
-        queryset: QuerySet[CartItem] = CartItem.objects.filter(
-            datetime__gte=date_from,
-            datetime__lte=date_to,
-        )
+        datetime_from, datetime_to = get_datetime_bounds(date_from, date_to)
+        group_kwargs = self.db_group_kwargs
+        aggregates = self.db_aggregates
+
+        rollup_name = self.match_rollup(as_total, date_to)
+        if rollup_name is not None:
+            queryset: QuerySet = SalesRollup.objects.filter(
+                name=rollup_name,
+                datetime__gte=datetime_from,
+                datetime__lt=datetime_to,
+            )
+            group_kwargs = {d: self.ROLLUP_DIMENSION_MAPPING[d] for d in current_dimensions}
+            aggregates = {m: self.ROLLUP_METRIC_MAPPING[m] for m in current_metrics}
+            queryset = self.apply_filters(queryset, self.ROLLUP_DIMENSION_MAPPING)
+        elif self.is_receipt_level():
+            queryset = Receipt.objects.filter(
+                datetime__gte=datetime_from,
+                datetime__lt=datetime_to,
+            )
+            group_kwargs = {d: self.RECEIPT_DIMENSION_MAPPING[d] for d in current_dimensions}
+            aggregates = {m: self.RECEIPT_METRIC_MAPPING[m] for m in current_metrics}
+            queryset = self.apply_filters(queryset, self.RECEIPT_DIMENSION_MAPPING)
+        else:
+            queryset = CartItem.objects.filter(
+                datetime__gte=datetime_from,
+                datetime__lt=datetime_to,
+            )
+            queryset = self.apply_filters(
+                queryset, self.get_item_dimension_mapping(), self.get_item_date_filter_mapping()
+            )
 
         if current_dimensions:
-            queryset = queryset.annotate(**self.db_group_kwargs)
-            if "brand_name" in self.db_group_kwargs:
+            queryset = queryset.annotate(**group_kwargs)
+            if "brand_name" in group_kwargs:
                 queryset = queryset.exclude(brand_name__isnull=True).exclude(brand_name__exact="")
 
         if current_dimensions and not as_total:
-            queryset = queryset.values(*current_dimensions).annotate(**self.db_aggregates)
-            df = pd.DataFrame(list(queryset))
-        else:
-            agg_result = queryset.aggregate(**self.db_aggregates)
-            if any(val is not None for val in agg_result.values()):
-                df = pd.DataFrame([agg_result])
+            queryset = queryset.values(*current_dimensions).annotate(**aggregates)
+
+        return queryset, aggregates
+
+    def get_dataframe(
+        self, date_from: datetime.date, date_to: datetime.date, as_total: bool = False, refresh: bool = False
+    ) -> pd.DataFrame:
+        if self.uses_intraday(date_from, date_to):
+            return self._get_intraday_dataframe(date_from, as_total)
+
+        current_dimensions = list(self.db_group_kwargs.keys())
+        current_metrics = list(self.db_aggregates.keys())
+        cache_key = self.get_cache_key(date_from, date_to, as_total)
+
+        prefetched = _prefetched_dataframes.get()
+        if prefetched is not None and cache_key in prefetched:
+            return prefetched[cache_key]
+
+        if not refresh:
+            with timed("cache_get"):
+                cached_df = cache.get(cache_key)
+            record_cache_lookup(cached_df is not None)
+            if cached_df is not None:
+                record_rows(len(cached_df))
+                self.memory_budget.charge(cached_df)
+                return cached_df
+
+        with analytics_reads(), guarded_queries(), query_tags(current_dimensions, current_metrics):
+            queryset, aggregates = self.build_queryset(date_from, date_to, as_total)
+            sample_percent = None if queryset.model is SalesRollup else self.get_sample_percent(date_from, date_to)
+
+            if queryset.model is not SalesRollup and self.uses_columnar(date_to):
+                with timed("duckdb"):
+                    df = get_columnar_dataframe(
+                        current_dimensions, current_metrics, date_from, date_to, as_total, self.filters
+                    )
+                self.memory_budget.charge(df)
+            elif sample_percent is not None:
+                with timed("sql"):
+                    df = self._get_sampled_dataframe(date_from, date_to, as_total, sample_percent)
+                self.memory_budget.charge(df)
+            elif current_dimensions and not as_total:
+                # Rows are streamed from a server-side cursor and compacted chunk by chunk.
+                with timed("sql"):
+                    df = read_dataframe(queryset.iterator(chunk_size=CHUNK_SIZE), current_metrics, self.memory_budget)
             else:
-                df = pd.DataFrame()
+                with timed("sql"):
+                    agg_result = queryset.aggregate(**aggregates)
+                if any(val is not None for val in agg_result.values()):
+                    df = pd.DataFrame([agg_result])
+                else:
+                    df = pd.DataFrame()
+
+        record_rows(len(df))
 
         if not df.empty:
-            cols_to_convert = [col for col in current_metrics if col in df.columns and col not in current_dimensions]
-            if cols_to_convert:
-                df[cols_to_convert] = df[cols_to_convert].astype(float)
+            with timed("dataframe"):
+                df = compact_dataframe(df, [m for m in current_metrics if m not in current_dimensions])
 
             ttl = getattr(settings, "ANALYTICS_CACHE_TTL", 3600)
-            cache.set(cache_key, df, timeout=ttl)
+            with timed("cache_set"):
+                cache.set(cache_key, df, timeout=ttl)
 
         return df
 
+    def _get_sampled_dataframe(
+        self, date_from: datetime.date, date_to: datetime.date, as_total: bool, sample_percent: float
+    ) -> pd.DataFrame:
+        dimensions = [] if as_total else list(self.db_group_kwargs)
+        components = self.get_additive_components()
+
+        # The ungrouped queryset, so that every sampled block can be summed up on its own.
+        queryset, _ = self.build_queryset(date_from, date_to, as_total=True)
+        metric_mapping = self.RECEIPT_METRIC_MAPPING if queryset.model is Receipt else self.METRIC_MAPPING
+        connection = connections[queryset.db]
+        quote = connection.ops.quote_name
+        table = quote(queryset.model._meta.db_table)
+
+        queryset = (
+            queryset.annotate(sample_block=RawSQL(f"({table}.ctid::text::point)[0]", ()))
+            .values(*dimensions, "sample_block")
+            .annotate(**{m: metric_mapping[m] for m in components})
+        )
+        compiler = queryset.query.get_compiler(using=queryset.db)
+        inner_sql, params = compiler.as_sql()
+
+        # Django has no TABLESAMPLE support, so the clause is spliced into the compiled query.
+        seed = getattr(settings, "ANALYTICS_SAMPLE_SEED", 0)
+        inner_sql = inner_sql.replace(
+            f"FROM {table}", f"FROM {table} TABLESAMPLE SYSTEM ({sample_percent}) REPEATABLE ({seed})", 1
+        )
+        select = [quote(d) for d in dimensions]
+        select += [
+            f"SUM({quote(m)}) AS {quote(m)}, SUM({quote(m)} * {quote(m)}) AS {quote(m + '_sumsq')}" for m in components
+        ]
+        sql = f"SELECT {', '.join(select)} FROM ({inner_sql}) AS sample_blocks"
+        if dimensions:
+            sql += f" GROUP BY {', '.join(quote(d) for d in dimensions)}"
+
+        columns, rows = execute_compiled(compiler, sql, params, converted_columns=len(dimensions))
+
+        df = pd.DataFrame(rows, columns=columns).astype({m: float for m in components})
+        df = df[df[list(components)].notna().any(axis=1)].reset_index(drop=True)
+
+        # Blocks are sampled with probability p: the sum scales by 1/p and its variance
+        # is estimated from the squared block totals as (1 - p) / p^2 * sum(T_b^2).
+        fraction = sample_percent / 100
+        for metric in components:
+            df[metric] = df[metric] / fraction
+            sumsq = df.pop(f"{metric}_sumsq").astype(float)
+            df[f"{metric}_ci"] = (self.SAMPLE_Z_SCORE * np.sqrt((1 - fraction) * sumsq) / fraction).round(2)
+
+        return self._finish_combined_dataframe(df, dimensions)
+
+    def get_additive_components(self) -> set[str]:
+        components = {m for m in self.db_aggregates if m in self.ADDITIVE_METRICS}
+        for metric in self.db_aggregates.keys() & self.RATIO_METRICS.keys():
+            components |= self.RATIO_METRICS[metric][1]
+        return components
+
+    def _finish_combined_dataframe(self, df: pd.DataFrame, dimensions: list[str]) -> pd.DataFrame:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for metric in self.db_aggregates.keys() & self.RATIO_METRICS.keys():
+                df[metric] = self.RATIO_METRICS[metric][0](df).replace([np.inf, -np.inf], np.nan).round(2)
+
+        metrics = [m for m in self.db_aggregates]
+        ci_columns = [c for c in self.sample_ci_columns if c in df.columns]
+        return df[[*dimensions, *metrics, *ci_columns]]
+
+    def uses_intraday(self, date_from: datetime.date, date_to: datetime.date) -> bool:
+        today = timezone.localdate()
+        metrics = set(self.db_aggregates)
+        return (
+            date_from <= today <= date_to
+            and bool(metrics)
+            and metrics <= self.ADDITIVE_METRICS | self.RATIO_METRICS.keys()
+            and self.db_group_kwargs.keys() <= self.RECEIPT_DIMENSION_MAPPING.keys()
+            and self.filters.keys() <= self.RECEIPT_DIMENSION_MAPPING.keys()
+            and is_intraday_ready(today)
+        )
+
+    def _get_intraday_dataframe(self, date_from: datetime.date, as_total: bool) -> pd.DataFrame:
+        # The open day comes from the Redis counters; closed days are cacheable, so they go
+        # through get_dataframe (rollups, cache) as sums that can be added to today's.
+        today = timezone.localdate()
+        dimensions = [] if as_total else list(self.db_group_kwargs)
+        components = sorted(self.get_additive_components())
+
+        with timed("intraday"):
+            live = get_intraday_dataframe(today, [*dimensions, *(self.filters.keys() - set(dimensions))], components)
+            if not live.empty:
+                live = self.filter_dataframe(live)[[*dimensions, *components]]
+            frames = [live]
+        if date_from < today:
+            closed = AnalyticsService(
+                list(self.db_group_kwargs), components, approximate=self.approximate, filters=self.filters
+            )
+            frames.append(closed.get_dataframe(date_from, today - datetime.timedelta(days=1), as_total))
+
+        frames = [f for f in frames if not f.empty]
+        if not frames:
+            return pd.DataFrame()
+
+        df = pd.concat(frames, ignore_index=True)
+        if dimensions:
+            df = df.groupby(dimensions, as_index=False, sort=False, observed=True).sum(min_count=1)
+        else:
+            df = df.sum(min_count=1).to_frame().T
+        df[components] = df[components].astype(float)
+
+        record_rows(len(df))
+        return self._finish_combined_dataframe(df, dimensions)
+
+    def estimate_cost(
+        self, date_from: datetime.date, date_to: datetime.date, as_total: bool = False
+    ) -> QueryEstimate | None:
+        with analytics_reads():
+            queryset, _ = self.build_queryset(date_from, date_to, as_total)
+            estimate = explain_estimate(queryset)
+
+        sample_percent = None if queryset.model is SalesRollup else self.get_sample_percent(date_from, date_to)
+        if estimate is not None and sample_percent is not None:
+            estimate = {key: value * sample_percent / 100 for key, value in estimate.items()}
+        return estimate
+
+    def uses_columnar(self, date_to: datetime.date) -> bool:
+        return can_serve(list(self.db_group_kwargs), list(self.db_aggregates), date_to, list(self.filters))
+
+    def is_receipt_level(self) -> bool:
+        metrics = set(self.db_aggregates)
+        return (
+            bool(metrics)
+            and metrics <= self.RECEIPT_METRIC_MAPPING.keys()
+            and self.db_group_kwargs.keys() <= self.RECEIPT_DIMENSION_MAPPING.keys()
+            and self.filters.keys() <= self.RECEIPT_DIMENSION_MAPPING.keys()
+        )
+
+    def match_rollup(self, as_total: bool = False, date_to: datetime.date | None = None) -> str | None:
+        metrics = set(self.db_aggregates)
+        if not metrics or not metrics <= self.ROLLUP_METRIC_MAPPING.keys():
+            return None
+
+        # Filtered dimensions have to be rollup columns too, even when they are not grouped by.
+        dimensions = list(self.db_group_kwargs) + list(self.filters)
+        item_dimensions = get_item_dimensions(dimensions)
+        grouped_item_dimensions = set() if as_total else get_item_dimensions(list(self.db_group_kwargs))
+
+        # Distinct receipts only add up across rollup rows that partition receipts.
+        if metrics & self.ROLLUP_RECEIPT_METRICS and item_dimensions - grouped_item_dimensions - {"shop_name"}:
+            return None
+
+        candidates = []
+        for name, rollup_dimensions in get_rollup_config().items():
+            if get_item_dimensions(rollup_dimensions) != item_dimensions:
+                continue
+            if is_hourly(dimensions) and not is_hourly(rollup_dimensions):
+                continue
+            candidates.append((is_hourly(rollup_dimensions), name))
+
+        if not candidates:
+            return None
+
+        covered_until = get_datetime_bounds(date_to, date_to)[1] if date_to is not None else None
+        fresh_rollups = get_fresh_rollups(covered_until)
+        for _, name in sorted(candidates):
+            if name in fresh_rollups:
+                return name
+        return None
+
     def get_comparison_dataframe(
         self, current_range: DateRangeDict, prev_range: DateRangeDict, as_total: bool = False
     ) -> pd.DataFrame:
 
         df_curr = self.get_dataframe(current_range["from_date"], current_range["to_date"], as_total=as_total)
         df_prev = self.get_dataframe(prev_range["from_date"], prev_range["to_date"], as_total=as_total)
+        df_prev = df_prev.drop(columns=self.sample_ci_columns, errors="ignore")
 
         merge_on = [] if as_total else list(self.db_group_kwargs.keys())
 
-        df_merged = calculate_diffs(
-            df_curr,
-            df_prev,
-            merge_on=merge_on,
-            base_metrics=self.base_metrics,
-            requested_metrics=self.requested_metrics,
-        )
+        with timed("calculate_diffs"):
+            df_merged = calculate_diffs(
+                df_curr,
+                df_prev,
+                merge_on=merge_on,
+                base_metrics=self.base_metrics,
+                requested_metrics=self.requested_metrics,
+            )
+        self.memory_budget.charge(df_merged)
 
         final_columns = self.requested_metrics if as_total else self.requested_dimensions + self.requested_metrics
+        final_columns = final_columns + self.sample_ci_columns
         available_columns = [c for c in final_columns if c in df_merged.columns]
 
         return df_merged[available_columns]
 
-    def generate_plotly_chart(self, df: pd.DataFrame, chart_type: str) -> str:
-        if not self.requested_dimensions:
-            df["x_axis"] = "Всього"
-            x_col = "x_axis"
-        elif len(self.requested_dimensions) > 1:
-            df["x_axis"] = df[self.requested_dimensions].astype(str).agg(" - ".join, axis=1)
-            x_col = "x_axis"
-        else:
-            x_col = self.requested_dimensions[0]
+    def generate_plotly_chart(self, df: pd.DataFrame, chart_type: str, chart_format: str = "html") -> str:
+        with timed("chart"):
+            if not self.requested_dimensions:
+                df["x_axis"] = "Всього"
+                x_col = "x_axis"
+            elif len(self.requested_dimensions) > 1:
+                df["x_axis"] = df[self.requested_dimensions].astype(str).agg(" - ".join, axis=1)
+                x_col = "x_axis"
+            else:
+                x_col = self.requested_dimensions[0]
 
-        y_metrics = [m for m in self.requested_metrics if m in df.columns]
+            y_metrics = [m for m in self.requested_metrics if m in df.columns]
 
-        if chart_type == "Pie Chart":
-            metric = y_metrics[0] if y_metrics else None
-            fig = px.pie(df, names=x_col, values=metric, title=f"Розподіл: {metric}")
+            if chart_type == "Pie Chart":
+                metric = y_metrics[0] if y_metrics else None
+                fig = px.pie(df, names=x_col, values=metric, title=f"Розподіл: {metric}")
 
-        elif chart_type == "Line Chart":
-            fig = px.line(df, x=x_col, y=y_metrics, title="Динаміка показників", markers=True)
+            elif chart_type == "Line Chart":
+                fig = px.line(df, x=x_col, y=y_metrics, title="Динаміка показників", markers=True)
 
-        else:
-            fig = px.bar(df, x=x_col, y=y_metrics, title="Аналітика показників", barmode="group")
+            else:
+                fig = px.bar(df, x=x_col, y=y_metrics, title="Аналітика показників", barmode="group")
+
+            if chart_format == "json":
+                # The figure spec only; plotly encodes numeric columns as base64 typed arrays.
+                return fig.to_json()
+            return fig.to_html(full_html=True, include_plotlyjs="cdn")
+
+
+def get_analytics_dataframe(params: dict, as_total: bool = False) -> pd.DataFrame:
+    service = AnalyticsService.from_params(params)
+    current_range = params["date_range"]
+    prev_range = params.get("prev_date_range")
+
+    if prev_range:
+        return service.get_comparison_dataframe(current_range, prev_range, as_total=as_total)
+    return service.get_dataframe(current_range["from_date"], current_range["to_date"], as_total=as_total)
+
+
+def get_chart_cache_key(params: dict, df: pd.DataFrame) -> str:
+    service = AnalyticsService.from_params(params)
+    current_range = params["date_range"]
+    # Keyed by the data itself, so a refreshed DataFrame never serves a stale chart.
+    payload = {
+        "chart_type": params.get("chart_type", "Bar Chart"),
+        "dimensions": service.requested_dimensions,
+        "metrics": service.requested_metrics,
+        "data": hashlib.md5(pd.util.hash_pandas_object(df, index=False).values.tobytes()).hexdigest(),
+    }
+    data_key = service.get_cache_key(current_range["from_date"], current_range["to_date"])
+    return f"{data_key}:chart:{hashlib.md5(json.dumps(payload, sort_keys=True).encode()).hexdigest()}"
+
+
+def build_chart_json(params: dict) -> bytes:
+    df = get_analytics_dataframe(params)
+    cache_key = get_chart_cache_key(params, df)
+    with timed("cache_get"):
+        body = cache.get(cache_key)
+    if body is not None:
+        return body
+
+    service = AnalyticsService.from_params(params)
+    figure = service.generate_plotly_chart(df, params.get("chart_type", "Bar Chart"), chart_format="json")
+    with timed("gzip"):
+        body = gzip.compress(figure.encode(), compresslevel=6)
+
+    ttl = getattr(settings, "ANALYTICS_CACHE_TTL", 3600)
+    with timed("cache_set"):
+        cache.set(cache_key, body, timeout=ttl)
+    return body
+
+
+def _dataframe_payload(df: pd.DataFrame, layout: str) -> dict:
+    # The DataFrame itself goes into the payload; AnalyticsJSONRenderer serializes it straight to bytes.
+    if layout == "columns":
+        return {"columns": list(df.columns), "data": DataFrameRows(df)}
+    return {"data": df}
+
+
+def build_analytics_payload(params: dict) -> dict:
+    df = get_analytics_dataframe(params)
+    layout = params.get("layout", "records")
+
+    if not params.get("group_by", []):
+        return _dataframe_payload(df, layout)
+
+    response_payload = {}
+    if params.get("total", False):
+        total_df = get_analytics_dataframe(params, as_total=True)
+        with timed("to_dict"):
+            response_payload["total"] = total_df.to_dict(orient="records")[0] if not total_df.empty else {}
+
+    response_payload.update(_dataframe_payload(df, layout))
+    return response_payload
+
+
+def build_excel_report(df: pd.DataFrame, total_df: pd.DataFrame | None = None) -> BytesIO:
+    excel_file = BytesIO()
+    with timed("excel"), pd.ExcelWriter(excel_file, engine="openpyxl") as writer:
+        has_total = total_df is not None and not total_df.empty
+        # A period without sales still gets a (blank) sheet, openpyxl refuses to save a workbook without one.
+        if not df.empty or not has_total:
+            df.to_excel(writer, sheet_name="Analytics", index=False)
+        if has_total:
+            total_df.to_excel(writer, sheet_name="Total", index=False)
+
+    excel_file.seek(0)
+    return excel_file
+
+
+def build_report(params: dict, render_type: str) -> tuple[BytesIO, str, str]:
+    service = AnalyticsService.from_params(params)
+    current_range = params["date_range"]
+    prev_range = params.get("prev_date_range")
+
+    def get_dataframe(as_total: bool = False) -> pd.DataFrame:
+        if prev_range:
+            return service.get_comparison_dataframe(current_range, prev_range, as_total=as_total)
+        return service.get_dataframe(current_range["from_date"], current_range["to_date"], as_total=as_total)
+
+    if render_type == "chart":
+        html = service.generate_plotly_chart(get_dataframe(), params.get("chart_type", "Bar Chart"))
+        return BytesIO(html.encode()), "analytics_report.html", "text/html"
+
+    total_df = get_dataframe(as_total=True) if params.get("total", False) else None
+    return build_excel_report(get_dataframe(), total_df), "analytics_report.xlsx", XLSX_CONTENT_TYPE
+
+
+def estimate_request_cost(params: dict) -> QueryEstimate:
+    # Planner estimate of what is left for the database to do; cached, intraday and DuckDB ranges add nothing.
+    service = AnalyticsService.from_params(params)
+    total: QueryEstimate = {"rows": 0, "cost": 0.0}
+
+    date_ranges = [params["date_range"]]
+    if params.get("prev_date_range"):
+        date_ranges.append(params["prev_date_range"])
+
+    for date_range in date_ranges:
+        date_from, date_to = date_range["from_date"], date_range["to_date"]
+        if date_from >= timezone.localdate() and service.uses_intraday(date_from, date_to):
+            continue
+        if cache.get(service.get_cache_key(date_from, date_to)) is not None:
+            continue
+        # The in-process DuckDB engine does not load the database at all.
+        if service.uses_columnar(date_to):
+            continue
+
+        estimate = service.estimate_cost(date_from, date_to)
+        if estimate is not None:
+            total["rows"] += estimate["rows"]
+            total["cost"] += estimate["cost"]
 
-        return fig.to_html(full_html=True, include_plotlyjs="cdn")
+    return total
+
+
+def exceeds_sync_budget(estimate: QueryEstimate) -> bool:
+    max_rows = getattr(settings, "ANALYTICS_SYNC_MAX_ROWS", 100_000)
+    max_cost = getattr(settings, "ANALYTICS_SYNC_MAX_COST", 1_000_000)
+    return estimate["rows"] > max_rows or estimate["cost"] > max_cost
@@ -0,0 +1,131 @@
+import datetime
+import json
+import logging
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+
+from .instrumentation import timed, track_analytics
+from .models import ReportArtifact, ReportSubscription
+from .reports import get_report_url, store_report
+from .serializers import AnalyticsRequestSerializer
+from .services import AnalyticsService, build_report
+
+logger = logging.getLogger(__name__)
+
+
+def get_subscription_period(frequency: str, today: datetime.date) -> tuple[datetime.date, datetime.date]:
+    # The last complete day, ISO week or calendar month before today.
+    if frequency == ReportSubscription.Frequency.DAILY:
+        day = today - datetime.timedelta(days=1)
+        return day, day
+    if frequency == ReportSubscription.Frequency.WEEKLY:
+        week_start = today - datetime.timedelta(days=today.weekday() + 7)
+        return week_start, week_start + datetime.timedelta(days=6)
+    month_end = today.replace(day=1) - datetime.timedelta(days=1)
+    return month_end.replace(day=1), month_end
+
+
+def get_subscription_params(subscription: ReportSubscription, today: datetime.date) -> dict:
+    date_from, date_to = get_subscription_period(subscription.frequency, today)
+    request_data = {
+        **subscription.request_data,
+        "date_range": {"from_date": date_from, "to_date": date_to},
+        "prev_date_range": None,
+    }
+    if subscription.compare_previous:
+        prev_from, prev_to = get_subscription_period(subscription.frequency, date_from)
+        request_data["prev_date_range"] = {"from_date": prev_from, "to_date": prev_to}
+
+    serializer = AnalyticsRequestSerializer(data=request_data)
+    serializer.is_valid(raise_exception=True)
+    return serializer.validated_data
+
+
+def get_spec_key(params: dict, render_type: str) -> str:
+    # Subscriptions with equal keys get the very same report file.
+    spec = {key: value for key, value in params.items() if key not in {"email", "render_type"}}
+    return json.dumps({**spec, "render_type": render_type}, sort_keys=True, cls=DjangoJSONEncoder)
+
+
+def build_subscription_report(params: dict, render_type: str) -> ReportArtifact:
+    service = AnalyticsService.from_params(params)
+    with track_analytics("celery", render_type, list(service.db_group_kwargs)):
+        content, filename, content_type = build_report(params, render_type)
+        with timed("store"):
+            return store_report(content, filename, content_type)
+
+
+def build_subscription_messages(
+    subscription: ReportSubscription, params: dict, artifact: ReportArtifact
+) -> list[EmailMessage]:
+    current_range = params["date_range"]
+    period = f"{current_range['from_date']:%d.%m.%Y} – {current_range['to_date']:%d.%m.%Y}"
+    body = f"Звіт «{subscription.name}» за {period} готовий. Завантажити його можна за посиланням: {get_report_url(artifact)}"
+    # One message per recipient, so subscribers never see each other's addresses.
+    return [
+        EmailMessage(
+            subject=f"{subscription.name} ({period})",
+            body=body,
+            from_email=settings.DEFAULT_FROM_EMAIL,
+            to=[recipient],
+        )
+        for recipient in subscription.recipients
+    ]
+
+
+def send_due_subscriptions(today: datetime.date | None = None) -> tuple[int, int]:
+    today = today or timezone.localdate()
+    batch_size = getattr(settings, "ANALYTICS_SUBSCRIPTION_EMAIL_BATCH", 50)
+
+    due = []
+    for subscription in ReportSubscription.objects.filter(is_active=True).order_by("id"):
+        period_start, _ = get_subscription_period(subscription.frequency, today)
+        # A run missed by beat is caught up by the next one; a sent period is never sent again.
+        if subscription.last_period_start is not None and subscription.last_period_start >= period_start:
+            continue
+        try:
+            params = get_subscription_params(subscription, today)
+        except ValidationError:
+            logger.warning("Skipping invalid report subscription %s", subscription.id, exc_info=True)
+            continue
+        due.append((subscription, params, period_start))
+
+    artifacts: dict[str, ReportArtifact | None] = {}
+    batch: list[EmailMessage] = []
+    batch_subscriptions: list[tuple[ReportSubscription, datetime.date]] = []
+    sent = 0
+
+    def flush(connection) -> None:
+        nonlocal batch, batch_subscriptions, sent
+        if batch:
+            with timed("email"):
+                sent += connection.send_messages(batch)
+        for subscription, period_start in batch_subscriptions:
+            subscription.last_period_start = period_start
+            subscription.save(update_fields=["last_period_start"])
+        batch, batch_subscriptions = [], []
+
+    # One SMTP session for the whole run instead of a connection per email.
+    with get_connection() as connection:
+        for subscription, params, period_start in due:
+            key = get_spec_key(params, subscription.render_type)
+            if key not in artifacts:
+                try:
+                    artifacts[key] = build_subscription_report(params, subscription.render_type)
+                except Exception:
+                    logger.exception("Could not build report for subscription %s", subscription.id)
+                    artifacts[key] = None
+            if artifacts[key] is None:
+                continue
+
+            batch.extend(build_subscription_messages(subscription, params, artifacts[key]))
+            batch_subscriptions.append((subscription, period_start))
+            if len(batch) >= batch_size:
+                flush(connection)
+        flush(connection)
+
+    return len({key for key, artifact in artifacts.items() if artifact is not None}), sent
@@ -1,94 +1,187 @@
-import pandas as pd
-from io import BytesIO
-from celery import shared_task
+from celery import chord, shared_task
+from django.core.cache import cache
 from django.core.mail import EmailMessage
 from django.conf import settings
-
-from .services import AnalyticsService
+from django.utils import timezone
+
+from .columnar import is_columnar_engine, sync_columnar_snapshot
+from .instrumentation import timed, track_analytics
+from .intraday import rebuild_intraday_counters
+from .querylog import collect_query_stats
+from .reports import delete_expired_reports, get_report_url, store_report
+from .rollups import get_rollup_config, refresh_rollup
+from .services import (
+    AnalyticsService,
+    build_analytics_payload,
+    build_chart_json,
+    build_report,
+    get_analytics_dataframe,
+)
 from .serializers import AnalyticsRequestSerializer
+from .subscriptions import send_due_subscriptions
+from .utils import get_analytics_job_key
+from .warming import warm_popular_requests
 
+# Exports, background jobs and full rebuilds; the statement timeout of their queries is shorter still.
+BULK_SOFT_TIME_LIMIT = 20 * 60
+BULK_TIME_LIMIT = 21 * 60
 
-@shared_task
+
+@shared_task(soft_time_limit=BULK_SOFT_TIME_LIMIT, time_limit=BULK_TIME_LIMIT)
 def generate_and_send_excel_task(request_data: dict):
     serializer = AnalyticsRequestSerializer(data=request_data)
     serializer.is_valid(raise_exception=True)
     params = serializer.validated_data
-
-    group_by = params.get("group_by", [])
-    metrics = params.get("metrics", [])
-    include_total = params.get("total", False)
-    current_range = params["date_range"]
-    prev_range = params.get("prev_date_range")
     email_to = params.get("email")
 
-    service = AnalyticsService(dimensions=group_by, metrics=metrics)
+    service = AnalyticsService.from_params(params)
 
-    if prev_range:
-        df = service.get_comparison_dataframe(current_range, prev_range)
-        total_df = (
-            service.get_comparison_dataframe(current_range, prev_range, as_total=True)
-            if include_total
-            else pd.DataFrame()
-        )
-    else:
-        df = service.get_dataframe(current_range["from_date"], current_range["to_date"])
-        total_df = (
-            service.get_dataframe(current_range["from_date"], current_range["to_date"], as_total=True)
-            if include_total
-            else pd.DataFrame()
+    with track_analytics("celery", "excel", list(service.db_group_kwargs)):
+        content, filename, content_type = build_report(params, "excel")
+        with timed("store"):
+            artifact = store_report(content, filename, content_type)
+
+        subject = "Аналітичний звіт (DataBuilder)"
+        body = f"Привіт! Твій звіт у форматі Excel готовий. Завантажити його можна за посиланням: {get_report_url(artifact)}"
+
+        email = EmailMessage(
+            subject=subject,
+            body=body,
+            from_email=settings.DEFAULT_FROM_EMAIL,  # Або вкажи тут свою адресу, наприклад 'noreply@databuilder.com'
+            to=[email_to],
         )
+        with timed("email"):
+            email.send()
 
-    excel_file = BytesIO()
-    with pd.ExcelWriter(excel_file, engine="openpyxl") as writer:
-        if not df.empty:
-            df.to_excel(writer, sheet_name="Analytics", index=False)
-        if include_total and not total_df.empty:
-            total_df.to_excel(writer, sheet_name="Total", index=False)
+    return f"Report sent to {email_to}"
 
-    excel_file.seek(0)
 
-    subject = "Аналітичний звіт (DataBuilder)"
-    body = "Привіт! Твій звіт у форматі Excel готовий. Файл прикріплено до цього листа."
+@shared_task(soft_time_limit=BULK_SOFT_TIME_LIMIT, time_limit=BULK_TIME_LIMIT)
+def generate_and_send_chart_task(request_data, email):
+    serializer = AnalyticsRequestSerializer(data=request_data)
+    serializer.is_valid(raise_exception=True)
+    params = serializer.validated_data
 
-    email = EmailMessage(
-        subject=subject,
-        body=body,
-        from_email=settings.DEFAULT_FROM_EMAIL,  # Або вкажи тут свою адресу, наприклад 'noreply@databuilder.com'
-        to=[email_to],
-    )
+    service = AnalyticsService.from_params(params)
 
-    email.attach(
-        "analytics_report.xlsx", excel_file.read(), "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-    )
-    email.send()
+    with track_analytics("celery", "chart", list(service.db_group_kwargs)):
+        chart_type = params.get("chart_type", "Bar Chart")
+        content, filename, content_type = build_report(params, "chart")
 
-    return f"Report sent to {email_to}"
+        with timed("store"):
+            artifact = store_report(content, filename, content_type)
 
+        email_msg = EmailMessage(
+            subject=f"Аналітичний звіт ({chart_type})",
+            body=f"Звіт згенеровано. Інтерактивний графік доступний за посиланням: {get_report_url(artifact)}",
+            from_email=settings.DEFAULT_FROM_EMAIL,
+            to=[email],
+        )
+        with timed("email"):
+            email_msg.send()
 
-@shared_task
-def generate_and_send_chart_task(request_data, email):
+
+@shared_task(bind=True, soft_time_limit=BULK_SOFT_TIME_LIMIT, time_limit=BULK_TIME_LIMIT)
+def generate_analytics_task(self, request_data: dict, user_id: int | None = None):
     serializer = AnalyticsRequestSerializer(data=request_data)
     serializer.is_valid(raise_exception=True)
     params = serializer.validated_data
-
     service = AnalyticsService(dimensions=params.get("group_by", []), metrics=params.get("metrics", []))
 
-    current_range = params.get("date_range")
-    prev_range = params.get("prev_date_range")
-
-    if prev_range:
-        df = service.get_comparison_dataframe(current_range=current_range, prev_range=prev_range)
-    else:
-        df = service.get_dataframe(date_from=current_range["from_date"], date_to=current_range["to_date"])
-
-    chart_type = params.get("chart_type", "Bar Chart")
-    html_content = service.generate_plotly_chart(df, chart_type)
-
-    email_msg = EmailMessage(
-        subject=f"Аналітичний звіт ({chart_type})",
-        body="Звіт згенеровано. Інтерактивний графік у вкладенні.",
-        from_email=settings.DEFAULT_FROM_EMAIL,
-        to=[email],
-    )
-    email_msg.attach("analytics_report.html", html_content, "text/html")
-    email_msg.send()
+    with track_analytics("celery", params.get("render_type"), list(service.db_group_kwargs)):
+        if params.get("render_type") == "chart" and params.get("chart_format") == "json":
+            result = {"render_type": "chart", "chart_format": "json", "content": build_chart_json(params)}
+        elif params.get("render_type") == "chart":
+            df = get_analytics_dataframe(params)
+            result = {
+                "render_type": "chart",
+                "content": service.generate_plotly_chart(df, params.get("chart_type", "Bar Chart")),
+            }
+        else:
+            result = {"render_type": "json", "content": build_analytics_payload(params)}
+
+    result["user_id"] = user_id
+    ttl = getattr(settings, "ANALYTICS_JOB_RESULT_TTL", 60 * 60)
+    cache.set(get_analytics_job_key(self.request.id), result, timeout=ttl)
+
+    return f"Analytics job {self.request.id} finished"
+
+
+@shared_task
+def refresh_analytics_rollups_task(full: bool = False):
+    names = list(get_rollup_config())
+    chord(refresh_analytics_rollup_task.s(name, full) for name in names)(warm_analytics_cache_task.si())
+    return f"Scheduled refresh of {len(names)} rollups"
+
+
+@shared_task(soft_time_limit=BULK_SOFT_TIME_LIMIT, time_limit=BULK_TIME_LIMIT)
+def refresh_analytics_rollup_task(name: str, full: bool = False):
+    lock_key = f"analytics:rollup-refresh:{name}"
+    lock_timeout = getattr(settings, "ANALYTICS_ROLLUP_REFRESH_LOCK_TIMEOUT", 30 * 60)
+    if not cache.add(lock_key, 1, timeout=lock_timeout):
+        return f"Rollup {name} is already being refreshed"
+
+    try:
+        refresh = refresh_rollup(name, full=full)
+    finally:
+        cache.delete(lock_key)
+
+    return f"Rollup {name} refreshed: {refresh.rows} rows in {refresh.duration.total_seconds():.2f}s"
+
+
+@shared_task
+def warm_analytics_cache_task():
+    lock_key = "analytics:cache-warm"
+    if not cache.add(lock_key, 1, timeout=getattr(settings, "ANALYTICS_WARM_BUDGET", 120) * 2):
+        return "Analytics cache is already being warmed"
+
+    try:
+        requests_warmed, dataframes_warmed = warm_popular_requests()
+    finally:
+        cache.delete(lock_key)
+
+    return f"Warmed {dataframes_warmed} dataframes for {requests_warmed} popular requests"
+
+
+def schedule_rollup_refresh() -> None:
+    # Ingestion calls this after every batch, so rollups catch up within a debounce instead of a beat interval.
+    delay = getattr(settings, "ANALYTICS_ROLLUP_REFRESH_DEBOUNCE", 60)
+    if cache.add("analytics:rollup-refresh-scheduled", 1, timeout=delay):
+        refresh_analytics_rollups_task.apply_async(countdown=delay)
+
+
+def schedule_cache_warming() -> None:
+    # Ingestion calls this after every batch; bursts of batches collapse into one warm-up.
+    delay = getattr(settings, "ANALYTICS_WARM_DEBOUNCE", 60)
+    if cache.add("analytics:cache-warm-scheduled", 1, timeout=delay):
+        warm_analytics_cache_task.apply_async(countdown=delay)
+
+
+@shared_task
+def delete_expired_reports_task():
+    return f"Deleted {delete_expired_reports()} expired reports"
+
+
+@shared_task
+def rebuild_intraday_counters_task():
+    today = timezone.localdate()
+    rebuild_intraday_counters(today)
+    return f"Intraday counters for {today} rebuilt"
+
+
+@shared_task(soft_time_limit=BULK_SOFT_TIME_LIMIT, time_limit=BULK_TIME_LIMIT)
+def sync_columnar_snapshot_task():
+    if not is_columnar_engine():
+        return "Columnar engine is disabled"
+    return f"Exported {len(sync_columnar_snapshot())} days to the columnar snapshot"
+
+
+@shared_task(soft_time_limit=BULK_SOFT_TIME_LIMIT, time_limit=BULK_TIME_LIMIT)
+def send_report_subscriptions_task():
+    reports, emails = send_due_subscriptions()
+    return f"Sent {emails} emails for {reports} distinct subscription reports"
+
+
+@shared_task
+def collect_query_stats_task():
+    return f"Collected stats of {collect_query_stats()} query fingerprints"
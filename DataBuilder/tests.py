@@ -1,10 +1,57 @@
+import datetime
+import gzip
+import json
+import logging
+import re
+import socket
+import threading
+import time
+from io import StringIO
+from types import SimpleNamespace
+
 import pytest
+import pandas as pd
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import OperationalError, connection, connections
+from django.db.models import Sum
+from django.test import RequestFactory
 from django.utils import timezone
 from unittest.mock import patch
+from rest_framework.renderers import JSONRenderer
 from rest_framework.test import APIClient
 from django.contrib.auth import get_user_model
+from django_redis import get_redis_connection
+from Config.celery import record_queue_wait, stamp_published_at
 
-from DataBuilder.models import Shop, Brand, Product, Receipt, CartItem
+from DataBuilder.etags import bump_data_version
+from DataBuilder.ingestion import ingest_receipts
+from DataBuilder.intraday import rebuild_intraday_counters
+from DataBuilder.limits import ClientClosedRequest, QueryTimeout, guarded_queries, query_slot, request_limits
+from DataBuilder.queues import get_estimate_queue, route_task
+from DataBuilder.profiling import profile_call
+from DataBuilder.querylog import QUERY_STATS_KEY_PREFIX, collect_query_stats, get_fingerprint, query_stats
+from DataBuilder.models import (
+    AnalyticsProfile,
+    Shop,
+    Brand,
+    Product,
+    QueryFingerprint,
+    Receipt,
+    CartItem,
+    ReportArtifact,
+    ReportSubscription,
+    SalesRollup,
+)
+from DataBuilder.rollups import refresh_rollup
+from DataBuilder.routers import AnalyticsReplicaRouter, analytics_reads
+from DataBuilder.batching import run_shared_scan
+from DataBuilder.serializers import AnalyticsRequestSerializer
+from DataBuilder.services import AnalyticsService, build_chart_json, get_analytics_dataframe
+from DataBuilder.subscriptions import send_due_subscriptions
+from DataBuilder.warming import get_popular_requests, get_usage_key, normalize_request, record_analytics_usage
+from DataBuilder.tasks import generate_analytics_task, generate_and_send_chart_task, warm_analytics_cache_task
+from DataBuilder.utils import get_analytics_job_owner_key
 
 User = get_user_model()
 
@@ -41,6 +88,13 @@ def api_client(setup_db_data):
     return client
 
 
+@pytest.fixture
+def clear_cache():
+    cache.clear()
+    yield
+    cache.clear()
+
+
 @pytest.fixture
 def base_payload():
     return {
@@ -69,7 +123,7 @@ def test_analytics_returns_chart_html(api_client, base_payload):
 
 
 @pytest.mark.django_db
-@patch("DataBuilder.tasks.generate_and_send_chart_task.delay")
+@patch("DataBuilder.tasks.generate_and_send_chart_task.apply_async")
 def test_analytics_triggers_chart_celery_task(mock_chart_task, api_client, base_payload):
     payload = base_payload.copy()
     payload["render_type"] = "chart"
@@ -81,7 +135,7 @@ def test_analytics_triggers_chart_celery_task(mock_chart_task, api_client, base_
 
 
 @pytest.mark.django_db
-@patch("DataBuilder.tasks.generate_and_send_excel_task.delay")
+@patch("DataBuilder.tasks.generate_and_send_excel_task.apply_async")
 def test_analytics_triggers_excel_celery_task(mock_excel_task, api_client, base_payload):
     payload = base_payload.copy()
     payload["render_type"] = "excel"
@@ -90,3 +144,891 @@ def test_analytics_triggers_excel_celery_task(mock_excel_task, api_client, base_
     response = api_client.post("/api/analytics/get-analytics/", payload, format="json")
     assert response.status_code == 202
     mock_excel_task.assert_called_once()
+    assert mock_excel_task.call_args.kwargs["queue"] == "analytics"
+
+    # Without an estimate an export goes to its fixed queue instead of failing the request.
+    with patch("DataBuilder.queues.estimate_request_cost", side_effect=OperationalError("replica gone")):
+        response = api_client.post("/api/analytics/get-analytics/", payload, format="json")
+    assert response.status_code == 202
+    assert mock_excel_task.call_args.kwargs["queue"] == "reports"
+
+
+@pytest.mark.django_db
+@patch("DataBuilder.tasks.generate_and_send_chart_task.apply_async")
+def test_heavy_chart_email_goes_to_bulk_queue(mock_chart_task, api_client, base_payload, settings, clear_cache):
+    settings.ANALYTICS_BULK_TASK_MIN_ROWS = 0
+    payload = {**base_payload, "group_by": ["product_name", "hour"], "render_type": "chart", "email": "a@example.com"}
+
+    response = api_client.post("/api/analytics/get-analytics/", payload, format="json")
+    assert response.status_code == 202
+    assert mock_chart_task.call_args.kwargs == {"args": [payload, "a@example.com"], "queue": "reports"}
+
+
+def add_sale(product: Product, sold_at: datetime.datetime, total_price: float = 100.00) -> CartItem:
+    receipt = Receipt.objects.create(
+        shop=Shop.objects.get(), datetime=sold_at, total_price=total_price, margin_price_total=20.00, refund=False
+    )
+    return CartItem.objects.create(
+        receipt=receipt,
+        product=product,
+        datetime=sold_at,
+        price=total_price,
+        original_price=total_price,
+        qty=1,
+        total_price=total_price,
+        margin_price_total=20.00,
+    )
+
+
+@pytest.mark.django_db
+def test_rollup_serves_same_result_as_cart_items(setup_db_data, clear_cache):
+    today = timezone.localdate()
+    yesterday = today - datetime.timedelta(days=1)
+    add_sale(Product.objects.get(), timezone.now() - datetime.timedelta(days=1))
+    service = AnalyticsService(
+        dimensions=["shop_name", "month_year"], metrics=["turnover", "checks_count", "avg_check"]
+    )
+    assert service.match_rollup() is None
+    raw_df = service.get_dataframe(yesterday, yesterday)
+    assert len(raw_df) == 1
+
+    refresh = refresh_rollup("shop_month")
+    cache.clear()
+
+    assert refresh.rows == 2
+    assert service.match_rollup(date_to=yesterday) == "shop_month"
+    # Today may still be selling, so it is read from the cart items.
+    assert service.match_rollup(date_to=today) is None
+    pd.testing.assert_frame_equal(service.get_dataframe(yesterday, yesterday), raw_df, check_like=True)
+
+
+@pytest.mark.django_db
+def test_rollup_refresh_rebuilds_only_new_days(setup_db_data, clear_cache):
+    product = Product.objects.get()
+    add_sale(product, timezone.now() - datetime.timedelta(days=2))
+    refresh_rollup("daily_total")
+    old_day = SalesRollup.objects.get(
+        name="daily_total", datetime__date=timezone.localdate() - datetime.timedelta(days=2)
+    )
+
+    add_sale(product, timezone.now(), total_price=50.00)
+    refresh = refresh_rollup("daily_total")
+
+    assert refresh.rows == 1
+    assert SalesRollup.objects.filter(pk=old_day.pk).exists()
+    today_row = SalesRollup.objects.get(name="daily_total", datetime__date=timezone.localdate())
+    assert today_row.total_price == 200
+    assert today_row.receipts_count == 2
+
+
+@pytest.mark.django_db
+def test_rollup_refresh_picks_up_backdated_sales(setup_db_data, clear_cache):
+    product = Product.objects.get()
+    refresh_rollup("daily_total")
+
+    backdated = add_sale(product, timezone.now() - datetime.timedelta(days=5), total_price=40.00)
+    refresh = refresh_rollup("daily_total")
+
+    assert refresh.rows == 2
+    rolled_up = SalesRollup.objects.filter(name="daily_total").aggregate(total=Sum("total_price"))["total"]
+    assert rolled_up == CartItem.objects.aggregate(total=Sum("total_price"))["total"]
+    assert SalesRollup.objects.get(name="daily_total", datetime__date=timezone.localtime(backdated.datetime).date())
+    assert refresh_rollup("daily_total").rows == 0
+
+
+@pytest.mark.django_db
+@patch("DataBuilder.tasks.refresh_analytics_rollups_task.apply_async")
+def test_ingestion_schedules_rollup_refresh(
+    mock_refresh, setup_db_data, clear_cache, django_capture_on_commit_callbacks
+):
+    with django_capture_on_commit_callbacks(execute=True):
+        with patch("DataBuilder.tasks.warm_analytics_cache_task.apply_async"):
+            ingest_receipts([])
+            ingest_receipts([])
+
+    mock_refresh.assert_called_once_with(countdown=60)
+
+
+@pytest.mark.django_db
+@patch("DataBuilder.viewsets.generate_analytics_task.apply_async")
+def test_analytics_over_budget_is_queued(mock_task, api_client, setup_db_data, base_payload, clear_cache, settings):
+    settings.ANALYTICS_SYNC_MAX_ROWS = 0
+
+    response = api_client.post("/api/analytics/get-analytics/", base_payload, format="json")
+    assert response.status_code == 202
+    job_id = response.json()["job_id"]
+    assert response.json()["status_url"].endswith(f"/api/analytics/jobs/{job_id}/")
+    assert mock_task.call_args.kwargs["task_id"] == job_id
+    assert mock_task.call_args.kwargs["queue"] == "analytics"
+    assert cache.get(get_analytics_job_owner_key(job_id)) == setup_db_data.id
+
+
+@pytest.mark.django_db
+def test_analytics_job_result_is_polled(api_client, setup_db_data, base_payload, clear_cache):
+    cache.set(get_analytics_job_owner_key("job-2"), setup_db_data.id)
+    generate_analytics_task.apply(args=[base_payload, setup_db_data.id], task_id="job-2")
+
+    response = api_client.get("/api/analytics/jobs/job-2/")
+    assert response.status_code == 200
+    assert response.json()["data"][0]["shop_name"] == "Тестовий Магазин"
+
+
+@pytest.mark.django_db
+@patch("DataBuilder.viewsets.AsyncResult")
+def test_analytics_job_of_another_user_is_not_found(mock_result, api_client, setup_db_data, clear_cache):
+    other = User.objects.create_user(username="other", password="password123")
+    cache.set(get_analytics_job_owner_key("job-3"), other.id)
+
+    assert api_client.get("/api/analytics/jobs/job-3/").status_code == 404
+    assert api_client.get("/api/analytics/jobs/unknown/").status_code == 404
+    mock_result.assert_not_called()
+
+
+@pytest.mark.django_db
+def test_analytics_reports_server_timing(api_client, base_payload, clear_cache):
+    response = api_client.post("/api/analytics/get-analytics/", base_payload, format="json")
+    assert response.status_code == 200
+
+    server_timing = response["Server-Timing"]
+    assert "sql;dur=" in server_timing
+    assert 'cache;desc="hit=0 miss=1"' in server_timing
+    assert 'rows;desc="1"' in server_timing
+
+
+@pytest.mark.django_db
+def test_metrics_endpoint_exposes_request_histogram(api_client, admin_client, base_payload, clear_cache, settings):
+    api_client.post("/api/analytics/get-analytics/", base_payload, format="json")
+    assert api_client.get("/metrics").status_code == 403
+
+    response = admin_client.get("/metrics")
+    assert response.status_code == 200
+    assert 'analytics_request_duration_seconds_count{dimensions="shop_name",render_type="json",source="web"}' in (
+        response.content.decode()
+    )
+
+    settings.METRICS_AUTH_TOKEN = "scrape-token"
+    assert admin_client.get("/metrics").status_code == 401
+    assert api_client.get("/metrics", headers={"Authorization": "Bearer scrape-token"}).status_code == 200
+
+
+@pytest.mark.django_db
+def test_analytics_profile_is_staff_only(api_client, setup_db_data, base_payload, clear_cache):
+    response = api_client.post("/api/analytics/get-analytics/?profile=1", base_payload, format="json")
+    assert response.status_code == 403
+
+    setup_db_data.is_staff = True
+    setup_db_data.save()
+
+    response = api_client.post("/api/analytics/get-analytics/?profile=1", base_payload, format="json")
+    assert response.status_code == 200
+    body = response.json()
+    assert body["result"]["data"][0]["turnover"] == 150.0
+    assert body["profile"]["queries"][0]["plan"][0]["Plan"]
+    assert "pandas" in body["profile"]["libraries_ms"]
+    assert AnalyticsProfile.objects.filter(id=body["profile_id"]).exists()
+
+    query = "metrics=turnover&group_by=shop_name&from_date=2020-01-01&to_date=2026-12-31&profile=1"
+    response = api_client.get(f"/api/analytics/get-analytics/?{query}")
+    assert response.status_code == 200
+    assert AnalyticsProfile.objects.get(id=response.json()["profile_id"]).request_data["metrics"] == ["turnover"]
+
+
+@pytest.mark.django_db
+def test_analytics_profile_runs_under_request_limits(api_client, setup_db_data, base_payload, clear_cache):
+    setup_db_data.is_staff = True
+    setup_db_data.save()
+
+    with patch("DataBuilder.limits.query_slot", wraps=query_slot) as slot:
+        response = api_client.post("/api/analytics/get-analytics/?profile=1", base_payload, format="json")
+    assert response.status_code == 200
+    slot.assert_called_with(f"user:{setup_db_data.pk}")
+
+
+@pytest.mark.django_db
+def test_analytics_profile_follows_chart_json_path(api_client, setup_db_data, base_payload, clear_cache):
+    setup_db_data.is_staff = True
+    setup_db_data.save()
+    payload = {**base_payload, "render_type": "chart", "chart_format": "json"}
+
+    with patch("DataBuilder.viewsets.build_chart_json", wraps=build_chart_json) as chart_json:
+        response = api_client.post("/api/analytics/get-analytics/?profile=1", payload, format="json")
+    assert response.status_code == 200
+    assert response.json()["result"] is None
+    chart_json.assert_called_once()
+
+
+@pytest.fixture
+def replica_database(db, settings):
+    # A second connection to the test database; connected before it is registered, so the test case allows it.
+    default = connections["default"]
+    replica = default.__class__(default.settings_dict.copy(), alias="replica")
+    connections["replica"] = replica
+    replica.ensure_connection()
+    connections.settings["replica"] = replica.settings_dict
+    settings.ANALYTICS_DATABASE = "replica"
+    with patch("DataBuilder.routers.get_replica_lag", return_value=0.0):
+        yield replica
+    replica.close()
+    if hasattr(replica, "close_pool"):
+        replica.close_pool()
+    del connections["replica"]
+    del connections.settings["replica"]
+
+
+@pytest.mark.django_db
+def test_analytics_profile_explains_queries_on_replica(replica_database):
+    def read_shops():
+        with analytics_reads():
+            return list(Shop.objects.values_list("name", flat=True))
+
+    _, report = profile_call(read_shops)
+
+    assert report["queries"][0]["database"] == "replica"
+    assert report["queries"][0]["plan"][0]["Plan"]
+
+
+@pytest.mark.django_db
+def test_generate_sales_creates_consistent_receipts():
+    call_command(
+        "generate_sales", items=300, shops=3, brands=4, products=20, days=10, batch_size=100, stdout=StringIO()
+    )
+
+    assert CartItem.objects.count() == 300
+    assert Shop.objects.count() == 3
+    receipt = Receipt.objects.annotate(items_total=Sum("cartitem__total_price")).first()
+    assert receipt.total_price == receipt.items_total
+
+
+@pytest.mark.django_db
+def test_benchmark_analytics_saves_results(tmp_path):
+    call_command("generate_sales", items=100, shops=2, brands=2, products=5, days=5, stdout=StringIO())
+
+    call_command(
+        "benchmark_analytics",
+        dimensions=["shop_name"],
+        metrics=["turnover"],
+        repeat=1,
+        output_dir=tmp_path,
+        stdout=StringIO(),
+    )
+
+    [result_file] = tmp_path.glob("*.json")
+    run = json.loads(result_file.read_text())
+    assert {r["operation"] for r in run["results"]} == {"dataframe", "comparison", "chart", "excel"}
+
+
+@pytest.mark.parametrize("lag, expected", [(2.0, "replica"), (120.0, "default"), (None, "default")])
+def test_analytics_reads_use_replica_only_when_fresh(settings, lag, expected):
+    settings.ANALYTICS_DATABASE = "replica"
+    settings.ANALYTICS_REPLICA_MAX_LAG = 30
+    router = AnalyticsReplicaRouter()
+
+    with patch("DataBuilder.routers.get_replica_lag", return_value=lag):
+        assert router.db_for_read(CartItem) is None
+        with analytics_reads():
+            assert router.db_for_read(CartItem) == expected
+
+    assert router.allow_migrate("replica", "DataBuilder") is False
+
+
+@pytest.mark.django_db
+def test_popular_requests_are_warmed_with_fresh_data(api_client, setup_db_data, clear_cache):
+    today = timezone.localdate()
+    payload = {
+        "metrics": ["turnover"],
+        "group_by": ["shop_name"],
+        "date_range": {"from_date": (today - datetime.timedelta(days=6)).isoformat(), "to_date": today.isoformat()},
+    }
+    response = api_client.post("/api/analytics/get-analytics/", payload, format="json")
+    assert response.json()["data"][0]["turnover"] == 150.0
+
+    receipt = Receipt.objects.get()
+    Receipt.objects.filter(id=receipt.id).update(total_price=200.00)
+    CartItem.objects.create(
+        receipt=receipt,
+        product=Product.objects.get(),
+        datetime=receipt.datetime,
+        price=50.00,
+        original_price=50.00,
+        qty=1,
+        total_price=50.00,
+        margin_price_total=10.00,
+    )
+    warm_analytics_cache_task.apply()
+
+    response = api_client.post("/api/analytics/get-analytics/", payload, format="json")
+    assert response.json()["data"][0]["turnover"] == 200.0
+    assert 'cache;desc="hit=1 miss=0"' in response["Server-Timing"]
+
+
+@pytest.mark.django_db
+def test_popular_requests_fade_with_age(setup_db_data, clear_cache):
+    today = timezone.localdate()
+
+    def params(group_by: list[str]) -> dict:
+        return {"metrics": ["turnover"], "group_by": group_by, "date_range": {"from_date": today, "to_date": today}}
+
+    redis = get_redis_connection("default")
+    old_favourite = json.dumps(normalize_request(params(["brand_name"])), sort_keys=True)
+    redis.zincrby(get_usage_key(today - datetime.timedelta(days=10)), 10, old_favourite)
+    redis.zincrby(get_usage_key(today - datetime.timedelta(days=30)), 500, old_favourite)
+    for _ in range(3):
+        record_analytics_usage(params(["shop_name"]))
+
+    assert [spec["group_by"] for spec in get_popular_requests(2)] == [["shop_name"], ["brand_name"]]
+
+
+@pytest.mark.django_db
+def test_receipt_level_requests_are_served_from_receipts(setup_db_data, clear_cache):
+    today = timezone.localdate()
+    service = AnalyticsService(dimensions=["shop_name", "hour"], metrics=["turnover", "checks_count", "avg_check"])
+    assert service.is_receipt_level()
+    assert not AnalyticsService(dimensions=["brand_name"], metrics=["turnover"]).is_receipt_level()
+    assert not AnalyticsService(dimensions=["shop_name"], metrics=["sales_qty"]).is_receipt_level()
+
+    queryset, _ = service.build_queryset(today, today)
+    assert queryset.model is Receipt
+    assert "DISTINCT" not in str(queryset.query)
+
+    df = service.get_dataframe(today, today)
+    assert df.loc[0, "turnover"] == 150.0
+    assert df.loc[0, "checks_count"] == 1
+    assert df.loc[0, "avg_check"] == 150.0
+
+
+@pytest.mark.django_db
+def test_approximate_mode_scales_sampled_totals(settings, clear_cache):
+    call_command("generate_sales", items=20_000, shops=3, brands=5, products=50, days=100, stdout=StringIO())
+    settings.ANALYTICS_SAMPLE_EXACT_DAYS = 10
+    today = timezone.localdate()
+    date_from = today - datetime.timedelta(days=99)
+
+    exact = AnalyticsService(dimensions=["shop_name"], metrics=["turnover", "avg_check"])
+    approximate = AnalyticsService(dimensions=["shop_name"], metrics=["turnover", "avg_check"], approximate=True)
+    assert approximate.get_sample_percent(date_from, today) == 10.0
+    assert approximate.get_cache_key(date_from, today) != exact.get_cache_key(date_from, today)
+
+    exact_total = exact.get_dataframe(date_from, today, as_total=True).loc[0, "turnover"]
+    sampled = approximate.get_dataframe(date_from, today, as_total=True)
+    assert 0 < sampled.loc[0, "turnover_ci"]
+    assert abs(sampled.loc[0, "turnover"] - exact_total) <= sampled.loc[0, "turnover_ci"]
+
+    grouped = approximate.get_dataframe(date_from, today)
+    assert set(grouped.columns) == {"shop_name", "turnover", "turnover_ci", "avg_check"}
+
+
+@pytest.mark.django_db
+def test_analytics_batch_matches_single_requests(api_client, clear_cache, settings):
+    call_command("generate_sales", items=500, shops=3, brands=4, products=20, days=40, stdout=StringIO())
+    date_range = {"from_date": "2020-01-01", "to_date": "2030-12-31"}
+    batch = [
+        {"metrics": ["turnover", "checks_count"], "group_by": ["shop_name"], "date_range": date_range, "total": True},
+        {"metrics": ["sales_qty", "avg_price"], "group_by": ["brand_name", "month_year"], "date_range": date_range},
+        {"metrics": ["unique_products_sold"], "group_by": ["product_name", "month_year"], "date_range": date_range},
+        {"metrics": ["turnover", "unique_products_sold"], "group_by": [], "date_range": date_range},
+    ]
+
+    with patch("DataBuilder.batching.run_shared_scan", wraps=run_shared_scan) as shared_scan:
+        response = api_client.post("/api/analytics/get-analytics-batch/", {"requests": batch}, format="json")
+    assert response.status_code == 200
+    shared_scan.assert_called_once()
+    results = response.json()["results"]
+
+    cache.clear()
+    for params, result in zip(batch, results):
+        single = api_client.post("/api/analytics/get-analytics/", params, format="json").json()
+        key = lambda row: json.dumps(row, sort_keys=True)  # noqa: E731
+        assert sorted(result["data"], key=key) == sorted(single["data"], key=key)
+        assert result.get("total") == single.get("total")
+
+    response = api_client.post("/api/analytics/get-analytics-batch/", {"requests": batch}, format="json")
+    assert 'cache;desc="hit=' in response["Server-Timing"]
+    assert "miss=0" in response["Server-Timing"]
+
+    cache.clear()
+    settings.ANALYTICS_MEMORY_BUDGET = 1_000
+    response = api_client.post("/api/analytics/get-analytics-batch/", {"requests": batch}, format="json")
+    assert response.status_code == 422
+
+
+@pytest.fixture
+def reports_storage(settings, tmp_path):
+    settings.STORAGES = {
+        **settings.STORAGES,
+        "reports": {"BACKEND": "django.core.files.storage.FileSystemStorage", "OPTIONS": {"location": tmp_path}},
+    }
+
+
+@pytest.mark.django_db
+def test_chart_report_is_emailed_as_link_and_downloadable_in_ranges(
+    api_client, base_payload, clear_cache, reports_storage, mailoutbox
+):
+    generate_and_send_chart_task.apply(args=[{**base_payload, "render_type": "chart"}, "chart@example.com"])
+
+    assert not mailoutbox[0].attachments
+    url = re.search(r"https?://\S+", mailoutbox[0].body).group()
+    path = url.split("://", 1)[1].split("/", 1)[1]
+
+    client = APIClient()
+    response = client.get(f"/{path}")
+    assert response.status_code == 200
+    assert response["Content-Encoding"] == "gzip"
+    body = b"".join(response.streaming_content)
+    assert b"plotly" in gzip.decompress(body)
+
+    response = client.get(f"/{path}", headers={"Range": "bytes=10-19"})
+    assert response.status_code == 206
+    assert response["Content-Range"] == f"bytes 10-19/{len(body)}"
+    assert b"".join(response.streaming_content) == body[10:20]
+
+    response = client.get(f"/{path}", headers={"Range": f"bytes={len(body)}-"})
+    assert response.status_code == 416
+    assert client.get(f"/{path[:-3]}xx/").status_code == 404
+
+
+@pytest.mark.django_db
+def test_catalog_uses_cursor_pagination_with_optional_count(api_client):
+    Product.objects.bulk_create([Product(name=f"Кава {i}") for i in range(3)])
+
+    response = api_client.get("/api/products/", {"page_size": 2})
+    assert response.status_code == 200
+    assert "count" not in response.json()
+    assert len(response.json()["results"]) == 2
+
+    response = api_client.get(response.json()["next"])
+    assert [p["name"] for p in response.json()["results"]] == ["Кава 1", "Кава 2"]
+
+    response = api_client.get("/api/products/", {"search": "кав", "count": "exact"})
+    assert response.json()["count"] == 3
+    assert isinstance(api_client.get("/api/products/", {"count": "estimate"}).json()["count"], int)
+
+
+@pytest.mark.django_db
+def test_cart_item_admin_changelist_avoids_per_row_queries(client, clear_cache, django_assert_max_num_queries):
+    call_command("generate_sales", items=200, shops=3, brands=4, products=20, days=10, stdout=StringIO())
+    client.force_login(User.objects.create_superuser(username="admin", password="password123"))
+    shop = Shop.objects.order_by("name").first()
+
+    with django_assert_max_num_queries(12):
+        response = client.get("/admin/DataBuilder/cartitem/", {"shop": shop.id, "period": "30d"})
+    assert response.status_code == 200
+    assert response.context["cl"].result_count == CartItem.objects.filter(receipt__shop=shop).count()
+    assert cache.get("admin:shop-choices")
+
+
+@pytest.mark.django_db
+@patch("DataBuilder.ingestion.schedule_cache_warming")
+def test_open_day_is_served_from_intraday_counters(
+    mock_schedule, setup_db_data, clear_cache, django_capture_on_commit_callbacks, django_assert_num_queries
+):
+    today = timezone.localdate()
+    rebuild_intraday_counters(today)
+    shop, product = Shop.objects.get(), Product.objects.get()
+
+    def sale(when: datetime.datetime, price: float) -> tuple[Receipt, list[CartItem]]:
+        receipt = Receipt(shop=shop, datetime=when, total_price=price, margin_price_total=price / 5)
+        item = CartItem(
+            product=product, price=price, original_price=price, qty=1, total_price=price, margin_price_total=price / 5
+        )
+        return receipt, [item]
+
+    with django_capture_on_commit_callbacks(execute=True):
+        ingest_receipts([sale(timezone.now(), 50.0), sale(timezone.now() - datetime.timedelta(days=1), 20.0)])
+    mock_schedule.assert_called_once()
+
+    service = AnalyticsService(dimensions=["shop_name", "hour"], metrics=["turnover", "checks_count", "avg_check"])
+    assert service.uses_intraday(today, today)
+    service.get_dataframe(today, today)
+    with django_assert_num_queries(0):
+        live = service.get_dataframe(today, today)
+    assert live["turnover"].sum() == 200.0
+    assert live["checks_count"].sum() == 2
+
+    yesterday = today - datetime.timedelta(days=1)
+    combined = service.get_dataframe(yesterday, today, as_total=True)
+    with patch("DataBuilder.services.is_intraday_ready", return_value=False):
+        exact = service.get_dataframe(yesterday, today, as_total=True)
+    assert combined.to_dict(orient="records") == exact.to_dict(orient="records")
+    assert combined.loc[0, "avg_check"] == round(220.0 / 3, 2)
+
+
+@pytest.mark.django_db
+def test_duckdb_engine_matches_orm(settings, tmp_path, clear_cache):
+    pytest.importorskip("duckdb")
+    yesterday = timezone.localdate() - datetime.timedelta(days=1)
+    call_command(
+        "generate_sales", items=2_000, shops=3, brands=4, products=30, days=20, end_date=yesterday, stdout=StringIO()
+    )
+    settings.ANALYTICS_COLUMNAR_ROOT = tmp_path
+    settings.ANALYTICS_ENGINE = "duckdb"
+
+    call_command("sync_columnar_snapshot", stdout=StringIO())
+    assert len(list(tmp_path.glob("cart_items/day=*/*.parquet"))) == 20
+
+    service = AnalyticsService(dimensions=["brand_name", "day_month_year"], metrics=["turnover", "avg_check"])
+    assert service.uses_columnar(yesterday)
+    assert not service.uses_columnar(timezone.localdate())
+
+    out = StringIO()
+    call_command("verify_columnar_engine", stdout=out)
+    assert "All 96 results match the ORM" in out.getvalue()
+
+
+@pytest.mark.django_db
+def test_dimension_filters_are_applied_in_sql(api_client, clear_cache):
+    call_command("generate_sales", items=3_000, shops=3, brands=4, products=30, days=10, stdout=StringIO())
+    today = timezone.localdate()
+    date_from = today - datetime.timedelta(days=9)
+    payload = {
+        "metrics": ["turnover", "checks_count"],
+        "group_by": ["shop_name", "hour"],
+        "date_range": {"from_date": date_from.isoformat(), "to_date": today.isoformat()},
+        "filters": {
+            "shop_name": {"in": ["Магазин 1", "Магазин 2"]},
+            "hour": {"gte": 10, "lte": 18},
+            "brand_name": {"not_in": ["Бренд 1"]},
+        },
+    }
+    response = api_client.post("/api/analytics/get-analytics/", payload, format="json")
+    data = pd.DataFrame(response.json()["data"])
+    assert set(data["shop_name"]) == {"Магазин 1", "Магазин 2"}
+    assert data["hour"].between(10, 18).all()
+
+    expected = (
+        CartItem.objects.filter(
+            datetime__date__gte=date_from,
+            receipt__shop__name__in=["Магазин 1", "Магазин 2"],
+            datetime__hour__gte=10,
+            datetime__hour__lte=18,
+        )
+        .exclude(product__brand__name="Бренд 1")
+        .aggregate(turnover=Sum("total_price"))
+    )
+    assert data["turnover"].sum() == pytest.approx(float(expected["turnover"]))
+
+    service = AnalyticsService.from_params({**payload, "filters": {}})
+    assert AnalyticsService.from_params(payload).get_cache_key(date_from, today) != service.get_cache_key(
+        date_from, today
+    )
+
+    payload["filters"] = {"hour": {"between": [1, 2]}}
+    assert api_client.post("/api/analytics/get-analytics/", payload, format="json").status_code == 400
+
+
+@pytest.mark.django_db
+def test_time_dimensions_use_stored_sale_buckets(clear_cache):
+    call_command("generate_sales", items=2_000, shops=2, brands=3, products=20, days=40, stdout=StringIO())
+    today = timezone.localdate()
+    date_from = today - datetime.timedelta(days=39)
+    dimensions = ["day_month_year", "day_of_week", "month_year", "quarter_year", "year", "hour"]
+    filters = {"day_month_year": {"gte": (today - datetime.timedelta(days=20)).isoformat()}}
+
+    service = AnalyticsService(dimensions, ["turnover", "sales_qty"], filters=filters)
+    queryset, _ = service.build_queryset(date_from, today)
+    sql = str(queryset.query)
+    assert '"sale_day"' in sql and '"sale_hour"' in sql and "EXTRACT" not in sql
+
+    df = service.get_dataframe(date_from, today, refresh=True).sort_values(dimensions, ignore_index=True)
+    with patch.object(AnalyticsService, "uses_sale_buckets", return_value=False):
+        expected = AnalyticsService(dimensions, ["turnover", "sales_qty"], filters=filters).get_dataframe(
+            date_from, today, refresh=True
+        )
+    pd.testing.assert_frame_equal(df, expected.sort_values(dimensions, ignore_index=True))
+
+
+@pytest.mark.django_db
+def test_analytics_results_are_compact_and_memory_bounded(api_client, settings, clear_cache):
+    call_command("generate_sales", items=2_000, shops=3, brands=3, products=40, days=10, stdout=StringIO())
+    today = timezone.localdate()
+    date_from = today - datetime.timedelta(days=9)
+
+    df = AnalyticsService(["product_name", "hour"], ["turnover", "checks_count"]).get_dataframe(date_from, today)
+    assert df["product_name"].dtype == "category"
+    assert df["checks_count"].dtype == "float64"
+    assert df["turnover"].dtype == "float64"
+
+    payload = {
+        "metrics": ["turnover", "checks_count"],
+        "group_by": ["product_name", "hour"],
+        "date_range": {"from_date": date_from.isoformat(), "to_date": today.isoformat()},
+        "prev_date_range": {
+            "from_date": (date_from - datetime.timedelta(days=10)).isoformat(),
+            "to_date": (date_from - datetime.timedelta(days=1)).isoformat(),
+        },
+    }
+    response = api_client.post("/api/analytics/get-analytics/", payload, format="json")
+    assert response.status_code == 200
+    assert len(response.json()["data"]) == len(df)
+
+    cache.clear()
+    settings.ANALYTICS_MEMORY_BUDGET = 10_000
+    response = api_client.post("/api/analytics/get-analytics/", payload, format="json")
+    assert response.status_code == 422
+    assert response.json()["detail"].startswith("Результат запиту завеликий")
+
+
+@pytest.mark.django_db
+def test_comparison_percentages_are_rounded_exactly(api_client, clear_cache):
+    product = Product.objects.get()
+    now = timezone.now()
+    for total_price in (100.00, 50.00, 50.00):
+        add_sale(product, now, total_price=total_price)
+    for _ in range(3):
+        add_sale(product, now - datetime.timedelta(days=1))
+    today = timezone.localdate()
+    yesterday = today - datetime.timedelta(days=1)
+
+    payload = {
+        "metrics": ["turnover", "checks_count", "turnover_diff_percent", "checks_count_diff_percent"],
+        "group_by": ["shop_name"],
+        "date_range": {"from_date": today.isoformat(), "to_date": today.isoformat()},
+        "prev_date_range": {"from_date": yesterday.isoformat(), "to_date": yesterday.isoformat()},
+    }
+    response = api_client.post("/api/analytics/get-analytics/", payload, format="json")
+
+    assert response.status_code == 200
+    row = response.json()["data"][0]
+    assert row["checks_count_diff_percent"] == 33.33
+    assert row["turnover_diff_percent"] == 16.67
+
+
+@pytest.mark.django_db
+def test_chart_json_is_gzipped_binary_figure_and_cached(api_client, clear_cache):
+    call_command("generate_sales", items=1_000, shops=3, brands=3, products=20, days=10, stdout=StringIO())
+    today = timezone.localdate()
+    payload = {
+        "metrics": ["turnover", "checks_count"],
+        "group_by": ["day_month_year"],
+        "date_range": {"from_date": (today - datetime.timedelta(days=9)).isoformat(), "to_date": today.isoformat()},
+        "render_type": "chart",
+        "chart_type": "Line Chart",
+        "chart_format": "json",
+    }
+    response = api_client.post("/api/analytics/get-analytics/", payload, format="json", HTTP_ACCEPT_ENCODING="gzip")
+    assert response.status_code == 200
+    assert response["Content-Encoding"] == "gzip"
+    figure = json.loads(gzip.decompress(response.content))
+    assert {trace["name"] for trace in figure["data"]} == {"turnover", "checks_count"}
+    assert all("bdata" in trace["y"] for trace in figure["data"])
+
+    with patch.object(AnalyticsService, "generate_plotly_chart") as generate:
+        response = api_client.post("/api/analytics/get-analytics/", payload, format="json")
+    generate.assert_not_called()
+    assert "Content-Encoding" not in response
+    assert json.loads(response.content) == figure
+
+
+@pytest.mark.django_db
+def test_analytics_etag_answers_unchanged_polls_with_304(api_client, base_payload, clear_cache):
+    response = api_client.post("/api/analytics/get-analytics/", base_payload, format="json")
+    etag = response["ETag"]
+    assert response.status_code == 200 and response["Cache-Control"] == "private, no-cache"
+
+    with patch("DataBuilder.viewsets.build_analytics_payload") as build_payload:
+        response = api_client.post(
+            "/api/analytics/get-analytics/", base_payload, format="json", HTTP_IF_NONE_MATCH=f"W/{etag}"
+        )
+    assert response.status_code == 304 and response["ETag"] == etag
+    build_payload.assert_not_called()
+
+    query = "metrics=turnover,checks_count&group_by=shop_name&from_date=2020-01-01&to_date=2026-12-31"
+    response = api_client.get(f"/api/analytics/get-analytics/?{query}")
+    assert response.status_code == 200 and response["ETag"] == etag
+    assert response.json() == api_client.post("/api/analytics/get-analytics/", base_payload, format="json").json()
+
+    add_sale(Product.objects.get(), timezone.now())
+    bump_data_version()
+    response = api_client.get(f"/api/analytics/get-analytics/?{query}", HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200 and response["ETag"] != etag
+    assert response.json()["data"][0]["turnover"] == 250.0
+    assert api_client.get(f"/api/analytics/get-analytics/?{query}&render_type=excel").status_code == 400
+
+
+@pytest.mark.django_db
+@patch("DataBuilder.ingestion.schedule_rollup_refresh")
+@patch("DataBuilder.ingestion.schedule_cache_warming")
+def test_ingestion_keeps_cached_closed_days(
+    mock_warming, mock_refresh, setup_db_data, clear_cache, django_capture_on_commit_callbacks
+):
+    today = timezone.localdate()
+    last_month_to = today.replace(day=1) - datetime.timedelta(days=1)
+    last_month_from = last_month_to.replace(day=1)
+    add_sale(Product.objects.get(), timezone.now() - datetime.timedelta(days=today.day + 1))
+    service = AnalyticsService(dimensions=["shop_name"], metrics=["turnover"])
+    service.get_dataframe(last_month_from, last_month_to)
+    closed_key = service.get_cache_key(last_month_from, last_month_to)
+    open_key = service.get_cache_key(today, today)
+
+    receipt = Receipt(shop=Shop.objects.get(), datetime=timezone.now(), total_price=10.00, margin_price_total=2.00)
+    item = CartItem(
+        product=Product.objects.get(),
+        price=10.00,
+        original_price=10.00,
+        qty=1,
+        total_price=10.00,
+        margin_price_total=2.00,
+    )
+    with django_capture_on_commit_callbacks(execute=True):
+        ingest_receipts([(receipt, [item])])
+
+    assert service.get_cache_key(last_month_from, last_month_to) == closed_key
+    assert cache.get(closed_key) is not None
+    assert service.get_cache_key(today, today) != open_key
+
+
+@pytest.mark.django_db
+def test_columns_layout_matches_records(api_client, clear_cache):
+    call_command("generate_sales", items=1_000, shops=3, brands=3, products=20, days=10, stdout=StringIO())
+    today = timezone.localdate()
+    payload = {
+        "metrics": ["turnover", "checks_count", "avg_check"],
+        "group_by": ["day_month_year", "shop_name"],
+        "date_range": {"from_date": (today - datetime.timedelta(days=9)).isoformat(), "to_date": today.isoformat()},
+        "total": True,
+    }
+    records = api_client.post("/api/analytics/get-analytics/", payload, format="json").json()
+    serializer = AnalyticsRequestSerializer(data=payload)
+    serializer.is_valid(raise_exception=True)
+    df = get_analytics_dataframe(serializer.validated_data)
+    assert records["data"] == json.loads(JSONRenderer().render(df.to_dict(orient="records")))
+    assert records["data"][0]["day_month_year"].endswith("T00:00:00Z")
+
+    columns = api_client.post("/api/analytics/get-analytics/", {**payload, "layout": "columns"}, format="json").json()
+    assert columns["total"] == records["total"]
+    assert [dict(zip(columns["columns"], row)) for row in columns["data"]] == records["data"]
+
+
+@pytest.mark.django_db
+def test_subscriptions_share_reports_and_email_once_per_period(
+    setup_db_data, settings, clear_cache, reports_storage, mailoutbox
+):
+    settings.ANALYTICS_SUBSCRIPTION_EMAIL_BATCH = 2
+    request_data = {"metrics": ["turnover"], "group_by": ["shop_name"]}
+    for name, recipients in [("Продажі A", ["a@example.com", "b@example.com"]), ("Продажі B", ["c@example.com"])]:
+        ReportSubscription.objects.create(
+            name=name, owner=setup_db_data, request_data=request_data, frequency="weekly", recipients=recipients
+        )
+    today = datetime.date(2026, 10, 21)
+
+    with patch("django.core.mail.backends.locmem.EmailBackend.send_messages", autospec=True) as send_messages:
+        send_messages.side_effect = lambda backend, messages: mailoutbox.extend(messages) or len(messages)
+        assert send_due_subscriptions(today) == (1, 3)
+    assert [len(call.args[1]) for call in send_messages.call_args_list] == [2, 1]
+    assert len({call.args[0] for call in send_messages.call_args_list}) == 1
+    assert ReportArtifact.objects.count() == 1
+    assert {m.to[0] for m in mailoutbox} == {"a@example.com", "b@example.com", "c@example.com"}
+    assert "12.10.2026 – 18.10.2026" in mailoutbox[0].subject
+    assert ReportSubscription.objects.filter(last_period_start=datetime.date(2026, 10, 12)).count() == 2
+
+    assert send_due_subscriptions(today) == (0, 0)
+    assert send_due_subscriptions(datetime.date(2026, 10, 26)) == (1, 3)
+
+
+@pytest.mark.django_db
+def test_concurrent_query_quota_answers_429_with_retry_after(
+    api_client, setup_db_data, base_payload, settings, clear_cache
+):
+    settings.ANALYTICS_QUERY_QUEUE_TIMEOUT = 0
+    key = f"analytics:query-slots:user:{setup_db_data.pk}"
+    get_redis_connection("default").zadd(key, {"first": time.time() + 60, "second": time.time() + 60})
+
+    response = api_client.post("/api/analytics/get-analytics/", base_payload, format="json")
+    assert response.status_code == 429
+    assert response["Retry-After"] == "2"
+
+    get_redis_connection("default").zrem(key, "first")
+    assert api_client.post("/api/analytics/get-analytics/", base_payload, format="json").status_code == 200
+    assert get_redis_connection("default").zcard(key) == 1
+
+
+@pytest.mark.django_db
+def test_slow_and_abandoned_queries_are_cancelled_in_postgres(setup_db_data, settings, clear_cache):
+    settings.ANALYTICS_TASK_STATEMENT_TIMEOUT = 100
+    with pytest.raises(QueryTimeout), guarded_queries(), connection.cursor() as cursor:
+        cursor.execute("SELECT pg_sleep(5)")
+
+    settings.ANALYTICS_DISCONNECT_POLL_INTERVAL = 0.05
+    server_socket, client_socket = socket.socketpair()
+    request = RequestFactory().get("/api/analytics/get-analytics/")
+    request.user = setup_db_data
+    request.META["gunicorn.socket"] = server_socket
+    threading.Timer(0.2, client_socket.close).start()
+
+    started = time.monotonic()
+    with pytest.raises(ClientClosedRequest), request_limits(request), guarded_queries(), connection.cursor() as cursor:
+        cursor.execute("SELECT pg_sleep(5)")
+    assert time.monotonic() - started < 3
+    server_socket.close()
+
+
+@pytest.mark.django_db
+def test_tasks_are_routed_by_size_and_queue_wait_is_recorded(admin_client, base_payload, settings, clear_cache):
+    excel = "DataBuilder.tasks.generate_and_send_excel_task"
+    request_data = {**base_payload, "render_type": "excel", "email": "excel@example.com"}
+    assert get_estimate_queue({"rows": 10, "cost": 100.0}) == "analytics"
+    settings.ANALYTICS_BULK_TASK_MIN_COST = 0
+    assert get_estimate_queue({"rows": 10, "cost": 100.0}) == "reports"
+    with patch("DataBuilder.services.estimate_request_cost") as estimate:
+        assert route_task(excel, (request_data,), {}, {}) == {"queue": "reports"}
+        assert route_task(excel, (request_data,), {}, {"queue": "analytics"}) is None
+    estimate.assert_not_called()
+    assert route_task("DataBuilder.tasks.warm_analytics_cache_task", (), {}, {}) == {"queue": "maintenance"}
+
+    headers = {}
+    stamp_published_at(headers=headers)
+    request = SimpleNamespace(
+        published_at=headers["published_at"] - 3, eta=None, delivery_info={"routing_key": "reports"}
+    )
+    record_queue_wait(task=SimpleNamespace(request=request, name=excel))
+
+    metrics = admin_client.get("/metrics").content.decode()
+    labels = f'queue="reports",task="{excel}"'
+    assert f'analytics_task_queue_wait_seconds_bucket{{{labels},le="2.5"}} 0' in metrics
+    assert f'analytics_task_queue_wait_seconds_bucket{{{labels},le="5.0"}} 1' in metrics
+
+
+@pytest.mark.django_db
+def test_slow_queries_are_logged_with_tags_and_aggregated_per_fingerprint(
+    api_client, base_payload, settings, clear_cache, admin_client
+):
+    settings.ANALYTICS_SLOW_QUERY_MS = 0
+    settings.ANALYTICS_QUERY_SAMPLE_RATE = 0
+    with patch("DataBuilder.querylog.logger") as logger:
+        response = api_client.post(
+            "/api/analytics/get-analytics/", base_payload, format="json", headers={"X-Request-ID": "req-42"}
+        )
+    assert response["X-Request-ID"] == "req-42"
+    tagged = [
+        call.args
+        for call in logger.log.call_args_list
+        if call.args[6:8] == ("req-42", "shop_name") and set(call.args[8].split(",")) == {"turnover", "checks_count"}
+    ]
+    assert tagged and tagged[0][0] == logging.WARNING
+
+    sql = "SELECT %s + 1 WHERE 2 IN (%s, %s)"
+    assert get_fingerprint(sql) == get_fingerprint("SELECT  %s + 7 WHERE 2 IN (%s)")
+    assert get_fingerprint('SAVEPOINT "s1402_x26"') == get_fingerprint('SAVEPOINT "s1403_x27"')
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [1, 2, 3])
+        cursor.execute("SELECT %s + 7 WHERE 2 IN (%s)", [1, 2])
+    assert collect_query_stats() > 1
+
+    stats = QueryFingerprint.objects.get(fingerprint=get_fingerprint(sql)[0])
+    assert stats.calls == 2 and stats.rows == 2
+    assert 0 < stats.p50_ms <= stats.p95_ms
+    assert (
+        "shop" in admin_client.get("/admin/DataBuilder/queryfingerprint/", {"q": "DataBuilder_shop"}).content.decode()
+    )
+
+
+@pytest.mark.django_db
+def test_buffered_query_stats_are_flushed_when_a_request_finishes(api_client, settings, clear_cache):
+    settings.ANALYTICS_QUERY_STATS_FLUSH_INTERVAL = 60
+    query_stats.flush()
+    query_stats.add("idle-fingerprint", "SELECT ?", 3.0, 1)
+    redis = get_redis_connection("default")
+    assert not redis.exists(f"{QUERY_STATS_KEY_PREFIX}:idle-fingerprint")
+
+    query_stats.flushed_at -= 60
+    api_client.get("/metrics")
+    assert redis.hget(f"{QUERY_STATS_KEY_PREFIX}:idle-fingerprint", "calls") == b"1"
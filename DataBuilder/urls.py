@@ -2,7 +2,7 @@ from django.urls import path, include
 from django.contrib import admin
 from rest_framework.routers import DefaultRouter
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView, TokenBlacklistView
-from .viewsets import BrandViewSet, ProductViewSet, ShopViewSet, AnalyticsViewSet
+from .viewsets import BrandViewSet, ProductViewSet, ShopViewSet, AnalyticsViewSet, metrics_view, report_download_view
 
 router = DefaultRouter()
 router.register(r"brands", BrandViewSet)
@@ -16,4 +16,6 @@ urlpatterns = [
     path("api/token/", TokenObtainPairView.as_view(), name="token_obtain_pair"),
     path("api/token/refresh/", TokenRefreshView.as_view(), name="token_refresh"),
     path("api/token/logout/", TokenBlacklistView.as_view(), name="token_blacklist"),
+    path("metrics", metrics_view, name="metrics"),
+    path("api/reports/<str:token>/", report_download_view, name="report-download"),
 ]
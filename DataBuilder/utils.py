@@ -1,8 +1,34 @@
 import hashlib
 import json
 import datetime
+from typing import Any, Iterator, TypedDict
+
 import pandas as pd
 import numpy as np
+from django.db import connections
+from django.db.models import QuerySet
+from django.db.models.sql.compiler import SQLCompiler
+from django.utils import timezone
+
+
+class QueryEstimate(TypedDict):
+    rows: int
+    cost: float
+
+
+def serialize_filters(filters: dict[str, dict[str, Any]] | None) -> dict[str, dict[str, Any]]:
+    # JSON form of dimension filters with dates as ISO strings and lists sorted, so equal filters compare equal.
+    def serialize(value: Any) -> Any:
+        if isinstance(value, list):
+            return sorted(serialize(v) for v in value)
+        if isinstance(value, datetime.date):
+            return value.isoformat()
+        return value
+
+    return {
+        dimension: {operator: serialize(value) for operator, value in conditions.items()}
+        for dimension, conditions in (filters or {}).items()
+    }
 
 
 def generate_analytics_cache_key(
@@ -10,6 +36,9 @@ def generate_analytics_cache_key(
     date_to: datetime.date,
     dimensions: list[str],
     metrics: list[str],
+    sample_percent: float | None = None,
+    filters: dict[str, dict[str, Any]] | None = None,
+    data_version: str | None = None,
 ) -> str:
     payload = {
         "date_from": date_from.isoformat(),
@@ -17,6 +46,12 @@ def generate_analytics_cache_key(
         "dimensions": sorted(dimensions),
         "metrics": sorted(metrics),
     }
+    if sample_percent is not None:
+        payload["sample_percent"] = sample_percent
+    if filters:
+        payload["filters"] = filters
+    if data_version is not None:
+        payload["data_version"] = data_version
 
     payload_str = json.dumps(payload, sort_keys=True)
     hash_object = hashlib.md5(payload_str.encode("utf-8"))
@@ -24,6 +59,70 @@ def generate_analytics_cache_key(
     return f"analytics:{hash_object.hexdigest()}"
 
 
+def explain_estimate(queryset: QuerySet) -> QueryEstimate | None:
+    # Planner estimates are only available in a parseable form on PostgreSQL.
+    if connections[queryset.db].vendor != "postgresql":
+        return None
+
+    plan = json.loads(queryset.explain(format="json"))
+    if isinstance(plan, list):
+        plan = plan[0]
+
+    return {"rows": int(plan["Plan"]["Plan Rows"]), "cost": float(plan["Plan"]["Total Cost"])}
+
+
+def execute_compiled(
+    compiler: SQLCompiler, sql: str, params, converted_columns: int | None = None
+) -> tuple[list[str], list[tuple]]:
+    # Runs SQL rewritten from the compiler's own query, applying the same value converters
+    # (e.g. aware datetimes for Trunc dimensions) to the first converted_columns columns.
+    with compiler.connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        columns = [column.name for column in cursor.description]
+        rows = cursor.fetchall()
+
+    fields = [select[0] for select in compiler.select[: compiler.col_count]]
+    converters = compiler.get_converters(fields)
+    if converted_columns is not None:
+        converters = {i: c for i, c in converters.items() if i < converted_columns}
+    if converters:
+        rows = [tuple(row) for row in compiler.apply_converters(rows, converters)]
+
+    return columns, rows
+
+
+def iter_compiled(compiler: SQLCompiler, sql: str, params, chunk_size: int) -> Iterator[dict[str, Any]]:
+    # Like execute_compiled, but rows come from a server-side cursor one chunk at a time.
+    fields = [select[0] for select in compiler.select[: compiler.col_count]]
+    converters = compiler.get_converters(fields)
+    with compiler.connection.chunked_cursor() as cursor:
+        cursor.execute(sql, params)
+        columns = [column.name for column in cursor.description]
+        while rows := cursor.fetchmany(chunk_size):
+            if converters:
+                rows = compiler.apply_converters(rows, converters)
+            for row in rows:
+                yield dict(zip(columns, row))
+
+
+def get_datetime_bounds(
+    date_from: datetime.date,
+    date_to: datetime.date,
+) -> tuple[datetime.datetime, datetime.datetime]:
+    # Half-open [date_from, date_to + 1 day) so that to_date covers the whole day.
+    start = timezone.make_aware(datetime.datetime.combine(date_from, datetime.time.min))
+    end = timezone.make_aware(datetime.datetime.combine(date_to + datetime.timedelta(days=1), datetime.time.min))
+    return start, end
+
+
+def get_analytics_job_key(job_id: str) -> str:
+    return f"analytics:job:{job_id}"
+
+
+def get_analytics_job_owner_key(job_id: str) -> str:
+    return f"analytics:job-owner:{job_id}"
+
+
 def calculate_diffs(
     df_curr: pd.DataFrame,
     df_prev: pd.DataFrame,
@@ -31,6 +130,11 @@ def calculate_diffs(
     base_metrics: set[str],
     requested_metrics: list[str],
 ) -> pd.DataFrame:
+    # A period without sales comes back as a DataFrame without any columns.
+    expected_columns = [*merge_on, *base_metrics]
+    df_curr = df_curr.reindex(columns=df_curr.columns.union(expected_columns, sort=False))
+    df_prev = df_prev.reindex(columns=df_prev.columns.union(expected_columns, sort=False))
+
     rename_map = {m: f"{m}_prev" for m in base_metrics}
     df_prev = df_prev.rename(columns=rename_map)
 
@@ -1,22 +1,59 @@
+import gzip
+import uuid
 from typing import Union
 
+from celery.result import AsyncResult
 from rest_framework import viewsets, filters as drf_filters, status
 from django_filters.rest_framework import DjangoFilterBackend
+from rest_framework.renderers import BrowsableAPIRenderer
 from rest_framework.request import Request
 from rest_framework.response import Response
 from rest_framework.decorators import action
-from django.http import HttpResponse
+from rest_framework.exceptions import PermissionDenied
+from rest_framework.reverse import reverse
+from django.conf import settings
+from django.core.cache import cache
+from django.http import Http404, HttpRequest, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+from django.utils.http import content_disposition_header
 
 
-from .models import Brand, Shop, Product
-from .serializers import BrandSerializer, ShopSerializer, ProductSerializer, AnalyticsRequestSerializer
+from .models import Brand, Shop, Product, ReportArtifact
+from .serializers import (
+    AnalyticsBatchRequestSerializer,
+    AnalyticsRequestSerializer,
+    BrandSerializer,
+    ProductSerializer,
+    ShopSerializer,
+    parse_analytics_query,
+)
+from .batching import build_analytics_batch
+from .etags import etag_matches, get_analytics_etag
 from .filtersets import ProductFilter
-from .services import AnalyticsService
-from .tasks import generate_and_send_excel_task, generate_and_send_chart_task
+from .pagination import CatalogCursorPagination
+from .instrumentation import finish_timings, get_current_timings, render_prometheus_metrics, start_timings, timed
+from .limits import request_limits
+from .profiling import profile_call, store_profile
+from .queues import get_estimate_queue, get_request_queue
+from .renderers import AnalyticsJSONRenderer
+from .reports import get_artifact_id, iter_file_range, parse_range
+from .services import (
+    AnalyticsService,
+    build_analytics_payload,
+    build_chart_json,
+    estimate_request_cost,
+    exceeds_sync_budget,
+    get_analytics_dataframe,
+)
+from .tasks import generate_analytics_task, generate_and_send_excel_task, generate_and_send_chart_task
+from .utils import get_analytics_job_key, get_analytics_job_owner_key
+from .warming import record_analytics_usage
 
 
 class BaseViewSet(viewsets.ModelViewSet):
     filter_backends = [DjangoFilterBackend, drf_filters.OrderingFilter, drf_filters.SearchFilter]
+    pagination_class = CatalogCursorPagination
+    ordering = ["id"]
 
 
 class BrandViewSet(BaseViewSet):
@@ -42,31 +79,98 @@ class ProductViewSet(BaseViewSet):
 
 
 class AnalyticsViewSet(BaseViewSet):
-    @action(detail=False, methods=["post"], url_path="get-analytics")
+    renderer_classes = [AnalyticsJSONRenderer, BrowsableAPIRenderer]
+
+    def initial(self, request: Request, *args, **kwargs) -> None:
+        start_timings("web")
+        super().initial(request, *args, **kwargs)
+
+    def finalize_response(self, request: Request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+
+        timings = get_current_timings()
+        if timings is not None:
+            # Render here so that serialization shows up in the breakdown as well.
+            if hasattr(response, "render") and not response.is_rendered:
+                with timed("render"):
+                    response.render()
+            response["Server-Timing"] = timings.as_server_timing()
+            finish_timings(timings)
+
+        return response
+
+    @action(detail=False, methods=["get", "post"], url_path="get-analytics")
     def get_analytics(self, request: Request) -> Union[Response, HttpResponse]:
-        serializer = AnalyticsRequestSerializer(data=request.data)
+        data = parse_analytics_query(request.query_params) if request.method == "GET" else request.data
+        serializer = AnalyticsRequestSerializer(data=data)
         serializer.is_valid(raise_exception=True)
 
         params = serializer.validated_data
         render_type = params.get("render_type", "json")
         email = params.get("email")
 
+        timings = get_current_timings()
+        if timings is not None:
+            group_by = params.get("group_by", [])
+            timings.set_request(render_type, [d for d in group_by if d in AnalyticsService.DIMENSION_MAPPING])
+
         if render_type == "excel":
-            generate_and_send_excel_task.delay(request.data)
+            queue = get_request_queue(generate_and_send_excel_task.name, params)
+            generate_and_send_excel_task.apply_async(args=[data], queue=queue)
             return Response(
                 {"message": "Запит прийнято. Звіт формується та буде надіслано на пошту."},
                 status=status.HTTP_202_ACCEPTED,
             )
 
-        if render_type == "chart":
-            if email:
-                generate_and_send_chart_task.delay(request.data, email)
-                return Response(
-                    {"message": "Запит прийнято. Графік формується та буде надіслано на пошту."},
-                    status=status.HTTP_202_ACCEPTED,
-                )
+        if render_type == "chart" and email:
+            queue = get_request_queue(generate_and_send_chart_task.name, params)
+            generate_and_send_chart_task.apply_async(args=[data, email], queue=queue)
+            return Response(
+                {"message": "Запит прийнято. Графік формується та буде надіслано на пошту."},
+                status=status.HTTP_202_ACCEPTED,
+            )
+
+        if request.query_params.get("profile") == "1":
+            return self._profile_analytics(request, data, params)
+
+        record_analytics_usage(params)
 
-            df = self._get_analytics_dataframe(params)
+        # Answered before any DataFrame is loaded or rendered.
+        etag = get_analytics_etag(params)
+        if etag_matches(request, etag):
+            return set_validators(HttpResponseNotModified(), etag)
+
+        estimate = estimate_request_cost(params)
+        if exceeds_sync_budget(estimate):
+            # The owner is known before the task can run, so job ids are never answered for anyone else.
+            job_id = str(uuid.uuid4())
+            ttl = getattr(settings, "ANALYTICS_JOB_RESULT_TTL", 60 * 60)
+            cache.set(get_analytics_job_owner_key(job_id), request.user.id, timeout=ttl)
+            generate_analytics_task.apply_async(
+                args=[data, request.user.id], task_id=job_id, queue=get_estimate_queue(estimate)
+            )
+            return Response(
+                {
+                    "message": "Запит надто важкий для синхронного виконання. Результат формується у фоні.",
+                    "job_id": job_id,
+                    "status_url": reverse("analytics-job", kwargs={"job_id": job_id}, request=request),
+                },
+                status=status.HTTP_202_ACCEPTED,
+            )
+
+        # Uncached queries run under a statement timeout and the user's concurrency quota,
+        # and are cancelled in Postgres if the client goes away.
+        with request_limits(request):
+            return set_validators(self._render_analytics(request, params), etag)
+
+    @staticmethod
+    def _render_analytics(request: Request, params: dict) -> Union[Response, HttpResponse]:
+        render_type = params.get("render_type", "json")
+        if render_type == "chart" and params.get("chart_format") == "json":
+            return gzipped_json_response(request, build_chart_json(params))
+
+        if render_type == "chart":
+            df = get_analytics_dataframe(params)
 
             service = AnalyticsService(
                 dimensions=params.get("group_by", []),
@@ -76,43 +180,126 @@ class AnalyticsViewSet(BaseViewSet):
 
             return HttpResponse(chart_html, content_type="text/html")
 
-        df = self._get_analytics_dataframe(params)
-        response_payload = {}
-        group_by = params.get("group_by", [])
-        include_total = params.get("total", False)
+        return Response(build_analytics_payload(params))
 
-        if not group_by:
-            return Response({"data": df.to_dict(orient="records")})
+    @action(detail=False, methods=["post"], url_path="get-analytics-batch")
+    def get_analytics_batch(self, request: Request) -> Response:
+        serializer = AnalyticsBatchRequestSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
 
-        if include_total:
-            total_df = self._get_total_dataframe(params)
-            response_payload["total"] = total_df.to_dict(orient="records")[0] if not total_df.empty else {}
+        params_list = serializer.validated_data["requests"]
+        timings = get_current_timings()
+        if timings is not None:
+            group_by = {d for params in params_list for d in params.get("group_by", [])}
+            timings.set_request("batch", [d for d in group_by if d in AnalyticsService.DIMENSION_MAPPING])
 
-        response_payload["data"] = df.to_dict(orient="records")
-        return Response(response_payload)
+        for params in params_list:
+            record_analytics_usage(params)
 
-    @staticmethod
-    def _get_analytics_dataframe(params):
-        service = AnalyticsService(
-            dimensions=params.get("group_by", []),
-            metrics=params.get("metrics", []),
-        )
-        current_range = params["date_range"]
-        prev_range = params.get("prev_date_range")
-
-        if prev_range:
-            return service.get_comparison_dataframe(current_range, prev_range)
-        return service.get_dataframe(current_range["from_date"], current_range["to_date"])
+        with request_limits(request):
+            return Response({"results": build_analytics_batch(params_list)})
 
-    @staticmethod
-    def _get_total_dataframe(params):
-        service = AnalyticsService(
-            dimensions=params.get("group_by", []),
-            metrics=params.get("metrics", []),
-        )
-        current_range = params["date_range"]
-        prev_range = params.get("prev_date_range")
-
-        if prev_range:
-            return service.get_comparison_dataframe(current_range, prev_range, as_total=True)
-        return service.get_dataframe(current_range["from_date"], current_range["to_date"], as_total=True)
+    def _profile_analytics(self, request: Request, data: dict, params: dict) -> Response:
+        if not request.user.is_staff:
+            raise PermissionDenied("Профілювання доступне лише персоналу.")
+
+        # The same rendering path as an ordinary request; only JSON results are sent back with the profile.
+        def run_analytics():
+            response = self._render_analytics(request, params)
+            return response.data if isinstance(response, Response) else None
+
+        # Under the same statement timeout and query slot as an ordinary request.
+        with request_limits(request):
+            result, report = profile_call(run_analytics)
+        timings = get_current_timings()
+        if timings is not None:
+            report["stages_ms"] = {stage: round(seconds * 1000, 3) for stage, seconds in timings.stages.items()}
+
+        # The parsed form, so GET profiles are stored with their query too.
+        profile = store_profile(request.user, data, report)
+        return Response({"profile_id": profile.id, "profile": report, "result": result})
+
+    @action(detail=False, methods=["get"], url_path=r"jobs/(?P<job_id>[^/.]+)", url_name="job")
+    def job(self, request: Request, job_id: str) -> Union[Response, HttpResponse]:
+        if cache.get(get_analytics_job_owner_key(job_id)) != request.user.id:
+            raise Http404
+
+        result = cache.get(get_analytics_job_key(job_id))
+        if result is not None:
+            if result.get("chart_format") == "json":
+                return gzipped_json_response(request, result["content"])
+            if result["render_type"] == "chart":
+                return HttpResponse(result["content"], content_type="text/html")
+            return Response(result["content"])
+
+        job_state = AsyncResult(job_id).state
+        if job_state == "FAILURE":
+            return Response(
+                {"status": job_state, "message": "Не вдалося сформувати результат."},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            )
+        return Response({"status": job_state}, status=status.HTTP_202_ACCEPTED)
+
+
+def set_validators(response: HttpResponse, etag: str) -> HttpResponse:
+    # Clients and shared caches revalidate every time; unchanged data costs a 304.
+    response["ETag"] = etag
+    response["Cache-Control"] = getattr(settings, "ANALYTICS_HTTP_CACHE_CONTROL", "private, no-cache")
+    patch_vary_headers(response, ["Authorization"])
+    return response
+
+
+def gzipped_json_response(request: HttpRequest, body: bytes) -> HttpResponse:
+    # The body is stored gzipped; only clients that cannot take it get it decompressed.
+    if "gzip" in request.headers.get("Accept-Encoding", ""):
+        response = HttpResponse(body, content_type="application/json")
+        response["Content-Encoding"] = "gzip"
+    else:
+        response = HttpResponse(gzip.decompress(body), content_type="application/json")
+    patch_vary_headers(response, ["Accept-Encoding"])
+    return response
+
+
+def metrics_view(request: HttpRequest) -> HttpResponse:
+    token = getattr(settings, "METRICS_AUTH_TOKEN", None)
+    if token and request.headers.get("Authorization") != f"Bearer {token}":
+        return HttpResponse(status=status.HTTP_401_UNAUTHORIZED)
+    # Without a token only staff sessions see the traffic and timing of every dashboard.
+    if not token and not request.user.is_staff:
+        return HttpResponse(status=status.HTTP_403_FORBIDDEN)
+
+    return HttpResponse(render_prometheus_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def report_download_view(request: HttpRequest, token: str) -> HttpResponse:
+    artifact_id = get_artifact_id(token)
+    artifact = ReportArtifact.objects.filter(id=artifact_id).first() if artifact_id else None
+    if artifact is None:
+        raise Http404
+
+    etag = f'"{artifact.id}"'
+    byte_range = None
+    range_header = request.headers.get("Range")
+    if range_header and request.headers.get("If-Range", etag) == etag:
+        byte_range = parse_range(range_header, artifact.size)
+
+    if byte_range is not None and (byte_range[0] > byte_range[1] or byte_range[0] >= artifact.size):
+        response = HttpResponse(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+        response["Content-Range"] = f"bytes */{artifact.size}"
+        return response
+
+    start, end = byte_range or (0, artifact.size - 1)
+    response = StreamingHttpResponse(
+        iter_file_range(artifact.file.open("rb"), start, end - start + 1),
+        status=status.HTTP_206_PARTIAL_CONTENT if byte_range else status.HTTP_200_OK,
+        content_type=artifact.content_type,
+    )
+    if byte_range:
+        response["Content-Range"] = f"bytes {start}-{end}/{artifact.size}"
+    if artifact.content_encoding:
+        response["Content-Encoding"] = artifact.content_encoding
+    response["Content-Length"] = str(end - start + 1)
+    response["Accept-Ranges"] = "bytes"
+    response["ETag"] = etag
+    response["Content-Disposition"] = content_disposition_header(True, artifact.filename)
+    return response
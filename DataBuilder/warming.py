@@ -0,0 +1,132 @@
+import datetime
+import json
+import logging
+import time
+from typing import Any
+
+from django.conf import settings
+from django.utils import timezone
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+
+from .services import AnalyticsService
+from .utils import serialize_filters
+
+logger = logging.getLogger(__name__)
+
+USAGE_KEY_PREFIX = "analytics:usage"
+POPULAR_KEY = "analytics:usage:popular"
+
+
+def normalize_request(params: dict, today: datetime.date | None = None) -> dict[str, Any]:
+    # Dates are stored relative to today, so "last 7 days" stays one entry as the days go by.
+    today = today or timezone.localdate()
+    current_range = params["date_range"]
+    prev_range = params.get("prev_date_range")
+
+    spec = {
+        "group_by": sorted(params.get("group_by", [])),
+        "metrics": sorted(params.get("metrics", [])),
+        "total": bool(params.get("total", False)) and bool(params.get("group_by")),
+        "approximate": bool(params.get("approximate", False)),
+        "filters": serialize_filters(params.get("filters")),
+        "span_days": (current_range["to_date"] - current_range["from_date"]).days,
+        "end_offset": (today - current_range["to_date"]).days,
+        "prev": None,
+    }
+    if prev_range:
+        spec["prev"] = {
+            "span_days": (prev_range["to_date"] - prev_range["from_date"]).days,
+            "end_offset": (current_range["from_date"] - prev_range["to_date"]).days,
+        }
+    return spec
+
+
+def materialize_request(spec: dict[str, Any], today: datetime.date | None = None) -> dict[str, Any]:
+    today = today or timezone.localdate()
+    to_date = today - datetime.timedelta(days=spec["end_offset"])
+    from_date = to_date - datetime.timedelta(days=spec["span_days"])
+
+    params = {
+        "group_by": spec["group_by"],
+        "metrics": spec["metrics"],
+        "total": spec["total"],
+        "approximate": spec.get("approximate", False),
+        "filters": spec.get("filters", {}),
+        "date_range": {"from_date": from_date, "to_date": to_date},
+        "prev_date_range": None,
+    }
+    if spec["prev"]:
+        prev_to = from_date - datetime.timedelta(days=spec["prev"]["end_offset"])
+        params["prev_date_range"] = {
+            "from_date": prev_to - datetime.timedelta(days=spec["prev"]["span_days"]),
+            "to_date": prev_to,
+        }
+    return params
+
+
+def get_usage_key(day: datetime.date) -> str:
+    return f"{USAGE_KEY_PREFIX}:{day.isoformat()}"
+
+
+def record_analytics_usage(params: dict) -> None:
+    # Only requests relative to the recent past are worth warming.
+    spec = normalize_request(params)
+    if spec["end_offset"] < 0 or spec["end_offset"] > getattr(settings, "ANALYTICS_WARM_MAX_END_OFFSET", 31):
+        return
+
+    key = get_usage_key(timezone.localdate())
+    try:
+        redis = get_redis_connection("default")
+        pipe = redis.pipeline(transaction=False)
+        pipe.zincrby(key, 1, json.dumps(spec, sort_keys=True))
+        pipe.expire(key, (getattr(settings, "ANALYTICS_USAGE_DAYS", 14) + 1) * 24 * 60 * 60)
+        pipe.execute()
+    except RedisError:
+        logger.warning("Could not record analytics usage", exc_info=True)
+
+
+def get_popular_requests(limit: int) -> list[dict[str, Any]]:
+    today = timezone.localdate()
+    decay = getattr(settings, "ANALYTICS_USAGE_DECAY", 0.8)
+    weights = {
+        get_usage_key(today - datetime.timedelta(days=age)): decay**age
+        for age in range(getattr(settings, "ANALYTICS_USAGE_DAYS", 14))
+    }
+
+    redis = get_redis_connection("default")
+    pipe = redis.pipeline(transaction=False)
+    pipe.zunionstore(POPULAR_KEY, weights)
+    pipe.zrevrange(POPULAR_KEY, 0, limit - 1)
+    _, members = pipe.execute()
+    return [json.loads(member) for member in members]
+
+
+def warm_request(params: dict) -> int:
+    service = AnalyticsService.from_params(params)
+    date_ranges = [params["date_range"]]
+    if params["prev_date_range"]:
+        date_ranges.append(params["prev_date_range"])
+
+    warmed = 0
+    for date_range in date_ranges:
+        totals = [False, True] if params["total"] else [False]
+        for as_total in totals:
+            service.get_dataframe(date_range["from_date"], date_range["to_date"], as_total=as_total, refresh=True)
+            warmed += 1
+    return warmed
+
+
+def warm_popular_requests() -> tuple[int, int]:
+    budget = getattr(settings, "ANALYTICS_WARM_BUDGET", 120)
+    top_k = getattr(settings, "ANALYTICS_WARM_TOP_K", 20)
+    deadline = time.monotonic() + budget
+
+    requests_warmed = dataframes_warmed = 0
+    for spec in get_popular_requests(top_k):
+        if time.monotonic() >= deadline:
+            break
+        dataframes_warmed += warm_request(materialize_request(spec))
+        requests_warmed += 1
+
+    return requests_warmed, dataframes_warmed